@@ -1,19 +1,51 @@
 import os
 import tkinter as tk
 import tkinter.ttk as ttk
-import ttkthemes
 from tkinter import filedialog, messagebox
-from archiver import get_archiver
-from crypto import FileCrypto
-from locker import Locker
+from functools import lru_cache
+from instrument import ProgressTracker
 import threading
 import shutil
 
 
 
-archiver = get_archiver("tarfile")
-crypto = FileCrypto()
-locker = Locker(archiver, crypto)
+# Milliseconds between progress bar updates
+PROGRESS_INTERVAL = 200
+
+
+@lru_cache(maxsize=None)
+def backend():
+    # (archiver, crypto) shared by every operation. Built, and their modules
+    # imported, on the first lock or unlock rather than before the window shows.
+    from archiver import get_archiver
+    from crypto import FileCrypto
+    return get_archiver("tarfile"), FileCrypto()
+
+
+def make_locker(observer):
+    from locker import Locker
+    archiver, crypto = backend()
+    return Locker(archiver, crypto, observer=observer)
+
+
+def show_progress(widget, thread, tracker, text):
+    # Polls tracker from the Tk thread until thread ends; Tk isn't thread safe,
+    # so the worker never touches the widgets for progress
+    if not thread.is_alive():
+        widget.progress_bar.config(value=0)
+        widget.status_label.config(text="")
+        return
+    if tracker.finalizing:
+        # Everything is read; what was written is being flushed to disk
+        widget.progress_bar.config(value=1.0)
+        widget.status_label.config(text=f"{text} finishing...")
+    else:
+        fraction = tracker.fraction or 0
+        eta = tracker.eta
+        remaining = f", {int(eta) // 60}:{int(eta) % 60:02d} left" if eta is not None else ""
+        widget.progress_bar.config(value=fraction)
+        widget.status_label.config(text=f"{text} {fraction:.0%}{remaining}")
+    widget.after(PROGRESS_INTERVAL, show_progress, widget, thread, tracker, text)
 
 class FolderLockingWidget(tk.Frame):
     def __init__(self, master, **kwargs):
@@ -49,6 +81,9 @@ class FolderLockingWidget(tk.Frame):
         self.lock_button = ttk.Button(self, text="Lock", command=self.lock)
         self.lock_button.pack()
 
+        self.progress_bar = ttk.Progressbar(self, maximum=1.0)
+        self.progress_bar.pack(fill="x")
+
         self.status_label = ttk.Label(self, text="", foreground="green")
         self.status_label.pack()
 
@@ -80,12 +115,15 @@ class FolderLockingWidget(tk.Frame):
     def lock_folder(self, folder, password, out_folder):
         self.lock_button.config(state="disabled")
         self.status_label.config(text="Locking folder...")
-        self.lock_thread = threading.Thread(target=self._lock_folder, args=(folder, password, out_folder), daemon=True)
+        progress = ProgressTracker()
+        self.lock_thread = threading.Thread(target=self._lock_folder, args=(folder, password, out_folder, progress), daemon=True)
         self.lock_thread.start()
+        show_progress(self, self.lock_thread, progress, "Locking folder...")
 
 
-    def _lock_folder(self, folder, password, out_folder):
+    def _lock_folder(self, folder, password, out_folder, progress):
         try:
+            locker = make_locker(progress)
             locked_file = locker.lock_folder(folder, password, out_folder)
             messagebox.showinfo("Success", f"Folder locked to {locked_file}")
         except Exception as e:
@@ -131,6 +169,9 @@ class FolderUnlockingWidget(tk.Frame):
         self.unlock_button = ttk.Button(self, text="Unlock", command=self.unlock)
         self.unlock_button.pack()
 
+        self.progress_bar = ttk.Progressbar(self, maximum=1.0)
+        self.progress_bar.pack(fill="x")
+
         self.status_label = ttk.Label(self, text="", foreground="green")
         self.status_label.pack()
 
@@ -163,14 +204,18 @@ class FolderUnlockingWidget(tk.Frame):
         self.unlock_button.config(state="disabled")
         self.status_label.config(text="Unlocking folder...")
         # Unlock the folder in a new thread
-        self.unlock_thread = threading.Thread(target=self._unlock_folder, args=(file, password, out_folder), daemon=True)
+        progress = ProgressTracker()
+        self.unlock_thread = threading.Thread(target=self._unlock_folder, args=(file, password, out_folder, progress), daemon=True)
         self.unlock_thread.start()
+        show_progress(self, self.unlock_thread, progress, "Unlocking folder...")
 
 
 
-    def _unlock_folder(self, file, password, out_folder):
+    def _unlock_folder(self, file, password, out_folder, progress):
         try:
-            out_folder = out_folder + "/" + file.split("/")[-1].replace(".tar.enc", "")
+            # The locker reads file with whichever archiver its header records
+            locker = make_locker(progress)
+            out_folder = os.path.join(out_folder, locker.folder_name(file, password))
             unlocked_folder = locker.unlock_folder(file, password, out_folder=out_folder)
             messagebox.showinfo("Success", f"Folder unlocked to {unlocked_folder}")
         except ValueError as e:
@@ -181,12 +226,15 @@ class FolderUnlockingWidget(tk.Frame):
             self.unlock_button.config(state="normal")
             self.status_label.config(text="")
 
-class MainApplication(ttkthemes.ThemedTk):
+class MainApplication(tk.Tk):
     # Main application
-    def __init__(self, **kwargs):
+    def __init__(self, theme: str = None, **kwargs):
         super().__init__(**kwargs)
+        if theme:
+            import ttkthemes
+            ttkthemes.ThemedStyle(self).set_theme(theme)
         self.title("Folder Locker")
-        self.geometry("400x200")
+        self.geometry("400x230")
         self.create_widgets()
 
     def create_widgets(self):
@@ -1,12 +1,83 @@
+import io
 import os
-import shutil
-import tarfile
-import zipfile
-import pickle
+import inspect
+import json
+import struct
+import time
+from datetime import datetime
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from contextlib import contextmanager
+from scanner import scan_tree
+from fileio import block_size, open_stream
+from instrument import Observer, observe_scan, span, tree_size
+from compression import (SAMPLE_SIZE, CompressingWriter, check_codec, compressor, decompressor,
+                         open_decompressed, should_compress)
+
+try:
+    import pwd
+    import grp
+except ImportError:
+    pwd = grp = None
+
+# Backend modules (tarfile, zipfile, pickle, shutil) are imported by the
+# archivers using them, so a process only loads the ones it picks
+
+
+# Entry returned by Archiver.list_members; type is "file", "dir", "symlink" or "other"
+Member = namedtuple("Member", "name type size mtime")
+# Largest file parallel extraction buffers and hands to its pool; bigger ones are
+# written by the reading thread, where open/close latency is small next to the data
+PARALLEL_FILE_SIZE = 4 * 1024 * 1024
+# Buffered file contents parallel extraction lets wait for its pool
+PARALLEL_PENDING_BYTES = 64 * 1024 * 1024
+# Archiver classes by name, see register_archiver
+ARCHIVERS = {}
+# Entry point group other packages list their Archiver classes under
+ENTRY_POINT_GROUP = "locker.archivers"
 
 class Archiver:
-    def __init__(self):
-        pass
+    # Name the class is registered under
+    name = None
+    # Suffix appended to the source folder name for archives written by this backend
+    extension = ""
+    # Format of the archives this backend writes, and the formats it can read;
+    # unlocking picks a reader by format, so a faster one can read what another wrote
+    format = None
+    reads = ()
+    # Whether archive_to can write to non-seekable file objects, and unarchive_from
+    # read from them unless random_access
+    streamable = False
+    # Whether reading an archive (unarchive_from, list_members, extract_member)
+    # needs a seekable file object, as for formats indexed at the end
+    random_access = False
+    # Whether unarchive_from can report checkpoints and resume from one
+    resumable = False
+    # Whether archives hold what symlinks to files point to rather than the links
+    # (and skip other symlinks); manifests of the tree are scanned the same way
+    follow_symlinks = False
+    # instrument.Observer told about the walk; Locker sets it on its own copy
+    observer = None
+    # Called with the scan entries, returns the entries to archive; Locker sets
+    # it on its own copy to checkpoint a lock
+    scan_hook = None
+
+    # workers sizes the thread pool that walks the source tree and prefetches files.
+    # codec ("zlib", "bz2", "lzma" or "zstd") and level enable compression; content
+    # that samples as already compressed or high entropy is stored as is.
+    # extract_workers > 1 writes extracted files from a thread pool; preallocate
+    # and fsync are applied to every extracted file (see _FileWriter).
+    def __init__(self, workers: int = 8, codec: str = None, level: int = None, extract_workers: int = 1,
+                 preallocate: bool = False, fsync: bool = False):
+        self.workers = workers
+        if codec:
+            check_codec(codec)
+        self.codec = codec
+        self.level = level
+        self.extract_workers = extract_workers
+        self.preallocate = preallocate
+        self.fsync = fsync
 
     def archive(self, src: str, dst: str=None) -> str:
         pass
@@ -14,146 +85,903 @@ class Archiver:
     def unarchive(self, file: str, folder: str):
         pass
 
-
-
+    def describe(self) -> dict:
+        # Recorded in the header of locked files, see reader_for
+        return {"archiver": self.name, "format": self.format, "codec": self.codec, "extension": self.extension}
+
+    def archive_to(self, src: str, fileobj) -> None:
+        raise NotImplementedError(f"{type(self).__name__} does not support streaming")
+
+    def arcname(self, src: str, path: str) -> str:
+        # Where the file at path (relative to src) ends up relative to the unarchive folder
+        return os.path.join(os.path.basename(src), path)
+
+    @contextmanager
+    def compressing(self, fileobj):
+        # Compression stage for streamed formats, between the archive and its sink
+        if not self.codec:
+            yield fileobj
+            return
+        with CompressingWriter(fileobj, self.codec, self.level) as writer:
+            yield writer
+
+    def scan(self, src: str, follow_symlinks: bool = None):
+        # Shared ingestion stage: ordered ScanEntry objects for src, walked and
+        # prefetched concurrently (see scanner.scan_tree); follow_symlinks
+        # defaults to the class's
+        if follow_symlinks is None:
+            follow_symlinks = self.follow_symlinks
+        entries = scan_tree(src, self.workers, follow_symlinks)
+        if self.scan_hook is not None:
+            entries = self.scan_hook(entries)
+        if self.observer is not None:
+            # Last, so it sees the files as the archiver reads them
+            entries = observe_scan(entries, self.observer)
+        return entries
+
+    def unarchive_from(self, fileobj, folder: str) -> None:
+        raise NotImplementedError(f"{type(self).__name__} does not support streaming")
+
+    def list_members(self, fileobj) -> list:
+        raise NotImplementedError(f"{type(self).__name__} does not support random access")
+
+    def extract_member(self, fileobj, member: str, folder: str) -> str:
+        # Extract member (and everything under it, for a directory) from a seekable
+        # archive stream, returning the extracted path
+        raise NotImplementedError(f"{type(self).__name__} does not support random access")
+
+    def _file_writer(self) -> "_FileWriter":
+        return _FileWriter(self.extract_workers, self.preallocate, self.fsync, self.observer)
+
+    @property
+    def _library_extract(self) -> bool:
+        # Whether extraction can be left to tarfile/zipfile as is
+        return self.extract_workers <= 1 and not self.preallocate and not self.fsync
+
+
+
+def register_archiver(name: str, cls: type = None):
+    # Makes cls available to get_archiver and unlocking as name; without cls,
+    # returns a class decorator. Other packages can register through a
+    # "locker.archivers" entry point naming the class instead.
+    if cls is None:
+        return lambda cls: register_archiver(name, cls)
+    cls.name = name
+    ARCHIVERS[name] = cls
+    return cls
+
+
+@lru_cache(maxsize=None)
+def _owner_names(uid: int, gid: int):
+    uname = gname = ""
+    if pwd:
+        try:
+            uname = pwd.getpwuid(uid)[0]
+        except KeyError:
+            pass
+        try:
+            gname = grp.getgrgid(gid)[0]
+        except KeyError:
+            pass
+    return uname, gname
+
+
+def _sample_entry(entry) -> bytes:
+    if entry.data is not None:
+        return entry.data[:SAMPLE_SIZE]
+    with entry.open() as fp:
+        return fp.read(SAMPLE_SIZE)
+
+
+@register_archiver("tarfile")
 class TarfileArchiver(Archiver):
+    format = "tar"
+    reads = ("tar",)
+    extension = ".tar"
+    streamable = True
+    resumable = True
+
     def archive(self, src: str, dst: str = None) -> str:
         if not dst:
             dst = src + ".tar"
-        with tarfile.open(dst, "x:") as tar:
-            tar.add(src, arcname=os.path.basename(src))
+        with open_stream(dst, "xb") as fp:
+            self.archive_to(src, fp)
 
         return dst
 
     def unarchive(self, file: str, folder: str) -> None:
-        with tarfile.open(file, "r:") as tar:
-            tar.extractall(folder, filter="data")
-
+        with open_stream(file) as fp:
+            self.unarchive_from(fp, folder)
+
+    def archive_to(self, src: str, fileobj) -> None:
+        import tarfile
+        with self.compressing(fileobj) as out, \
+                tarfile.open(fileobj=out, mode="w|", copybufsize=block_size(src)) as tar:
+            self._add_tree(tar, src)
+
+    def _add_tree(self, tar: "tarfile.TarFile", src: str) -> None:
+        # Equivalent to tar.add(src, arcname=basename(src)), fed by the scanner
+        # instead of stat-ing and reading each file serially
+        import tarfile
+        for entry in self.scan(src):
+            arcname = os.path.normpath(self.arcname(src, entry.relpath))
+            if entry.type == "other":
+                info = tar.gettarinfo(entry.path, arcname)
+                # None for sockets, which tar.add skips too
+                if info is not None:
+                    tar.addfile(info)
+                continue
+
+            info = tarfile.TarInfo(arcname)
+            info.mode = entry.stat.st_mode & 0o7777
+            info.uid, info.gid = entry.stat.st_uid, entry.stat.st_gid
+            info.uname, info.gname = _owner_names(info.uid, info.gid)
+            info.mtime = entry.stat.st_mtime
+            if entry.type == "dir":
+                info.type = tarfile.DIRTYPE
+                tar.addfile(info)
+            elif entry.type == "symlink":
+                info.type = tarfile.SYMTYPE
+                info.linkname = os.readlink(entry.path)
+                tar.addfile(info)
+            else:
+                # Later links to a file already archived are stored as hard links, as by tar.add
+                inode = (entry.stat.st_ino, entry.stat.st_dev)
+                if entry.stat.st_nlink > 1 and tar.inodes.get(inode, arcname) != arcname:
+                    info.type = tarfile.LNKTYPE
+                    info.linkname = tar.inodes[inode]
+                    tar.addfile(info)
+                    continue
+                if inode[0]:
+                    tar.inodes[inode] = arcname
+                info.size = len(entry.data) if entry.data is not None else entry.stat.st_size
+                with entry.open() as fp:
+                    tar.addfile(info, fp)
+
+    def unarchive_from(self, fileobj, folder: str, start: int = 0, checkpoint=None) -> None:
+        # checkpoint(offset, sync), if given, is called after each member with the
+        # archive offset of the next one; sync() makes everything extracted so far
+        # durable. Unarchiving with start set to such an offset resumes there
+        # (fileobj must be seekable). Compressed archives report no checkpoints.
+        if start:
+            fileobj.seek(start)
+        import tarfile
+        stream = open_decompressed(fileobj)
+        if stream is not fileobj:
+            checkpoint = None
+        with tarfile.open(fileobj=stream, mode="r|", copybufsize=block_size(folder)) as tar:
+            if self._library_extract and checkpoint is None:
+                tar.extractall(folder, filter="data")
+            else:
+                self._extract_all(tar, folder, start, checkpoint)
+
+    def _extract_all(self, tar: "tarfile.TarFile", folder: str, start: int = 0, checkpoint=None) -> None:
+        # extractall(folder, filter="data") with regular files written by a
+        # _FileWriter. Every member goes through the same data filter first;
+        # everything but small regular files is still extracted by tarfile.
+        # Directories extracted before a resumed start keep their extraction times.
+        import tarfile
+        directories = []
+        # tarfile's own makedirs races with other unlocks into the same folder
+        os.makedirs(folder, exist_ok=True)
+        with self._file_writer() as writer:
+            for info in tar:
+                info = tarfile.data_filter(info, folder)
+                path = os.path.join(folder, info.name)
+                if info.isreg() and info.size <= PARALLEL_FILE_SIZE:
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    writer.write(path, [tar.extractfile(info).read()], info.size,
+                                 lambda path, info=info: (tar.chmod(info, path), tar.utime(info, path)))
+                else:
+                    # A hard link's target, or an earlier copy of this file, may still be pending
+                    writer.wait(None if info.islnk() else path)
+                    if info.isdir():
+                        # Like extractall, directory times and modes are set once they are filled
+                        tar.extract(info, folder, set_attrs=False, filter="data")
+                        directories.append(info)
+                    else:
+                        tar.extract(info, folder, filter="data")
+                        if info.isreg():
+                            writer.track(path)
+                if checkpoint is not None:
+                    checkpoint(start + tar.offset, writer.sync)
+
+        for info in sorted(directories, key=lambda info: info.name, reverse=True):
+            path = os.path.join(folder, info.name)
+            tar.utime(info, path)
+            tar.chmod(info, path)
+
+    def list_members(self, fileobj) -> list:
+        # tar has no index, but on a seekable stream tarfile skips over member data
+        with self._open_members(fileobj) as tar:
+            return [Member(info.name, self._member_type(info), info.size, info.mtime) for info in tar]
+
+    def extract_member(self, fileobj, member: str, folder: str) -> str:
+        prefix = member.rstrip("/") + "/"
+        found = False
+        with self._open_members(fileobj) as tar:
+            for info in tar:
+                if info.name == member or info.name.startswith(prefix):
+                    tar.extract(info, folder, filter="data")
+                    found = True
+        if not found:
+            raise KeyError(member)
+        return os.path.join(folder, member)
+
+    @staticmethod
+    def _open_members(fileobj) -> "tarfile.TarFile":
+        # Compressed archives can only be read front to back
+        import tarfile
+        fileobj = open_decompressed(fileobj)
+        return tarfile.open(fileobj=fileobj, mode="r:" if fileobj.seekable() else "r|")
+
+    @staticmethod
+    def _member_type(info: "tarfile.TarInfo") -> str:
+        if info.isfile():
+            return "file"
+        if info.isdir():
+            return "dir"
+        if info.issym():
+            return "symlink"
+        return "other"
+
+
+@register_archiver("shutil")
 class ShutilArchiver(Archiver):
+    # shutil compresses the whole tarball with no level setting; zstd falls back to gzip
+    FORMATS = {"zlib": "gztar", "bz2": "bztar", "lzma": "xztar", "zstd": "gztar"}
+    EXTENSIONS = {"tar": ".tar", "gztar": ".tar.gz", "bztar": ".tar.bz2", "xztar": ".tar.xz"}
+    reads = ("tar", "gztar", "bztar", "xztar")
+
+    def __init__(self, workers: int = 8, codec: str = None, level: int = None, **options):
+        super().__init__(workers, codec, level, **options)
+        self.format = self.FORMATS[codec] if codec else "tar"
+        self.extension = self.EXTENSIONS[self.format]
+
     def archive(self, src: str, dst: str = None) -> str:
         if not dst:
             # shutil automatically appends the extension
             dst = src
-        shutil.make_archive(dst, "tar", src)
+        import shutil
+        shutil.make_archive(dst, self.format, src)
+        if self.observer is not None:
+            # shutil reads the tree without scanning it
+            self.observer.progress(bytes=tree_size(src))
+
+        return dst + self.extension
 
-        return dst + ".tar"
+    def arcname(self, src: str, path: str) -> str:
+        return path
 
     def unarchive(self, file: str, folder: str) -> None:
+        import shutil
         shutil.unpack_archive(file, folder)
 
 
 
+@register_archiver("zipfile")
 class ZipfileArchiver(Archiver):
+    CHUNK_SIZE = 1024 * 1024
+    format = "zip"
+    reads = ("zip",)
+    extension = ".zip"
+    follow_symlinks = True
+    # zipfile constants; zip has no zstd method before Python 3.14, so it falls back to deflate
+    COMPRESS_TYPES = {"zlib": "ZIP_DEFLATED", "bz2": "ZIP_BZIP2", "lzma": "ZIP_LZMA", "zstd": "ZIP_DEFLATED"}
+
     def archive(self, src: str, dst: str = None) -> str:
+        import zipfile
         if not dst:
             dst = src + ".zip"
         with zipfile.ZipFile(dst, "x", compression=zipfile.ZIP_STORED) as zipf:
-            for root, dirs, files in os.walk(src):
-                for file in files:
-                    zipf.write(os.path.join(root, file), os.path.relpath(os.path.join(root, file), src))
+            for entry in self.scan(src):
+                if entry.type != "file":
+                    continue
+                # Codec is picked per file
+                compress_type = zipfile.ZIP_STORED
+                if self.codec and should_compress(_sample_entry(entry), entry.name):
+                    compress_type = getattr(zipfile, self.COMPRESS_TYPES[self.codec])
+                if entry.data is None:
+                    zipf.write(entry.path, entry.relpath, compress_type, self.level)
+                    continue
+                # zip can't represent timestamps before 1980
+                info = zipfile.ZipInfo(entry.relpath, max(time.localtime(entry.stat.st_mtime)[:6], (1980, 1, 1, 0, 0, 0)))
+                info.external_attr = (entry.stat.st_mode & 0xFFFF) << 16
+                zipf.writestr(info, entry.data, compress_type, self.level)
 
         return dst
 
+    def arcname(self, src: str, path: str) -> str:
+        return path
+
     def unarchive(self, file: str, folder: str) -> None:
+        import zipfile
         with zipfile.ZipFile(file, "r") as zipf:
-            zipf.extractall(folder)
+            if self._library_extract:
+                zipf.extractall(folder)
+                return
+            # Members are read and inflated on the writer's pool; ZipFile allows
+            # concurrent reads
+            with self._file_writer() as writer:
+                for info in zipf.infolist():
+                    path = self._target(folder, info.filename)
+                    if info.is_dir():
+                        os.makedirs(path, exist_ok=True)
+                        continue
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    if info.file_size <= PARALLEL_FILE_SIZE:
+                        writer.write(path, lambda info=info: zipf.read(info), info.file_size)
+                        continue
+                    writer.begin(path, info.file_size)
+                    with zipf.open(info) as fp:
+                        while (chunk := fp.read(self.CHUNK_SIZE)):
+                            writer.feed(chunk)
+
+    @staticmethod
+    def _target(folder: str, name: str) -> str:
+        # Where ZipFile.extract writes name: drive letters, empty, "." and ".."
+        # components are dropped, so nothing lands outside folder
+        name = name.replace("/", os.sep)
+        if os.altsep:
+            name = name.replace(os.altsep, os.sep)
+        parts = [part for part in os.path.splitdrive(name)[1].split(os.sep) if part not in ("", os.curdir, os.pardir)]
+        return os.path.join(folder, *parts)
+
+    def list_members(self, fileobj) -> list:
+        import zipfile
+        with zipfile.ZipFile(fileobj, "r") as zipf:
+            return [
+                Member(info.filename, "dir" if info.is_dir() else "file", info.file_size,
+                       datetime(*info.date_time).timestamp())
+                for info in zipf.infolist()
+            ]
+
+    def extract_member(self, fileobj, member: str, folder: str) -> str:
+        import zipfile
+        with zipfile.ZipFile(fileobj, "r") as zipf:
+            prefix = member.rstrip("/") + "/"
+            names = [name for name in zipf.namelist() if name == member or name.startswith(prefix)]
+            if not names:
+                raise KeyError(member)
+            zipf.extractall(folder, members=names)
+        return os.path.join(folder, member)
             
 
 
+@register_archiver("pickle")
 class PickleArchiver(Archiver):
-    CHUNK_SIZE = 1024
+    # Stream of pickled records, written and read one at a time: a header, then
+    # ("dir", path), ("file", dir, name) followed by ("data", chunk) records, and
+    # ("end",). Archives holding one pickled {dir: {name: content}} dict are
+    # still read.
+    CHUNK_SIZE = 1024 * 1024
+    FORMAT = ("locker-pickle", 2)
+    format = "locker-pickle"
+    reads = ("locker-pickle",)
+    extension = ".archive"
+    streamable = True
+    follow_symlinks = True
 
     def archive(self, src: str, dst: str = None) -> str:
-        structure = {}
-        for dir, subdir, files in os.walk(src):
-            structure[dir] = {}
-
-            for file in files:
-                with open(os.path.join(dir,file), 'rb') as fp:
-                    content_chunks = []
-                    while (chunk := fp.read(self.CHUNK_SIZE)):
-                        content_chunks.append(chunk)
-                    structure[dir][file] = b"".join(content_chunks)
-
         if not dst:
             dst = src + ".archive"
         
-        with open(dst, 'wb') as fp:
-            pickle.dump(structure, fp, pickle.HIGHEST_PROTOCOL)
+        with open_stream(dst, "wb") as fp:
+            self.archive_to(src, fp)
 
         return dst
 
+    def archive_to(self, src: str, fileobj) -> None:
+        import pickle
+        with self.compressing(fileobj) as out:
+            pickler = pickle.Pickler(out, pickle.HIGHEST_PROTOCOL)
+            pickler.dump(self.FORMAT)
+            for record in _records(self.scan(src), self.CHUNK_SIZE):
+                if record[0] == "data":
+                    # Pickled straight from the read buffer without copying it
+                    record = ("data", pickle.PickleBuffer(record[1]))
+                pickler.dump(record)
+                # Drop the memo so earlier records aren't kept alive
+                pickler.clear_memo()
+            pickler.dump(("end",))
 
-    def unarchive(self, file: str, folder: str):
-        os.makedirs(folder)
+    def arcname(self, src: str, path: str) -> str:
+        return os.path.join(src, path)
 
-        with open(file, 'rb') as fp:
-            structure = pickle.load(fp)
-        
 
-        for dir,files in structure.items():
-            os.makedirs(os.path.join(folder, dir), exist_ok=True)
+    def unarchive(self, file: str, folder: str):
+        with open_stream(file) as fp:
+            self.unarchive_from(fp, folder)
+
+    def unarchive_from(self, fileobj, folder: str) -> None:
+        import pickle
+        os.makedirs(folder)
 
-            for file,content in files.items():
-                with open(os.path.join(folder, dir, file), 'wb') as fp:
-                    fp.write(content)
+        unpickler = pickle.Unpickler(open_decompressed(fileobj))
+        header = unpickler.load()
+        if isinstance(header, dict):
+            _write_structure(folder, header)
+            return
+        if header != self.FORMAT:
+            raise ValueError(f"Unsupported pickle archive {header!r}")
+        with self._file_writer() as writer:
+            _write_records(folder, iter(unpickler.load, ("end",)), writer)
 
 import json
 import base64
+@register_archiver("json")
 class JSONArchiver(Archiver):
-    CHUNK_SIZE = 1024
+    # JSON Lines, one record per line: a header, then {"dir": path},
+    # {"file": name, "dir": path} followed by {"data": base64 chunk} lines, and
+    # {"end": true}. Archives holding one {dir: {name: base64}} object are still read.
+    CHUNK_SIZE = 1024 * 1024
+    FORMAT = {"format": "locker-jsonl", "version": 1}
+    format = "locker-jsonl"
+    reads = ("locker-jsonl",)
+    extension = ".json"
+    streamable = True
+    follow_symlinks = True
 
     def archive(self, src: str, dst: str = None) -> str:
-        structure = {}
-        for dir, subdir, files in os.walk(src):
-            structure[dir] = {}
-
-            for file in files:
-                with open(os.path.join(dir, file), 'rb') as fp:
-                    content_chunks = []
-                    while (chunk := fp.read(self.CHUNK_SIZE)):
-                        content_chunks.append(chunk)
-                    content = b"".join(content_chunks)
-                    structure[dir][file] = base64.b64encode(content).decode('utf-8')
-
         if not dst:
             dst = src + ".json"
 
-        with open(dst, 'w') as fp:
-            json.dump(structure, fp)
+        with open_stream(dst, "wb") as fp:
+            self.archive_to(src, fp)
 
         return dst
 
+    def archive_to(self, src: str, fileobj) -> None:
+        with self.compressing(fileobj) as out:
+            out.write(json.dumps(self.FORMAT).encode() + b"\n")
+            for record in _records(self.scan(src), self.CHUNK_SIZE):
+                if record[0] == "dir":
+                    out.write(json.dumps({"dir": record[1]}).encode() + b"\n")
+                elif record[0] == "file":
+                    out.write(json.dumps({"file": record[2], "dir": record[1]}).encode() + b"\n")
+                else:
+                    out.write(b'{"data": "' + base64.b64encode(record[1]) + b'"}\n')
+            out.write(b'{"end": true}\n')
+
+    def arcname(self, src: str, path: str) -> str:
+        return os.path.join(src, path)
+
     def unarchive(self, file: str, folder: str) -> None:
+        with open_stream(file) as fp:
+            self.unarchive_from(fp, folder)
+
+    def unarchive_from(self, fileobj, folder: str) -> None:
         os.makedirs(folder)
 
-        with open(file, 'r') as fp:
-            structure = json.load(fp)
-
-        for dir, files in structure.items():
-            os.makedirs(os.path.join(folder, dir), exist_ok=True)
-
-            for file, content in files.items():
-                content = base64.b64decode(content)
-                with open(os.path.join(folder, dir, file), 'wb') as fp:
-                    fp.write(content)
-
-
-
-def get_archiver(archiver: str) -> Archiver:
-    if archiver == "tarfile":
-        return TarfileArchiver()
-    elif archiver == "shutil":
-        return ShutilArchiver()
-    elif archiver == "zipfile":
-        return ZipfileArchiver()
-    elif archiver == "pickle":
-        return PickleArchiver()
-    elif archiver == "json":
-        return JSONArchiver()
-    else:
-        raise ValueError("Invalid archiver")
-    
+        lines = iter(open_decompressed(fileobj))
+        header = json.loads(next(lines, b"{}"))
+        if header != self.FORMAT:
+            _write_structure(folder, {dir: {file: base64.b64decode(content) for file, content in files.items()}
+                                      for dir, files in header.items()})
+            return
+        with self._file_writer() as writer:
+            _write_records(folder, self._parse(lines), writer)
+
+    @staticmethod
+    def _parse(lines):
+        for line in lines:
+            record = json.loads(line)
+            if "data" in record:
+                yield ("data", base64.b64decode(record["data"]))
+            elif "file" in record:
+                yield ("file", record["dir"], record["file"])
+            elif "dir" in record:
+                yield ("dir", record["dir"])
+            elif record.get("end"):
+                return
+        raise ValueError("Truncated archive")
+
+
+def _records(entries, chunk_size: int):
+    # Flattens scanned entries into ("dir", path), ("file", dir, name) and
+    # ("data", chunk) records. Large files are read with readinto into one
+    # reused buffer, so a yielded chunk is only valid until the next record.
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    dirs = {}
+    for entry in entries:
+        if entry.type == "dir":
+            dirs[entry.relpath] = entry.path
+            yield ("dir", entry.path)
+        elif entry.type == "file":
+            yield ("file", dirs[os.path.dirname(entry.relpath) or "."], entry.name)
+            if entry.data is not None:
+                if entry.data:
+                    yield ("data", entry.data)
+                continue
+            with entry.open() as fp:
+                while (size := fp.readinto(buffer)):
+                    yield ("data", view[:size])
+
+
+def _write_records(folder: str, records, writer: "_FileWriter") -> None:
+    # Writes a record stream (see _records) under folder. Directories are created
+    # as their records arrive, before the files in them.
+    for record in records:
+        if record[0] == "data":
+            writer.feed(record[1])
+        elif record[0] == "dir":
+            os.makedirs(os.path.join(folder, record[1]), exist_ok=True)
+        else:
+            writer.begin(os.path.join(folder, record[1], record[2]))
+
+
+class _FileWriter:
+    # Writes extracted files for the unarchivers. With workers > 1, file contents
+    # are written from a thread pool, so restoring many small files isn't bound
+    # by one thread's open/write/close latency. Callers create directories
+    # themselves, in archive order, so the skeleton exists before anything is
+    # written into it; files bigger than PARALLEL_FILE_SIZE are written by the
+    # calling thread. preallocate reserves each file's size with posix_fallocate
+    # before writing; fsync flushes every written file and its directory in one
+    # batch at close instead of one by one, reported to observer as "finalize".
+    def __init__(self, workers: int = 1, preallocate: bool = False, fsync: bool = False, observer: Observer = None):
+        self._pool = ThreadPoolExecutor(workers) if workers > 1 else None
+        self._preallocate = preallocate and hasattr(os, "posix_fallocate")
+        self._fsync = fsync
+        self._observer = observer or Observer()
+        self._pending = deque()
+        self._pending_bytes = 0
+        self._futures = {}
+        self._written = []
+        # File being streamed with begin/feed
+        self._path = self._size = self._finish = self._fp = None
+        self._chunks = []
+        self._buffered = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, path: str, data, size: int, finish=None) -> None:
+        # Writes a whole file: data is a list of chunks, or a callable returning
+        # the content that runs on the pool. finish(path) is called once it is closed.
+        self._end()
+        self.wait(path)
+        self._written.append(path)
+        if self._pool is None:
+            self._write(path, data, size, finish)
+            return
+        future = self._pool.submit(self._write, path, data, size, finish)
+        self._futures[path] = future
+        self._pending.append((path, future, size))
+        self._pending_bytes += size
+        while self._pending_bytes > PARALLEL_PENDING_BYTES:
+            self._collect()
+
+    def begin(self, path: str, size: int = None, finish=None) -> None:
+        # Starts a file whose content follows in feed() calls; it ends at the
+        # next begin, write or close
+        self._end()
+        self._path, self._size, self._finish = path, size, finish
+        if self._pool is None or (size or 0) > PARALLEL_FILE_SIZE:
+            self._open()
+
+    def feed(self, chunk) -> None:
+        if self._fp is not None:
+            self._fp.write(chunk)
+            return
+        self._chunks.append(chunk)
+        self._buffered += len(chunk)
+        if self._buffered > PARALLEL_FILE_SIZE:
+            self._open()
+
+    def track(self, path: str) -> None:
+        # Includes a file written by someone else in the fsync batch
+        self._written.append(path)
+
+    def wait(self, path: str = None) -> None:
+        # Waits for the pending write of path, or for all of them
+        if path is None:
+            while self._pending:
+                self._collect()
+        elif (future := self._futures.get(path)) is not None:
+            future.result()
+
+    def sync(self) -> None:
+        # Waits for pending writes and flushes every file written since the last
+        # sync, and its directory, to disk. Only valid between files.
+        self.wait()
+        self._sync()
+        self._written = []
+
+    def close(self) -> None:
+        try:
+            self._end()
+            self.wait()
+            if self._fsync:
+                with span(self._observer, "finalize"):
+                    self._sync()
+        finally:
+            if self._pool is not None:
+                self._pool.shutdown()
+
+    def abort(self) -> None:
+        if self._fp is not None:
+            self._fp.close()
+        self._path = self._fp = None
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+
+    def _open(self):
+        self.wait(self._path)
+        self._written.append(self._path)
+        self._fp = self._create(self._path, self._size, stream=True)
+        for chunk in self._chunks:
+            self._fp.write(chunk)
+        self._chunks, self._buffered = [], 0
+
+    def _end(self):
+        path = self._path
+        if path is None:
+            return
+        self._path = None
+        if self._fp is not None:
+            fp, self._fp = self._fp, None
+            self._close(fp)
+            if self._finish:
+                self._finish(path)
+        else:
+            chunks, size = self._chunks, self._buffered
+            self._chunks, self._buffered = [], 0
+            self.write(path, chunks, size, self._finish)
+
+    def _collect(self):
+        path, future, size = self._pending.popleft()
+        self._pending_bytes -= size
+        if self._futures.get(path) is future:
+            del self._futures[path]
+        future.result()
+
+    def _create(self, path: str, size: int, stream: bool = False):
+        # Big files, streamed with begin/feed, drop their pages from the cache as
+        # they are written
+        fp = open_stream(path, "wb") if stream else open(path, "wb")
+        if self._preallocate and size:
+            try:
+                os.posix_fallocate(fp.fileno(), 0, size)
+            except OSError:
+                # Not supported by every file system
+                pass
+        return fp
+
+    def _close(self, fp):
+        try:
+            if self._preallocate:
+                # Drop whatever was reserved but not written
+                fp.truncate()
+            if self._fsync and os.name != "posix":
+                # Without directory fsync there is nothing to batch
+                fp.flush()
+                os.fsync(fp.fileno())
+        finally:
+            fp.close()
+
+    def _write(self, path: str, data, size: int, finish):
+        if callable(data):
+            data = [data()]
+        fp = self._create(path, size)
+        try:
+            for chunk in data:
+                fp.write(chunk)
+        finally:
+            self._close(fp)
+        if finish:
+            finish(path)
+
+    def _sync(self):
+        if os.name != "posix":
+            # There, files are synced as they are closed (with fsync) and
+            # directories can't be opened
+            return
+        files = list(dict.fromkeys(self._written))
+        paths = files + list(dict.fromkeys(os.path.dirname(path) or "." for path in files))
+
+        def sync(path):
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+        if self._pool is not None:
+            list(self._pool.map(sync, paths))
+        else:
+            for path in paths:
+                sync(path)
+
+
+def _write_structure(folder: str, structure: dict) -> None:
+    # Writes the {dir: {name: content}} layout of older pickle and json archives
+    for dir, files in structure.items():
+        os.makedirs(os.path.join(folder, dir), exist_ok=True)
+
+        for file, content in files.items():
+            with open(os.path.join(folder, dir, file), 'wb') as fp:
+                fp.write(content)
+
+
+
+@register_archiver("indexed")
+class IndexedArchiver(Archiver):
+    # Random-access format: file contents back to back, then a JSON index of entry
+    # offsets and sizes, then a fixed-size trailer pointing at the index. Inside the
+    # encrypted container, reading one member only decrypts the records holding the
+    # trailer, the index and that member.
+    MAGIC = b"LARC"
+    TRAILER = struct.Struct(">QQ4s")
+    CHUNK_SIZE = 1024 * 1024
+    format = "larc"
+    reads = ("larc",)
+    extension = ".larc"
+    streamable = True
+    random_access = True
+    follow_symlinks = True
+
+    def archive(self, src: str, dst: str = None) -> str:
+        if not dst:
+            dst = src + self.extension
+        with open_stream(dst, "xb") as fp:
+            self.archive_to(src, fp)
+        return dst
+
+    def unarchive(self, file: str, folder: str) -> None:
+        with open_stream(file) as fp:
+            self.unarchive_from(fp, folder)
+
+    def archive_to(self, src: str, fileobj) -> None:
+        # Only writes sequentially, so fileobj can be an encrypting stream
+        fileobj.write(self.MAGIC)
+        offset = len(self.MAGIC)
+        entries = []
+        for entry in self.scan(src):
+            name = self._posix(os.path.normpath(self.arcname(src, entry.relpath)))
+            mode, mtime = entry.stat.st_mode & 0o7777, entry.stat.st_mtime
+            if entry.type == "dir":
+                entries.append({"name": name, "type": "dir", "mode": mode, "mtime": mtime})
+            elif entry.type == "file":
+                # Entries are compressed one by one, so each stays independently readable
+                codec = self.codec if self.codec and should_compress(_sample_entry(entry), entry.name) else None
+                packer = compressor(codec, self.level) if codec else None
+                size = stored_size = 0
+                with entry.open() as fp:
+                    while (chunk := fp.read(self.CHUNK_SIZE)):
+                        size += len(chunk)
+                        if packer:
+                            chunk = packer.compress(chunk)
+                        fileobj.write(chunk)
+                        stored_size += len(chunk)
+                if packer:
+                    chunk = packer.flush()
+                    fileobj.write(chunk)
+                    stored_size += len(chunk)
+                entries.append({"name": name, "type": "file", "offset": offset, "size": size,
+                                "stored_size": stored_size, "codec": codec, "mode": mode, "mtime": mtime})
+                offset += stored_size
+
+        index = json.dumps({"version": 1, "entries": entries}).encode()
+        fileobj.write(index)
+        fileobj.write(self.TRAILER.pack(offset, len(index), self.MAGIC))
+
+    def unarchive_from(self, fileobj, folder: str) -> None:
+        # Needs a seekable fileobj; a DecryptingReader over a regular file is one
+        self._extract(fileobj, self._read_index(fileobj), folder)
+
+    def list_members(self, fileobj) -> list:
+        return [Member(entry["name"], entry["type"], entry.get("size", 0), entry["mtime"])
+                for entry in self._read_index(fileobj)]
+
+    def extract_member(self, fileobj, member: str, folder: str) -> str:
+        prefix = member.rstrip("/") + "/"
+        entries = [entry for entry in self._read_index(fileobj)
+                   if entry["name"] == member or entry["name"].startswith(prefix)]
+        if not entries:
+            raise KeyError(member)
+        self._extract(fileobj, entries, folder)
+        return os.path.join(folder, member)
+
+    @staticmethod
+    def _posix(name: str) -> str:
+        return name.replace(os.sep, "/")
+
+    def _read_index(self, fileobj) -> list:
+        if not fileobj.seekable():
+            raise ValueError(f"{type(self).__name__} can't read a non-seekable stream")
+        fileobj.seek(-self.TRAILER.size, io.SEEK_END)
+        index_offset, index_size, magic = self.TRAILER.unpack(fileobj.read(self.TRAILER.size))
+        if magic != self.MAGIC:
+            raise ValueError("Not an indexed archive")
+        fileobj.seek(index_offset)
+        index = json.loads(fileobj.read(index_size))
+        if index["version"] != 1:
+            raise ValueError(f"Unsupported index version {index['version']}")
+        return index["entries"]
+
+    def _extract(self, fileobj, entries: list, folder: str) -> None:
+        # Same guarantees as tarfile's "data" filter: nothing is written outside
+        # folder and files lose setuid/setgid and group/other write bits
+        root = os.path.realpath(folder)
+        directories = []
+        with self._file_writer() as writer:
+            for entry in sorted(entries, key=lambda entry: entry.get("offset", 0)):
+                path = os.path.realpath(os.path.join(root, entry["name"]))
+                if os.path.commonpath([root, path]) != root:
+                    raise ValueError(f"Refusing to extract {entry['name']!r} outside {folder}")
+                if entry["type"] == "dir":
+                    os.makedirs(path, exist_ok=True)
+                    directories.append((path, entry))
+                    continue
+
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                fileobj.seek(entry["offset"])
+                remaining = entry.get("stored_size", entry["size"])
+                unpacker = decompressor(entry["codec"]) if entry.get("codec") else None
+                writer.begin(path, entry["size"], lambda path, entry=entry: (
+                    os.chmod(path, entry["mode"] & 0o755 | 0o600), os.utime(path, (entry["mtime"], entry["mtime"]))))
+                while remaining:
+                    chunk = fileobj.read(min(remaining, self.CHUNK_SIZE))
+                    if not chunk:
+                        raise ValueError("Truncated archive")
+                    remaining -= len(chunk)
+                    writer.feed(unpacker.decompress(chunk) if unpacker else chunk)
+
+        for path, entry in reversed(directories):
+            os.utime(path, (entry["mtime"], entry["mtime"]))
+
+
+
+def get_archiver(archiver: str, **options) -> Archiver:
+    _load_entry_points()
+    if archiver not in ARCHIVERS:
+        raise ValueError(f"Invalid archiver {archiver!r}")
+    return _construct(ARCHIVERS[archiver], options)
+
+
+def _construct(cls: type, options: dict) -> Archiver:
+    # Archivers registered by other packages may not take every option the
+    # built-in ones do, so cls only gets the ones its __init__ declares
+    parameters = inspect.signature(cls).parameters.values()
+    if not any(parameter.kind is parameter.VAR_KEYWORD for parameter in parameters):
+        names = {parameter.name for parameter in parameters}
+        options = {name: value for name, value in options.items() if name in names}
+    return cls(**options)
+
+
+def available_archivers() -> list:
+    _load_entry_points()
+    return list(ARCHIVERS)
+
+
+def reader_for(content: dict, **options) -> Archiver:
+    # The fastest registered archiver for an archive described by content (see
+    # Archiver.describe): one that streams, and so needs no temporary archive,
+    # if any reads its format, preferring the archiver that wrote it
+    _load_entry_points()
+    readers = [cls for cls in ARCHIVERS.values() if content.get("format") in cls.reads]
+    if not readers:
+        return get_archiver(content["archiver"], **options)
+    readers.sort(key=lambda cls: (not cls.streamable, cls.name != content["archiver"]))
+    return _construct(readers[0], options)
+
+
+@lru_cache(maxsize=None)
+def _load_entry_points() -> None:
+    # Built-in names can't be taken over
+    from importlib import metadata
+    for entry_point in metadata.entry_points(group=ENTRY_POINT_GROUP):
+        if entry_point.name not in ARCHIVERS:
+            register_archiver(entry_point.name, entry_point.load())
+
 
 
 if __name__ == "__main__":
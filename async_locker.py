@@ -0,0 +1,265 @@
+import io
+import copy
+import queue
+import asyncio
+import inspect
+import threading
+import contextlib
+from crypto import FileCrypto
+from locker import Locker
+
+
+# Chunks in flight between the event loop and a worker thread; bounds memory
+# when one side is slower than the other
+MAX_PENDING = 8
+# How often a blocked worker thread checks whether it was cancelled
+POLL_INTERVAL = 0.1
+
+
+class OperationCancelled(Exception):
+    # Raised in a worker thread once the task awaiting it was cancelled
+    pass
+
+
+class _Checked:
+    # File proxy that stops the worker at its next read or write after cancellation
+    def __init__(self, fileobj, cancelled: threading.Event):
+        self._fileobj = fileobj
+        self._cancelled = cancelled
+
+    def _check(self):
+        if self._cancelled.is_set():
+            raise OperationCancelled()
+
+    def read(self, *args):
+        self._check()
+        return self._fileobj.read(*args)
+
+    def readinto(self, b):
+        self._check()
+        return self._fileobj.readinto(b)
+
+    def write(self, data):
+        self._check()
+        return self._fileobj.write(data)
+
+    def seek(self, *args):
+        self._check()
+        return self._fileobj.seek(*args)
+
+    def __getattr__(self, name):
+        return getattr(self._fileobj, name)
+
+
+class _CancellableCrypto(FileCrypto):
+    # Same settings and key cache as crypto, but every container it opens
+    # checks cancelled between records
+    def __init__(self, crypto: FileCrypto, cancelled: threading.Event):
+        self.__dict__.update(crypto.__dict__)
+        self._cancelled = cancelled
+
+    def open_writer(self, password: bytes, fileobj, resume_at: int = None, metadata: dict = None,
+                    volume: dict = None):
+        return super().open_writer(password, _Checked(fileobj, self._cancelled), resume_at, metadata, volume)
+
+    def open_reader(self, password: bytes, fileobj):
+        return super().open_reader(password, _Checked(fileobj, self._cancelled))
+
+
+class _ChannelWriter(io.RawIOBase):
+    # Sink for a worker thread that hands what is written to it to an asyncio.Queue.
+    # Writes block while max_pending chunks are waiting for the consumer.
+    def __init__(self, loop, chunks: asyncio.Queue, slots: threading.Semaphore, cancelled: threading.Event):
+        super().__init__()
+        self._loop = loop
+        self._chunks = chunks
+        self._slots = slots
+        self._cancelled = cancelled
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        # The encrypting writer reuses its buffers, so take a copy
+        chunk = bytes(data)
+        while not self._slots.acquire(timeout=POLL_INTERVAL):
+            if self._cancelled.is_set():
+                raise OperationCancelled()
+        if self._cancelled.is_set():
+            raise OperationCancelled()
+        self._loop.call_soon_threadsafe(self._chunks.put_nowait, chunk)
+        return len(chunk)
+
+
+class _ChannelReader(io.RawIOBase):
+    # Source for a worker thread fed with chunks from the event loop; None ends it.
+    # Each consumed chunk frees a slot the feeding coroutine waits on.
+    def __init__(self, loop, slots: asyncio.Semaphore, cancelled: threading.Event):
+        super().__init__()
+        self._loop = loop
+        self._slots = slots
+        self._cancelled = cancelled
+        self._chunks = queue.Queue()
+        self._pending = memoryview(b"")
+        self._eof = False
+
+    def readable(self) -> bool:
+        return True
+
+    def feed(self, chunk):
+        self._chunks.put(chunk)
+
+    def readinto(self, b) -> int:
+        while not self._pending:
+            if self._eof:
+                return 0
+            try:
+                chunk = self._chunks.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                chunk = b""
+            if self._cancelled.is_set():
+                raise OperationCancelled()
+            if chunk is None:
+                self._eof = True
+                return 0
+            if chunk:
+                self._loop.call_soon_threadsafe(self._slots.release)
+            self._pending = memoryview(chunk)
+        size = min(len(b), len(self._pending))
+        b[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+
+async def _read_chunks(source, size: int):
+    # Prefer read(n): aiohttp and asyncio stream readers iterate by line
+    if hasattr(source, "read"):
+        while (chunk := await source.read(size)):
+            yield chunk
+    else:
+        async for chunk in source:
+            yield chunk
+
+
+class AsyncLocker:
+    # asyncio front end for a Locker. Archiving, key derivation and encryption run
+    # on executor (the loop's default one when None), so the event loop is never
+    # blocked. Cancelling an awaiting task stops its worker at the next record and
+    # removes a partially written locked file. Streams are bounded to max_pending
+    # chunks in flight, so a slow consumer slows the worker down instead of
+    # buffering the archive in memory.
+    def __init__(self, locker: Locker, executor=None, max_pending: int = MAX_PENDING):
+        self.locker = locker
+        self.executor = executor
+        self.max_pending = max_pending
+
+    async def lock_folder(self, folder: str, password: str, out_folder: str, incremental: bool = False) -> str:
+        return await self._run("lock_folder", folder, password, out_folder, incremental)
+
+    async def unlock_folder(self, file: str, password: str, out_folder: str = ".", resume: bool = False) -> str:
+        return await self._run("unlock_folder", file, password, out_folder, resume)
+
+    async def verify(self, file: str, password: str) -> int:
+        return await self._run("verify", file, password)
+
+    async def list(self, file: str, password: str, pattern: str = None) -> list:
+        return await self._run("list", file, password, pattern)
+
+    async def list_members(self, file: str, password: str) -> list:
+        return await self._run("list_members", file, password)
+
+    async def extract_member(self, file: str, member: str, password: str, out_folder: str = ".") -> str:
+        return await self._run("extract_member", file, member, password, out_folder)
+
+    async def iter_lock(self, folder: str, password: str):
+        # Yields the locked (encrypted archive) bytes of folder as they are produced
+        if not self.locker.archiver.streamable:
+            raise ValueError(f"{type(self.locker.archiver).__name__} does not support streaming")
+        loop = asyncio.get_running_loop()
+        chunks = asyncio.Queue()
+        slots = threading.Semaphore(self.max_pending)
+        cancelled = threading.Event()
+        sink = _ChannelWriter(loop, chunks, slots, cancelled)
+
+        def produce():
+            try:
+                self.locker.lock_to_stream(folder, password, sink)
+            finally:
+                with contextlib.suppress(RuntimeError):
+                    loop.call_soon_threadsafe(chunks.put_nowait, None)
+
+        future = loop.run_in_executor(self.executor, produce)
+        try:
+            while (chunk := await chunks.get()) is not None:
+                slots.release()
+                yield chunk
+            await future
+        finally:
+            if not future.done():
+                cancelled.set()
+                with contextlib.suppress(Exception):
+                    await future
+
+    async def lock_to_writer(self, folder: str, password: str, writer) -> None:
+        # Streams the locked bytes of folder to writer, without a staging file.
+        # writer.write may be a coroutine (aiohttp's StreamResponse) or a plain
+        # method followed by an awaitable drain() (asyncio.StreamWriter).
+        drain = getattr(writer, "drain", None)
+        chunks = self.iter_lock(folder, password)
+        try:
+            async for chunk in chunks:
+                result = writer.write(chunk)
+                if inspect.isawaitable(result):
+                    await result
+                if drain is not None:
+                    await drain()
+        finally:
+            await chunks.aclose()
+
+    async def unlock_from(self, source, password: str, out_folder: str = ".") -> str:
+        # Unlocks a stream produced by iter_lock into out_folder. source is an async
+        # iterable of bytes or has a coroutine read(n), like a request body.
+        loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(self.max_pending)
+        cancelled = threading.Event()
+        channel = _ChannelReader(loop, slots, cancelled)
+        crypto = self.locker.crypto
+
+        def consume():
+            try:
+                self.locker.unlock_from_stream(channel, password, out_folder)
+            finally:
+                # Unblock the feeding coroutine if the worker stopped early
+                for _ in range(self.max_pending):
+                    loop.call_soon_threadsafe(slots.release)
+
+        future = loop.run_in_executor(self.executor, consume)
+        try:
+            async for chunk in _read_chunks(source, crypto.chunk_size):
+                await slots.acquire()
+                if future.done():
+                    break
+                channel.feed(chunk)
+            channel.feed(None)
+            await future
+        finally:
+            if not future.done():
+                cancelled.set()
+                with contextlib.suppress(Exception):
+                    await future
+        return out_folder
+
+    async def _run(self, method: str, *args):
+        # Runs a Locker method on the executor with a crypto that checks for
+        # cancellation, so a cancelled task doesn't leave its worker running
+        cancelled = threading.Event()
+        locker = copy.copy(self.locker)
+        locker.crypto = _CancellableCrypto(self.locker.crypto, cancelled)
+        future = asyncio.get_running_loop().run_in_executor(self.executor, getattr(locker, method), *args)
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            cancelled.set()
+            with contextlib.suppress(Exception):
+                await future
+            raise
@@ -0,0 +1,246 @@
+# Benchmark harness for archivers, crypto modes and end-to-end lock/unlock.
+#
+#   python benchmark.py run --shape small --shape huge -o results.json
+#   python benchmark.py compare baseline.json results.json
+#   python benchmark.py startup --budget 0.1
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+
+# name: (number of files, file size, files per directory)
+SHAPES = {
+    "small": (2000, 4 * 1024, 100),
+    "medium": (200, 256 * 1024, 20),
+    "huge": (4, 64 * 1024 * 1024, 4),
+}
+ARCHIVERS = ["tarfile", "shutil", "zipfile", "pickle", "json", "indexed"]
+CRYPTO_MODES = {"serial": 1, "parallel": None}
+# Metrics compared between runs, and whether bigger is better
+METRICS = {"lock_wall": False, "unlock_wall": False, "lock_cpu": False, "unlock_cpu": False,
+           "lock_throughput": True, "unlock_throughput": True, "peak_rss": False}
+# Front ends whose import time is measured by the startup command, and the
+# modules they must not import before a lock or unlock actually runs
+STARTUP_MODULES = ["cli", "app"]
+STARTUP_BUDGET = 0.1
+HEAVY_MODULES = ["archiver", "crypto", "locker", "tarfile", "zipfile", "pickle", "Cryptodome", "ttkthemes",
+                 "importlib.metadata"]
+
+
+def generate_tree(root: str, shape: str, content: str, scale: float = 1.0) -> int:
+    # Writes a synthetic tree under root and returns its size in bytes.
+    # content is "random" (incompressible) or "compressible" (repetitive text).
+    count, size, per_dir = SHAPES[shape]
+    count = max(1, int(count * scale))
+    total = 0
+    line = b"2024-01-01T00:00:00Z INFO worker-7 request handled status=200 bytes=5120\n"
+    for index in range(count):
+        folder = os.path.join(root, f"dir_{index // per_dir:04d}")
+        os.makedirs(folder, exist_ok=True)
+        if content == "random":
+            data = os.urandom(size)
+        else:
+            data = (line * (size // len(line) + 1))[:size]
+        with open(os.path.join(folder, f"file_{index:06d}.dat"), "wb") as f:
+            f.write(data)
+        total += size
+    return total
+
+
+def _cpu_time() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _peak_rss() -> int:
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def run_case(src: str, source_bytes: int, archiver: str, mode: str, codec: str = None,
+             kdf_iterations: int = 1000000) -> dict:
+    # Locks and unlocks src once, returning timings; meant to run in a fresh process
+    # so peak RSS belongs to this case only
+    from archiver import get_archiver
+    from crypto import FileCrypto
+    from locker import Locker
+
+    crypto = FileCrypto(workers=CRYPTO_MODES[mode], kdf={"name": "pbkdf2", "iterations": kdf_iterations})
+    locker = Locker(get_archiver(archiver, codec=codec), crypto)
+    work = tempfile.mkdtemp(prefix="locker-bench-")
+    try:
+        # pickle and json record paths relative to the working directory
+        cwd = os.getcwd()
+        os.chdir(os.path.dirname(src))
+        try:
+            name = os.path.basename(src)
+            start, cpu = time.perf_counter(), _cpu_time()
+            locked = locker.lock_folder(name, "benchmark", work)
+            lock_wall, lock_cpu = time.perf_counter() - start, _cpu_time() - cpu
+
+            start, cpu = time.perf_counter(), _cpu_time()
+            locker.unlock_folder(locked, "benchmark", os.path.join(work, "out"))
+            unlock_wall, unlock_cpu = time.perf_counter() - start, _cpu_time() - cpu
+        finally:
+            os.chdir(cwd)
+
+        return {
+            "archiver": archiver,
+            "mode": mode,
+            "codec": codec,
+            "source_bytes": source_bytes,
+            "locked_bytes": os.path.getsize(locked),
+            "lock_wall": lock_wall,
+            "lock_cpu": lock_cpu,
+            "lock_throughput": source_bytes / lock_wall,
+            "unlock_wall": unlock_wall,
+            "unlock_cpu": unlock_cpu,
+            "unlock_throughput": source_bytes / unlock_wall,
+            "peak_rss": _peak_rss(),
+        }
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+
+def run(shapes: list, contents: list, archivers: list, modes: list, codecs: list,
+        scale: float = 1.0, kdf_iterations: int = 1000000, log=sys.stderr) -> dict:
+    context = multiprocessing.get_context("fork" if sys.platform == "linux" else "spawn")
+    results = []
+    for shape in shapes:
+        for content in contents:
+            root = tempfile.mkdtemp(prefix="locker-bench-src-")
+            try:
+                src = os.path.join(root, f"{shape}_{content}")
+                source_bytes = generate_tree(src, shape, content, scale)
+                for archiver in archivers:
+                    for mode in modes:
+                        for codec in codecs:
+                            with ProcessPoolExecutor(1, mp_context=context) as pool:
+                                result = pool.submit(run_case, src, source_bytes, archiver, mode, codec,
+                                                     kdf_iterations).result()
+                            result.update(shape=shape, content=content)
+                            results.append(result)
+                            print(f"{_case_key(result)}: lock {result['lock_wall']:.2f}s "
+                                  f"unlock {result['unlock_wall']:.2f}s", file=log)
+            finally:
+                shutil.rmtree(root, ignore_errors=True)
+
+    return {
+        "created": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "results": results,
+    }
+
+
+def measure_startup(module: str, repeat: int = 5) -> dict:
+    # Imports module in repeat fresh interpreters, returning the best wall time
+    # and which of HEAVY_MODULES the import loaded
+    code = (f"import sys, json, time; start = time.perf_counter(); import {module}; "
+            "print(json.dumps([time.perf_counter() - start, sorted(sys.modules)]))")
+    best = None
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+        elapsed, modules = json.loads(output)
+        best = elapsed if best is None else min(best, elapsed)
+    heavy = [name for name in HEAVY_MODULES if any(loaded == name or loaded.startswith(name + ".")
+                                                   for loaded in modules)]
+    return {"module": module, "import_wall": best, "heavy_modules": heavy}
+
+
+def _case_key(result: dict) -> str:
+    return "/".join(str(result[key]) for key in ("shape", "content", "archiver", "mode", "codec"))
+
+
+def compare(baseline: dict, current: dict, threshold: float = 0.1) -> list:
+    # Returns rows of (case, metric, baseline value, current value, relative change,
+    # regressed) for every case present in both runs. A change counts as a
+    # regression when it is worse than threshold (0.1 = 10%).
+    before = {_case_key(result): result for result in baseline["results"]}
+    rows = []
+    for result in current["results"]:
+        key = _case_key(result)
+        if key not in before:
+            continue
+        for metric, higher_is_better in METRICS.items():
+            old, new = before[key][metric], result[metric]
+            change = (new - old) / old if old else 0.0
+            worse = -change if higher_is_better else change
+            rows.append((key, metric, old, new, change, worse > threshold))
+    return rows
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark locker archivers and crypto modes")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="run benchmarks and report JSON")
+    run_parser.add_argument("--shape", action="append", choices=SHAPES, help="tree shape (repeatable)")
+    run_parser.add_argument("--content", action="append", choices=["random", "compressible"])
+    run_parser.add_argument("--archiver", action="append", choices=ARCHIVERS)
+    run_parser.add_argument("--mode", action="append", choices=CRYPTO_MODES)
+    run_parser.add_argument("--codec", action="append", help="compression codec (repeatable, 'none' for off)")
+    run_parser.add_argument("--scale", type=float, default=1.0, help="multiply the number of files per shape")
+    run_parser.add_argument("--kdf-iterations", type=int, default=1000000)
+    run_parser.add_argument("-o", "--output", help="write JSON here instead of stdout")
+
+    compare_parser = commands.add_parser("compare", help="compare two JSON reports")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type=float, default=0.1, help="relative change counted as regression")
+
+    startup_parser = commands.add_parser("startup", help="check the import time of the front ends")
+    startup_parser.add_argument("--module", action="append", help="module to import (repeatable)")
+    startup_parser.add_argument("--budget", type=float, default=STARTUP_BUDGET, help="seconds allowed per import")
+    startup_parser.add_argument("--repeat", type=int, default=5, help="imports per module, the best one counts")
+
+    args = parser.parse_args(argv)
+    if args.command == "startup":
+        failed = False
+        for module in args.module or STARTUP_MODULES:
+            result = measure_startup(module, args.repeat)
+            problems = [f"imports {name}" for name in result["heavy_modules"]]
+            if result["import_wall"] > args.budget:
+                problems.append(f"over the {args.budget:g}s budget")
+            failed = failed or bool(problems)
+            print(f"{module:10} {result['import_wall'] * 1000:8.1f} ms  {'; '.join(problems) or 'ok'}")
+        return 1 if failed else 0
+
+    if args.command == "run":
+        codecs = [None if codec == "none" else codec for codec in (args.codec or ["none"])]
+        report = run(args.shape or ["small", "huge"], args.content or ["random"], args.archiver or ARCHIVERS,
+                     args.mode or list(CRYPTO_MODES), codecs, args.scale, args.kdf_iterations)
+        output = json.dumps(report, indent=2)
+        if args.output:
+            with open(args.output, "w") as f:
+                f.write(output)
+        else:
+            print(output)
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    rows = compare(baseline, current, args.threshold)
+    for key, metric, old, new, change, regressed in rows:
+        flag = "  REGRESSION" if regressed else ""
+        print(f"{key:50} {metric:18} {old:14.4g} {new:14.4g} {change:+8.1%}{flag}")
+    return 1 if any(row[-1] for row in rows) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,163 @@
+import io
+import os
+import json
+import hashlib
+from collections import deque
+from scanner import ScanEntry
+
+
+JOURNAL_VERSION = 1
+# Bytes of archive between two checkpoints of a lock or unlock
+CHECKPOINT_BYTES = 256 * 1024 * 1024
+# Upper bound on what an archiver buffers between taking a scan entry and the
+# entry's last bytes reaching its output (tarfile holds back one 10 KiB record,
+# pickle one 64 KiB frame)
+ARCHIVER_LAG = 1024 * 1024
+_ZEROS = bytes(1024 * 1024)
+
+
+class TreeChanged(Exception):
+    # The folder being locked no longer matches the journal of the lock it resumes
+    pass
+
+
+class Journal:
+    # JSON file recording how far an interrupted operation got. It is only ever
+    # replaced atomically, so it always describes data that was synced first.
+    def __init__(self, path: str):
+        self.path = path
+
+    def load(self, expected: dict) -> dict:
+        # The saved state when it exists and matches every item of expected, else None
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if state.get("version") != JOURNAL_VERSION or any(state.get(k) != v for k, v in expected.items()):
+            return None
+        return state
+
+    def save(self, state: dict) -> None:
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(dict(state, version=JOURNAL_VERSION), f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def remove(self) -> None:
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class _Zeros(io.RawIOBase):
+    # size zero bytes, standing in for file content that won't be kept
+    def __init__(self, size: int):
+        super().__init__()
+        self._remaining = size
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        size = min(len(b), self._remaining, len(_ZEROS))
+        b[:size] = _ZEROS[:size]
+        self._remaining -= size
+        return size
+
+
+class _SkippedEntry(ScanEntry):
+    __slots__ = ()
+
+    def open(self):
+        return io.BufferedReader(_Zeros(self.stat.st_size))
+
+
+class CheckpointedSink(io.RawIOBase):
+    # Sink between an archiver and the EncryptingWriter writer (reached through
+    # fileobj, which may wrap it). Every interval bytes it syncs out_file and
+    # journals how many records it durably holds, with what is needed to make
+    # the archiver regenerate the same bytes: how many scan entries it had taken
+    # and a digest of their metadata. entries() is the archiver's scan hook.
+    #
+    # Resuming from such a state, the sink drops the regenerated bytes the file
+    # already holds and raises TreeChanged if the entries don't match. Entries
+    # whose bytes all lie before the resume point get zeros for content (with
+    # skip_content), so the files aren't read again; that only holds for
+    # uncompressed archives, whose bytes don't depend on earlier content.
+    def __init__(self, fileobj, writer, out_file, journal: Journal, interval: int, info: dict,
+                 state: dict = None, skip_content: bool = True):
+        super().__init__()
+        self._fileobj = fileobj
+        self._writer = writer
+        self._out_file = out_file
+        self._journal = journal
+        self._interval = interval
+        self._info = info
+        self._state = state
+        self._skip_content = skip_content
+        self._skip = state["bytes"] if state else 0
+        self._next_checkpoint = self._skip + (interval or 0)
+        self.received = 0
+        self._count = 0
+        self._digest = hashlib.sha256()
+        # (entries taken, bytes received) when each entry was taken, until a
+        # checkpoint shows all bytes of the entries before it are in the file
+        self._taken = deque()
+        self._complete = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        data = memoryview(data).cast("B")
+        size = data.nbytes
+        start = self.received
+        self.received += size
+        if self.received <= self._skip:
+            return size
+        if start < self._skip:
+            data = data[self._skip - start:]
+        self._fileobj.write(data)
+        if self._interval and self.received >= self._next_checkpoint:
+            self._checkpoint()
+        return size
+
+    def entries(self, entries):
+        skipped = self._state["complete"] if self._state and self._skip_content else 0
+        for entry in entries:
+            self._verify()
+            self._taken.append((self._count, self.received))
+            stat = entry.stat
+            self._digest.update(json.dumps([entry.relpath, entry.type, stat.st_size, stat.st_mtime_ns,
+                                            stat.st_mode]).encode())
+            self._count += 1
+            if self._count <= skipped and entry.type == "file":
+                entry = _SkippedEntry(entry.name, entry.path, entry.relpath, entry.type, stat)
+            yield entry
+        self._verify()
+        if self._state and self._count < self._state["entries"]:
+            raise TreeChanged("Fewer entries than when the lock was interrupted")
+
+    def finish(self) -> None:
+        # Called once the archiver is done
+        if self.received < self._skip:
+            raise TreeChanged("Less data than when the lock was interrupted")
+
+    def _verify(self):
+        if self._state and self._count == self._state["entries"] and \
+                self._digest.hexdigest() != self._state["digest"]:
+            raise TreeChanged("Entries changed since the lock was interrupted")
+
+    def _checkpoint(self):
+        records = self._writer.checkpoint()
+        self._out_file.flush()
+        os.fsync(self._out_file.fileno())
+        committed = records * self._writer.chunk_size
+        # Entry n - 1 was written out once entry n was taken, give or take what the archiver buffers
+        while self._taken and self._taken[0][1] + ARCHIVER_LAG <= committed:
+            self._complete = self._taken.popleft()[0]
+        self._journal.save(dict(self._info, records=records, bytes=committed, entries=self._count,
+                                digest=self._digest.hexdigest(), complete=self._complete))
+        self._next_checkpoint = self.received + self._interval
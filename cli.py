@@ -0,0 +1,186 @@
+# Headless front end for scheduled and scripted use:
+#
+#   python cli.py lock "users/*" -o /backups --jobs 8 --password-env LOCKER_PASSWORD
+#   python cli.py unlock /backups/*.enc -o /restore --password-file secret.txt
+#   python cli.py verify /backups/*.enc --password-file secret.txt
+#   python cli.py lock users/alice -o - --password-env LOCKER_PASSWORD | ssh backup "cat > alice.tar.enc"
+#   ssh backup "cat alice.tar.enc" | python cli.py unlock - -o /restore --password-env LOCKER_PASSWORD
+
+import os
+import sys
+import glob
+import json
+import time
+import getpass
+import argparse
+from compression import available_codecs
+
+
+def read_password(args) -> str:
+    if args.password_env:
+        password = os.environ.get(args.password_env)
+        if password is None:
+            raise SystemExit(f"Environment variable {args.password_env} is not set")
+        return password
+    if args.password_file:
+        with open(args.password_file) as f:
+            return f.readline().rstrip("\r\n")
+    return getpass.getpass()
+
+
+def expand(patterns: list) -> list:
+    # Patterns the shell didn't expand (quoted, or on Windows) are globbed here;
+    # names that match nothing are kept so they are reported as failures
+    paths = []
+    for pattern in patterns:
+        paths.extend(sorted(glob.glob(pattern)) or [pattern])
+    return paths
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Lock and unlock folders")
+    commands = parser.add_subparsers(dest="command", required=True)
+    lock_parser = commands.add_parser("lock", help="lock folders")
+    lock_parser.add_argument("folders", nargs="+", help="folders or glob patterns")
+    lock_parser.add_argument("--archiver", default="tarfile", help="archiver to use (default: tarfile)")
+    lock_parser.add_argument("--codec", choices=available_codecs(), help="compress with this codec")
+    lock_parser.add_argument("--incremental", action="store_true", help="only write what changed since the last lock")
+    lock_parser.add_argument("--volume-size", type=int, metavar="MIB",
+                             help="split locked files into volumes of this many MiB (name.enc.000, .001, ...)")
+    lock_parser.add_argument("--hash-cache", action="store_true",
+                             help="reuse file hashes from earlier runs, kept in ~/.cache/locker")
+    unlock_parser = commands.add_parser("unlock", help="unlock locked files")
+    unlock_parser.add_argument("files", nargs="+", help="locked files or glob patterns, or - for stdin")
+    unlock_parser.add_argument("--archiver", default="tarfile",
+                               help="archiver for files whose header doesn't record one (default: tarfile)")
+    unlock_parser.add_argument("--extract-workers", type=int, default=1, help="threads writing extracted files")
+    unlock_parser.add_argument("--preallocate", action="store_true", help="reserve each file's size before writing")
+    unlock_parser.add_argument("--fsync", action="store_true", help="flush extracted files to disk before finishing")
+    unlock_parser.add_argument("--resume", action="store_true",
+                               help="continue interrupted unlocks into the output folder from their last checkpoint")
+
+    verify_parser = commands.add_parser("verify", help="check passwords and integrity without unlocking")
+    verify_parser.add_argument("files", nargs="+", help="locked files or glob patterns")
+    # Verifying never extracts, so any archiver will do
+    verify_parser.set_defaults(archiver="tarfile")
+
+    for command in (lock_parser, unlock_parser):
+        command.add_argument("-o", "--out-folder", help="output folder (default: next to the input on lock, "
+                                                        "the current folder on unlock); - locks to stdout")
+    for command in (lock_parser, unlock_parser, verify_parser):
+        command.add_argument("-j", "--jobs", type=int, help="items processed at once (default: one per CPU)")
+        command.add_argument("--crypto-workers", type=int, default=1, help="encryption threads per item")
+        command.add_argument("--password-env", metavar="VAR", help="read the password from this environment variable")
+        command.add_argument("--password-file", metavar="FILE", help="read the password from the first line of FILE")
+        command.add_argument("--json", action="store_true", help="print one JSON object per result")
+        command.add_argument("--profile", action="store_true", help="print a stage timing breakdown at the end")
+        command.add_argument("--direct-io", action="store_true", help="read files with O_DIRECT where supported")
+        command.add_argument("--keep-cache", action="store_true",
+                             help="leave streamed files in the page cache instead of dropping them")
+    return parser
+
+
+def check_streams(args) -> None:
+    # - stands for stdin or stdout, which carry exactly one locked stream
+    if args.command == "lock" and args.out_folder == "-":
+        if len(args.folders) != 1:
+            raise SystemExit("Only one folder can be locked to stdout")
+        if args.incremental or args.volume_size:
+            raise SystemExit("Locking to stdout can't be incremental or split")
+    elif args.command == "verify" and "-" in args.files:
+        raise SystemExit("verify reads locked files, not stdin")
+    elif args.command == "unlock" and "-" in args.files and args.files != ["-"]:
+        raise SystemExit("Only one locked stream can be unlocked from stdin")
+    elif args.command == "unlock" and "-" in args.files and args.resume:
+        raise SystemExit("Unlocking from stdin can't be resumed")
+
+
+def run_streamed(task, source: str):
+    # Times task() like a batch item, as a one-result batch
+    from locker import BatchResult
+    start = time.perf_counter()
+    try:
+        output, error = task(), None
+    except Exception as e:
+        output, error = None, e
+    return [BatchResult(source, output, error, time.perf_counter() - start)]
+
+
+def report(result, as_json: bool, out=None) -> None:
+    # out defaults to stdout, unless stdout carries a locked stream
+    if as_json:
+        print(json.dumps({
+            "source": result.source,
+            "output": result.output,
+            "error": str(result.error) if result.error else None,
+            "elapsed": round(result.elapsed, 3),
+        }), file=out or sys.stdout, flush=True)
+    elif result.error:
+        print(f"FAILED {result.source}: {result.error}", file=sys.stderr, flush=True)
+    else:
+        print(f"{result.source} -> {result.output} ({result.elapsed:.2f}s)", file=out or sys.stdout, flush=True)
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    check_streams(args)
+    password = read_password(args)
+    # Imported once the arguments are known to be good, so --help and usage
+    # errors don't wait for the crypto and archiver modules
+    from archiver import get_archiver
+    from crypto import FileCrypto
+    from locker import Locker
+    from instrument import Profiler
+    from hashcache import HashCache
+    import fileio
+    fileio.DIRECT_IO = args.direct_io
+    fileio.DROP_CACHE = not args.keep_cache
+    if args.command == "lock":
+        options = {"codec": args.codec}
+    elif args.command == "unlock":
+        options = {"extract_workers": args.extract_workers, "preallocate": args.preallocate, "fsync": args.fsync}
+    else:
+        options = {}
+    profiler = Profiler() if args.profile else None
+    volume_size = args.volume_size * 1024 * 1024 if args.command == "lock" and args.volume_size else None
+    hash_cache = HashCache() if args.command == "lock" and args.hash_cache else None
+    locker = Locker(get_archiver(args.archiver, **options), FileCrypto(workers=args.crypto_workers),
+                    observer=profiler, volume_size=volume_size, hash_cache=hash_cache)
+
+    out = None
+    if args.command == "lock" and args.out_folder == "-":
+        out = sys.stderr
+
+        def lock_to_stdout():
+            locker.lock_to_stream(args.folders[0], password, sys.stdout.buffer)
+            sys.stdout.buffer.flush()
+            return "-"
+
+        results = run_streamed(lock_to_stdout, args.folders[0])
+    elif args.command == "lock":
+        try:
+            results = locker.lock_many(expand(args.folders), password, args.out_folder, args.jobs, args.incremental)
+        except ValueError as e:
+            # Folders that would lock to the same file
+            raise SystemExit(str(e))
+    elif args.command == "verify":
+        results = locker.verify_many(expand(args.files), password, args.jobs)
+    elif args.files == ["-"]:
+        results = run_streamed(lambda: locker.unlock_from_stream(sys.stdin.buffer, password, args.out_folder or "."),
+                               "-")
+    else:
+        results = locker.unlock_many(expand(args.files), password, args.out_folder or ".", args.jobs, args.resume)
+
+    failed = 0
+    for result in results:
+        report(result, args.json, out)
+        failed += result.error is not None
+    if profiler:
+        profiler.print_report()
+    if hash_cache:
+        hash_cache.close()
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,219 @@
+import io
+import os
+import math
+import zlib
+import struct
+import importlib.util
+from functools import lru_cache
+
+
+# Codec ids used in frame headers; 0 marks a frame stored as is
+CODEC_IDS = {"zlib": 1, "bz2": 2, "lzma": 3, "zstd": 4}
+DEFAULT_LEVELS = {"zlib": 6, "bz2": 9, "lzma": 6, "zstd": 3}
+# Data whose sampled entropy (bits per byte) is above this is not worth compressing
+ENTROPY_THRESHOLD = 7.5
+SAMPLE_SIZE = 64 * 1024
+COMPRESSED_EXTENSIONS = {
+    ".gz", ".tgz", ".bz2", ".xz", ".lzma", ".zst", ".zip", ".7z", ".rar", ".enc",
+    ".jpg", ".jpeg", ".png", ".gif", ".webp", ".mp3", ".mp4", ".mkv", ".mov", ".avi",
+}
+
+# Framed stream: FRAME_MAGIC, then frames of (codec id, payload length, payload).
+# The magic starts with a NUL byte, which no tar, pickle, json or indexed
+# archive does, so readers can tell compressed streams apart.
+FRAME_MAGIC = b"\x00LZF"
+FRAME_HEADER = struct.Struct(">BI")
+FRAME_SIZE = 1024 * 1024
+
+
+# zlib is always there and cheap to import; the other codecs are imported by
+# the first compress or decompress that needs them, not with this module
+@lru_cache(maxsize=None)
+def _has_zstandard() -> bool:
+    return importlib.util.find_spec("zstandard") is not None
+
+
+def _zstandard():
+    if not _has_zstandard():
+        raise ValueError("Codec 'zstd' needs the zstandard package")
+    import zstandard
+    return zstandard
+
+
+def available_codecs() -> list:
+    return [codec for codec in CODEC_IDS if codec != "zstd" or _has_zstandard()]
+
+
+def check_codec(codec: str) -> None:
+    if codec not in CODEC_IDS:
+        raise ValueError(f"Invalid codec {codec!r}")
+    if codec not in available_codecs():
+        raise ValueError(f"Codec {codec!r} needs the zstandard package")
+
+
+def entropy(sample) -> float:
+    # Shannon entropy of sample in bits per byte
+    if not len(sample):
+        return 0.0
+    sample = bytes(sample)
+    total = len(sample)
+    result = 0.0
+    for value in range(256):
+        count = sample.count(value)
+        if count:
+            p = count / total
+            result -= p * math.log2(p)
+    return result
+
+
+def should_compress(sample, name: str = None) -> bool:
+    # Quick check on a sample: skip known compressed formats and random-looking data
+    if name and os.path.splitext(name)[1].lower() in COMPRESSED_EXTENSIONS:
+        return False
+    return entropy(sample[:SAMPLE_SIZE]) < ENTROPY_THRESHOLD
+
+
+def compress(codec: str, data, level: int = None) -> bytes:
+    level = DEFAULT_LEVELS[codec] if level is None else level
+    if codec == "zlib":
+        return zlib.compress(data, level)
+    if codec == "bz2":
+        import bz2
+        return bz2.compress(data, level)
+    if codec == "lzma":
+        import lzma
+        return lzma.compress(data, preset=level)
+    return _zstandard().ZstdCompressor(level=level).compress(data)
+
+
+def decompress(codec: str, data) -> bytes:
+    if codec == "zlib":
+        return zlib.decompress(data)
+    if codec == "bz2":
+        import bz2
+        return bz2.decompress(data)
+    if codec == "lzma":
+        import lzma
+        return lzma.decompress(data)
+    return _zstandard().ZstdDecompressor().decompress(data)
+
+
+def compressor(codec: str, level: int = None):
+    # Incremental compressor with compress(data) and flush()
+    level = DEFAULT_LEVELS[codec] if level is None else level
+    if codec == "zlib":
+        return zlib.compressobj(level)
+    if codec == "bz2":
+        import bz2
+        return bz2.BZ2Compressor(level)
+    if codec == "lzma":
+        import lzma
+        return lzma.LZMACompressor(preset=level)
+    return _zstandard().ZstdCompressor(level=level).compressobj()
+
+
+def decompressor(codec: str):
+    # Incremental decompressor with decompress(data)
+    if codec == "zlib":
+        return zlib.decompressobj()
+    if codec == "bz2":
+        import bz2
+        return bz2.BZ2Decompressor()
+    if codec == "lzma":
+        import lzma
+        return lzma.LZMADecompressor()
+    return _zstandard().ZstdDecompressor().decompressobj()
+
+
+class CompressingWriter(io.RawIOBase):
+    # Compresses what is written to it into fileobj as independent frames. Each
+    # frame is compressed only if a sample of it looks compressible, so already
+    # compressed or random content is passed through without paying for the codec.
+    # close() flushes the last frame but leaves fileobj open.
+    def __init__(self, fileobj, codec: str, level: int = None, frame_size: int = FRAME_SIZE):
+        super().__init__()
+        check_codec(codec)
+        self._fileobj = fileobj
+        self._codec = codec
+        self._level = level
+        self._frame_size = frame_size
+        self._buffer = bytearray()
+        fileobj.write(FRAME_MAGIC)
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        # data may be any buffer (pickle writes PickleBuffer objects straight through)
+        data = memoryview(data)
+        self._buffer += data
+        while len(self._buffer) >= self._frame_size:
+            self._write_frame(self._buffer[:self._frame_size])
+            del self._buffer[:self._frame_size]
+        return data.nbytes
+
+    def _write_frame(self, frame):
+        codec_id = 0
+        if should_compress(frame):
+            compressed = compress(self._codec, frame, self._level)
+            if len(compressed) < len(frame):
+                codec_id, frame = CODEC_IDS[self._codec], compressed
+        self._fileobj.write(FRAME_HEADER.pack(codec_id, len(frame)))
+        self._fileobj.write(frame)
+
+    def close(self):
+        if not self.closed and self._buffer:
+            self._write_frame(self._buffer)
+            self._buffer = bytearray()
+        super().close()
+
+
+class DecompressingReader(io.RawIOBase):
+    # Reads a framed stream written by CompressingWriter; fileobj must be
+    # positioned after FRAME_MAGIC (see open_decompressed)
+    def __init__(self, fileobj):
+        super().__init__()
+        self._fileobj = fileobj
+        self._codecs = {codec_id: codec for codec, codec_id in CODEC_IDS.items()}
+        self._pending = memoryview(b"")
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        while not self._pending:
+            frame = self._read_frame()
+            if frame is None:
+                return 0
+            self._pending = memoryview(frame)
+        size = min(len(b), len(self._pending))
+        b[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+    def _read_frame(self):
+        header = self._fileobj.read(FRAME_HEADER.size)
+        if not header:
+            return None
+        if len(header) != FRAME_HEADER.size:
+            raise ValueError("Truncated compressed frame")
+        codec_id, length = FRAME_HEADER.unpack(header)
+        payload = self._fileobj.read(length)
+        if len(payload) != length:
+            raise ValueError("Truncated compressed frame")
+        if codec_id == 0:
+            return payload
+        if codec_id not in self._codecs:
+            raise ValueError(f"Unknown codec id {codec_id}")
+        return decompress(self._codecs[codec_id], payload)
+
+
+def open_decompressed(fileobj):
+    # Returns a reader for the uncompressed data of fileobj, which must be a
+    # readable stream; FRAME_MAGIC is looked for with peek, without consuming it
+    if not hasattr(fileobj, "peek"):
+        fileobj = io.BufferedReader(fileobj)
+    if fileobj.peek(len(FRAME_MAGIC))[:len(FRAME_MAGIC)] != FRAME_MAGIC:
+        return fileobj
+    fileobj.read(len(FRAME_MAGIC))
+    return io.BufferedReader(DecompressingReader(fileobj), FRAME_SIZE)
@@ -1,11 +1,603 @@
 # crypto module using pycryptodomex
 
+import io
 import os
+import json
+import hmac
+import mmap
+import struct
+import time
 import hashlib
+import threading
+from collections import deque, OrderedDict
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor
 from Cryptodome.Cipher import AES
-from Cryptodome.Protocol.KDF import PBKDF2
+from Cryptodome.Hash import SHA1, SHA256
+from Cryptodome.Protocol.KDF import PBKDF2, HKDF, scrypt
 from Cryptodome.Util.Padding import pad, unpad
 from Cryptodome.Random import get_random_bytes
+from fileio import StreamFile, block_size, open_stream
+
+
+# Chunked container: MAGIC + version + header length + JSON header, followed by
+# fixed-size AES-GCM records (ciphertext + tag). The last record is sealed with a
+# final flag in its nonce so truncation at a record boundary is detected.
+MAGIC = b"LOCKER"
+FORMAT_VERSION = 1
+CHUNK_SIZE = 1024 * 1024
+TAG_SIZE = 16
+LEGACY_CHUNK_SIZE = 64 * 1024
+
+# Key derivation parameters are recorded in the header, so they can be tuned per
+# file. Containers without a "kdf" entry and legacy files use LEGACY_KDF. The
+# header may also hold a "sealed_content" entry, the description of the
+# plaintext (for locked folders, the archiver that wrote it, see
+# Archiver.describe) encrypted under the file key, and a "volume" entry when the
+# container is one volume of a split file (see volumes.py). Older containers
+# have the description in plaintext, as "content".
+LEGACY_KDF = {"name": "pbkdf2", "iterations": 1000000}
+DEFAULT_KDF = LEGACY_KDF
+SCRYPT_KDF = {"name": "scrypt", "n": 2 ** 17, "r": 8, "p": 1}
+PBKDF2_HASHES = {"sha1": SHA1, "sha256": SHA256}
+# Bounds on the parameters read from a header, which is only authenticated
+# after the KDF has run: a tampered header could otherwise make opening a file
+# hang, or take all memory. scrypt uses 128 * n * r bytes and n * r * p blocks of work.
+MAX_PBKDF2_ITERATIONS = 10 ** 7
+MAX_SCRYPT_N = 2 ** 20
+MAX_SCRYPT_MEMORY = 1024 ** 3
+MAX_SCRYPT_WORK = 2 ** 24
+
+
+def check_kdf(kdf: dict) -> None:
+    # Raises ValueError unless kdf is a supported KDF with parameters within bounds
+    def number(name: str, maximum: int) -> int:
+        value = kdf.get(name)
+        if type(value) is not int or not 1 <= value <= maximum:
+            raise ValueError(f"Invalid {kdf['name']} parameter {name}={value!r}")
+        return value
+
+    if not isinstance(kdf, dict) or kdf.get("name") not in ("pbkdf2", "scrypt"):
+        raise ValueError(f"Unsupported KDF {kdf.get('name') if isinstance(kdf, dict) else kdf!r}")
+    if kdf["name"] == "pbkdf2":
+        number("iterations", MAX_PBKDF2_ITERATIONS)
+        if kdf.get("hash", "sha1") not in PBKDF2_HASHES:
+            raise ValueError(f"Unsupported PBKDF2 hash {kdf['hash']!r}")
+        return
+    n, r, p = number("n", MAX_SCRYPT_N), number("r", MAX_SCRYPT_WORK), number("p", MAX_SCRYPT_WORK)
+    if n < 2 or n & (n - 1):
+        raise ValueError(f"Invalid scrypt parameter n={n!r}, must be a power of two")
+    if 128 * n * r > MAX_SCRYPT_MEMORY or n * r * p > MAX_SCRYPT_WORK:
+        raise ValueError(f"scrypt parameters n={n}, r={r}, p={p} exceed the limits")
+
+
+def derive_key(password: bytes, salt: bytes, kdf: dict) -> bytes:
+    check_kdf(kdf)
+    if kdf["name"] == "pbkdf2":
+        hash_module = PBKDF2_HASHES[kdf.get("hash", "sha1")]
+        return PBKDF2(password, salt, 32, kdf["iterations"], hmac_hash_module=hash_module)
+    return scrypt(password, salt, 32, kdf["n"], kdf["r"], kdf["p"])
+
+
+class KeyCache:
+    # Bounded in-memory cache of derived keys keyed by (password, salt, params),
+    # so repeated opens of the same file or files sharing a session salt only
+    # pay for the KDF once. Entries expire after ttl seconds; the least recently
+    # used entry is evicted when the cache is full. Threads asking for the same
+    # key at once wait for a single derivation instead of each running the KDF.
+    def __init__(self, max_size: int = 64, ttl: float = 300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._inflight = {}
+
+    def _lookup(self, cache_key):
+        # Must be called with self._lock held
+        entry = self._entries.get(cache_key)
+        if entry and entry[0] > time.monotonic():
+            self._entries.move_to_end(cache_key)
+            return entry[1]
+        return None
+
+    def derive(self, password: bytes, salt: bytes, kdf: dict) -> bytes:
+        # The password itself is never stored, only its digest
+        cache_key = (hashlib.sha256(password).digest(), salt, json.dumps(kdf, sort_keys=True))
+        with self._lock:
+            key = self._lookup(cache_key)
+            if key is not None:
+                return key
+            inflight = self._inflight.setdefault(cache_key, threading.Lock())
+
+        with inflight:
+            with self._lock:
+                key = self._lookup(cache_key)
+            if key is not None:
+                return key
+            try:
+                key = derive_key(password, salt, kdf)
+                with self._lock:
+                    now = time.monotonic()
+                    self._entries[cache_key] = (now + self.ttl, key)
+                    self._entries.move_to_end(cache_key)
+                    for stale in [k for k, (expires, _) in self._entries.items() if expires <= now]:
+                        del self._entries[stale]
+                    while len(self._entries) > self.max_size:
+                        self._entries.popitem(last=False)
+            finally:
+                with self._lock:
+                    self._inflight.pop(cache_key, None)
+        return key
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class InvalidPassword(ValueError):
+    # The password doesn't match the key check value in a container header
+    pass
+
+
+class ResumeMismatch(ValueError):
+    # A resumed EncryptingWriter produced a record that differs from the one the
+    # interrupted run left in the file at the same index; sealing it would reuse
+    # that record's nonce for other plaintext
+    pass
+
+
+def _file_key(master_key: bytes, subkey_salt: bytes) -> bytes:
+    # Per-file key, so files sharing a KDF salt never share record nonces
+    return HKDF(master_key, 32, subkey_salt, SHA256, context=b"locker-file")
+
+
+def _key_check(key: bytes) -> str:
+    # Key check value stored in the header: a wrong password is rejected right
+    # after the KDF instead of by the first record's tag
+    return hmac.new(key, b"locker-key-check", hashlib.sha256).hexdigest()[:32]
+
+
+def _read_exact(fileobj, size: int) -> bytes:
+    data = fileobj.read(size)
+    if not data or len(data) == size:
+        return data
+    parts = [data]
+    remaining = size - len(data)
+    while remaining and (chunk := fileobj.read(remaining)):
+        parts.append(chunk)
+        remaining -= len(chunk)
+    return b"".join(parts)
+
+
+@contextmanager
+def _mapped(file):
+    # Yields a read-only view of file's pages, or None when it can't be mapped
+    # (empty files, pipes and other special files) or is read with direct I/O
+    if getattr(getattr(file, "raw", file), "direct", False):
+        yield None
+        return
+    try:
+        mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, OSError, io.UnsupportedOperation):
+        mapping = None
+    if mapping is None:
+        yield None
+        return
+    if hasattr(mapping, "madvise"):
+        mapping.madvise(mmap.MADV_SEQUENTIAL)
+    try:
+        with memoryview(mapping) as view:
+            yield view
+    finally:
+        try:
+            mapping.close()
+        except BufferError:
+            # A traceback still holds a view; the mapping goes away with it
+            pass
+
+
+def _read_header(fileobj, prefix: bytes):
+    # Returns (header bytes, parsed header) of a container whose first bytes,
+    # already read from fileobj, are prefix
+    fixed = len(MAGIC) + 5
+    if len(prefix) < fixed:
+        raise ValueError("Truncated header")
+    version = prefix[len(MAGIC)]
+    if version != FORMAT_VERSION:
+        raise ValueError(f"Unsupported format version {version}")
+    (length,) = struct.unpack(">I", prefix[len(MAGIC) + 1:fixed])
+    raw = prefix[fixed:] + _read_exact(fileobj, length - (len(prefix) - fixed))
+    if len(raw) != length:
+        raise ValueError("Truncated header")
+    return prefix[:fixed] + raw, json.loads(raw)
+
+
+def _record_nonce(prefix: bytes, index: int, final: bool) -> bytes:
+    return prefix + struct.pack(">IB", index, final)
+
+
+# Records only use 0 and 1 as the last nonce byte, which leaves 2 for the content
+CONTENT_NONCE = struct.pack(">IB", 0, 2)
+
+
+def _seal_content(key: bytes, prefix: bytes, content: dict) -> str:
+    return bytes(_seal_record(key, b"", prefix + CONTENT_NONCE, json.dumps(content).encode())).hex()
+
+
+def _open_content(key: bytes, prefix: bytes, sealed: str) -> dict:
+    return json.loads(bytes(_open_record(key, b"", prefix + CONTENT_NONCE, bytes.fromhex(sealed))))
+
+
+def _readinto_exact(fileobj, buffer) -> int:
+    # Fills buffer from fileobj unless it ends first; returns the number of bytes read
+    view = memoryview(buffer)
+    filled = 0
+    while filled < len(view) and (size := fileobj.readinto(view[filled:])):
+        filled += size
+    return filled
+
+
+def _seal_record(key: bytes, header: bytes, nonce: bytes, chunk, out=None) -> memoryview:
+    # Encrypts chunk straight into out (allocated when not given, otherwise at
+    # least len(chunk) + TAG_SIZE bytes) and returns a view of the record
+    size = len(chunk)
+    record = memoryview(out if out is not None else bytearray(size + TAG_SIZE))[:size + TAG_SIZE]
+    cipher = AES.new(key, AES.MODE_GCM, nonce=nonce)
+    cipher.update(header)
+    cipher.encrypt(chunk, output=record[:size])
+    record[size:] = cipher.digest()
+    return record
+
+
+def _open_record(key: bytes, header: bytes, nonce: bytes, record, out=None) -> memoryview:
+    # Decrypts record into out (allocated when not given) and returns a view of
+    # the plaintext; raises ValueError, leaving out undefined, if the tag fails
+    record = memoryview(record)
+    size = len(record) - TAG_SIZE
+    plaintext = memoryview(out if out is not None else bytearray(size))[:size]
+    cipher = AES.new(key, AES.MODE_GCM, nonce=nonce)
+    cipher.update(header)
+    cipher.decrypt(record[:size], output=plaintext)
+    cipher.verify(record[size:])
+    return plaintext
+
+
+def _pool(workers: int):
+    # Records are sealed independently, so they can be processed on a thread pool;
+    # pycryptodome releases the GIL while it runs AES. Returns (executor, window).
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 1:
+        return None, 0
+    return ThreadPoolExecutor(workers), 2 * workers
+
+
+class EncryptingWriter(io.RawIOBase):
+    # File-like sink that encrypts everything written to it into fileobj.
+    # The final record is only written by close(); leaving the context with an
+    # exception aborts the stream instead of sealing a truncated payload.
+    # resume_at continues an unfinished container already in fileobj (which must
+    # be readable and seekable) after its first resume_at records, as reported by
+    # checkpoint(); what was written after them is truncated away on close. The
+    # records after them are sealed under the same key and nonces as the ones
+    # the interrupted run may have written there, so each must match what the
+    # file holds, or writing raises ResumeMismatch before anything is overwritten.
+    def __init__(self, password: bytes, fileobj, chunk_size: int = CHUNK_SIZE, workers: int = 1,
+                 kdf: dict = None, salt: bytes = None, key_cache: KeyCache = None, resume_at: int = None,
+                 metadata: dict = None, volume: dict = None):
+        self._aborted = False
+        self._executor = None
+        super().__init__()
+        if resume_at is not None:
+            fileobj.seek(0)
+            self._header, header = _read_header(fileobj, _read_exact(fileobj, 16))
+            chunk_size, kdf = header["chunk_size"], header["kdf"]
+            salt, subkey_salt = bytes.fromhex(header["salt"]), bytes.fromhex(header["subkey_salt"])
+            self._nonce = bytes.fromhex(header["nonce"])
+        else:
+            kdf = kdf or DEFAULT_KDF
+            salt = salt or get_random_bytes(16)
+            subkey_salt = get_random_bytes(16)
+            self._nonce = get_random_bytes(7)
+        master_key = key_cache.derive(password, salt, kdf) if key_cache is not None else derive_key(password, salt, kdf)
+        self._key = _file_key(master_key, subkey_salt)
+        self._chunk_size = chunk_size
+        if resume_at is not None:
+            if not hmac.compare_digest(_key_check(self._key), header.get("check", "")):
+                raise InvalidPassword("Wrong password")
+            self._stale_end = fileobj.seek(0, io.SEEK_END)
+            fileobj.seek(len(self._header) + resume_at * (chunk_size + TAG_SIZE))
+        else:
+            self._stale_end = 0
+            header = {
+                "cipher": "aes-256-gcm",
+                "chunk_size": chunk_size,
+                "kdf": kdf,
+                "salt": salt.hex(),
+                "subkey_salt": subkey_salt.hex(),
+                "nonce": self._nonce.hex(),
+                "check": _key_check(self._key),
+            }
+            if metadata:
+                header["sealed_content"] = _seal_content(self._key, self._nonce, metadata)
+            if volume:
+                header["volume"] = volume
+            header = json.dumps(header).encode()
+            self._header = MAGIC + bytes([FORMAT_VERSION]) + struct.pack(">I", len(header)) + header
+        self._fileobj = fileobj
+        self._buffer = bytearray()
+        self._index = resume_at or 0
+        self._executor, self._window = _pool(workers)
+        self._pending = deque()
+        # The serial engine seals every record into this one buffer
+        self._record = bytearray(chunk_size + TAG_SIZE) if self._executor is None else None
+        if resume_at is None:
+            fileobj.write(self._header)
+
+    @property
+    def chunk_size(self) -> int:
+        return self._chunk_size
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        # data may be any buffer (pickle writes PickleBuffer objects straight through).
+        # Whole records are sealed straight from data; only the partial record at
+        # either end goes through the internal buffer.
+        data = memoryview(data).cast("B")
+        size = data.nbytes
+        if self._buffer:
+            fill = self._chunk_size - len(self._buffer)
+            self._buffer += data[:fill]
+            data = data[fill:]
+            if not data:
+                return size
+            self._seal(self._buffer, final=False)
+            self._buffer = bytearray()
+        # Always keep at least one byte back so close() knows which record is final
+        while len(data) > self._chunk_size:
+            self._seal(data[:self._chunk_size], final=False)
+            data = data[self._chunk_size:]
+        self._buffer += data
+        return size
+
+    def _seal(self, chunk, final: bool):
+        nonce = _record_nonce(self._nonce, self._index, final)
+        self._index += 1
+        if self._executor is None:
+            self._put(_seal_record(self._key, self._header, nonce, chunk, self._record))
+            return
+
+        # Keep a bounded window of records in flight and write them back in order.
+        # chunk may be a view of the caller's buffer, which can change once write returns.
+        self._pending.append(self._executor.submit(_seal_record, self._key, self._header, nonce, bytes(chunk)))
+        while len(self._pending) > self._window:
+            self._put(self._pending.popleft().result())
+
+    def _put(self, record) -> None:
+        position = self._fileobj.tell() if self._stale_end else 0
+        if position < self._stale_end:
+            existing = self._fileobj.read(min(len(record), self._stale_end - position))
+            if record[:len(existing)] != existing:
+                raise ResumeMismatch(f"Record at offset {position} differs from the interrupted run's")
+            self._fileobj.seek(position)
+        self._fileobj.write(record)
+
+    def checkpoint(self) -> int:
+        # Writes out every sealed record and returns how many fileobj now holds;
+        # they cover the first chunk_size * that many bytes written. Flushing and
+        # syncing fileobj is up to the caller.
+        while self._pending:
+            self._put(self._pending.popleft().result())
+        return self._index
+
+    def abort(self):
+        self._aborted = True
+        self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if not self._aborted:
+                self._seal(self._buffer, final=True)
+                while self._pending:
+                    self._put(self._pending.popleft().result())
+                if self._stale_end:
+                    self._fileobj.truncate()
+            self._buffer = bytearray()
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown(cancel_futures=True)
+            super().close()
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self._aborted = True
+        return super().__exit__(exc_type, exc, tb)
+
+    def __del__(self):
+        self._aborted = True
+        super().__del__()
+
+
+class DecryptingReader(io.RawIOBase):
+    # File-like source yielding the plaintext of fileobj. Reads both the chunked
+    # container and the legacy `salt + iv + ciphertext` CBC layout. Containers on
+    # a seekable fileobj are seekable too: records have a fixed size, so any
+    # plaintext offset maps to one record that can be decrypted on its own.
+    def __init__(self, password: bytes, fileobj, workers: int = 1, key_cache: KeyCache = None):
+        self._executor = None
+        super().__init__()
+        self._fileobj = fileobj
+        self._key_cache = key_cache
+        self._executor, self._window = _pool(workers)
+        self._pending = memoryview(b"")
+        self._position = 0
+        self._size = None
+        # Parsed container header, None for legacy files
+        self.header = None
+        prefix = _read_exact(fileobj, 16)
+        if prefix[:len(MAGIC)] == MAGIC:
+            self._open_container(password, prefix)
+            self._chunks = self._container_chunks(0)
+        else:
+            self._seekable = False
+            self._chunks = self._legacy_chunks(password, prefix)
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return self._seekable
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if not self._seekable:
+            raise io.UnsupportedOperation("seek")
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self.size()
+        if offset < 0:
+            raise ValueError("negative seek position")
+        if offset == self._position:
+            return offset
+
+        index, skip = divmod(offset, self._chunk_size)
+        self._fileobj.seek(self._data_offset + index * (self._chunk_size + TAG_SIZE))
+        self._chunks = self._container_chunks(index)
+        self._pending = memoryview(b"")
+        chunk = next(self._chunks, None)
+        if chunk is not None:
+            self._pending = memoryview(chunk)[skip:]
+        self._position = offset
+        return offset
+
+    def size(self) -> int:
+        # Plaintext size, computed from the container size
+        if self._size is None:
+            if not self._seekable:
+                raise io.UnsupportedOperation("size")
+            current = self._fileobj.tell()
+            body = self._fileobj.seek(0, io.SEEK_END) - self._data_offset
+            self._fileobj.seek(current)
+            records = -(-body // (self._chunk_size + TAG_SIZE))
+            self._size = body - records * TAG_SIZE
+        return self._size
+
+    def readinto(self, b) -> int:
+        while not self._pending:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return 0
+            self._pending = memoryview(chunk)
+        size = min(len(b), len(self._pending))
+        b[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        self._position += size
+        return size
+
+    def verify(self) -> int:
+        # Authenticates every remaining record without handing out plaintext and
+        # returns how many plaintext bytes that covered. Raises ValueError at the
+        # first record that fails. Legacy files have no tags; only their padding is checked.
+        size = len(self._pending)
+        self._pending = memoryview(b"")
+        for chunk in self._chunks:
+            size += len(chunk)
+        self._position += size
+        return size
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+        super().close()
+
+    def _derive(self, password: bytes, salt: bytes, kdf: dict) -> bytes:
+        if self._key_cache is not None:
+            return self._key_cache.derive(password, salt, kdf)
+        return derive_key(password, salt, kdf)
+
+    def _open_container(self, password: bytes, prefix: bytes):
+        self._header_bytes, header = _read_header(self._fileobj, prefix)
+        self.header = header
+        salt = bytes.fromhex(header["salt"])
+        if "kdf" in header:
+            self._key = _file_key(self._derive(password, salt, header["kdf"]), bytes.fromhex(header["subkey_salt"]))
+        else:
+            self._key = self._derive(password, salt, LEGACY_KDF)
+        # Older containers have no check value and fail on the first record instead
+        if "check" in header and not hmac.compare_digest(_key_check(self._key), header["check"]):
+            raise InvalidPassword("Wrong password")
+        self._nonce = bytes.fromhex(header["nonce"])
+        if "sealed_content" in header:
+            header["content"] = _open_content(self._key, self._nonce, header["sealed_content"])
+        self._chunk_size = header["chunk_size"]
+        self._seekable = getattr(self._fileobj, "seekable", lambda: False)()
+        self._data_offset = self._fileobj.tell() if self._seekable else len(self._header_bytes)
+
+    def _records(self, index: int, reuse: bool = False):
+        # Yields (record nonce, record) pairs from index on, looking one record
+        # ahead to find the final one. With reuse, records are read into two
+        # alternating buffers, so each one must be consumed before the next is requested.
+        record_size = self._chunk_size + TAG_SIZE
+        buffers = [bytearray(record_size), bytearray(record_size)] if reuse else None
+
+        def read(turn):
+            buffer = buffers[turn] if reuse else bytearray(record_size)
+            return memoryview(buffer)[:_readinto_exact(self._fileobj, buffer)]
+
+        record, turn = read(0), 1
+        if not record and index > 0:
+            return
+        while True:
+            if len(record) < TAG_SIZE:
+                raise ValueError("Truncated ciphertext")
+            next_record = read(turn) if len(record) == record_size else b""
+            turn ^= 1
+            final = not next_record
+            yield _record_nonce(self._nonce, index, final), record
+            if final:
+                return
+            record = next_record
+            index += 1
+
+    def _container_chunks(self, index: int):
+        if self._executor is None:
+            # Records and plaintext each live in preallocated buffers, and the
+            # plaintext is only overwritten once readinto has consumed it
+            plaintext = bytearray(self._chunk_size)
+            for nonce, record in self._records(index, reuse=True):
+                yield _open_record(self._key, self._header_bytes, nonce, record, plaintext)
+            return
+
+        pending = deque()
+        for nonce, record in self._records(index):
+            pending.append(self._executor.submit(_open_record, self._key, self._header_bytes, nonce, record))
+            if len(pending) >= self._window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    def _legacy_chunks(self, password: bytes, salt: bytes):
+        iv = _read_exact(self._fileobj, AES.block_size)
+        key = self._derive(password, salt, LEGACY_KDF)
+        cipher = AES.new(key, AES.MODE_CBC, iv)
+        pending = _read_exact(self._fileobj, LEGACY_CHUNK_SIZE)
+        while True:
+            next_chunk = _read_exact(self._fileobj, LEGACY_CHUNK_SIZE)
+            if not next_chunk:
+                yield unpad(cipher.decrypt(pending), AES.block_size)
+                return
+            yield cipher.decrypt(pending)
+            pending = next_chunk
 
 
 class Crypto:
@@ -20,8 +612,10 @@ class Crypto:
 
     @staticmethod
     def decrypt(password: bytes, data: bytes) -> bytes:
-        salt = data[:16]
-        iv = data[16:16+AES.block_size]
+        # Slice through a view so the ciphertext isn't copied
+        data = memoryview(data)
+        salt = bytes(data[:16])
+        iv = bytes(data[16:16+AES.block_size])
         ciphertext = data[16+AES.block_size:]
         key = PBKDF2(password, salt, 32, 1000000)
         cipher = AES.new(key, AES.MODE_CBC, iv)
@@ -34,21 +628,79 @@ class Crypto:
 
         return sha256.hexdigest()
 
+    @staticmethod
+    def keyed_hash(key: bytes, data) -> str:
+        # HMAC of data with the hash above, for content addresses that don't
+        # reveal the plain hash of what they address
+        return hmac.new(key, data, hashlib.sha256).hexdigest()
+
+    @staticmethod
+    def encrypt_stream(password: bytes, in_stream, out_stream, chunk_size: int = CHUNK_SIZE) -> None:
+        with EncryptingWriter(password, out_stream, chunk_size) as writer:
+            while (chunk := in_stream.read(chunk_size)):
+                writer.write(chunk)
+
+    @staticmethod
+    def decrypt_stream(password: bytes, in_stream, out_stream, chunk_size: int = CHUNK_SIZE) -> None:
+        with DecryptingReader(password, in_stream) as reader:
+            while (chunk := reader.read(chunk_size)):
+                out_stream.write(chunk)
+
 
 
 class FileCrypto(Crypto):
-    def encrypt_file(self, password: bytes, in_filename: str, out_folder: str=None) -> str:
+    # workers > 1 selects the parallel engine, which seals and opens records on a
+    # thread pool of that size; None uses one worker per CPU.
+    # kdf selects the key derivation parameters for new files (see DEFAULT_KDF).
+    # Setting session_salt reuses one KDF salt for every file written by this
+    # instance, so a batch runs the KDF once and derives per-file subkeys from it.
+    def __init__(self, chunk_size: int = CHUNK_SIZE, workers: int = 1, kdf: dict = None,
+                 key_cache: KeyCache = None, session_salt: bytes = None):
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.kdf = kdf or DEFAULT_KDF
+        self.key_cache = key_cache if key_cache is not None else KeyCache()
+        self.session_salt = session_salt
+
+    def new_session(self) -> bytes:
+        self.session_salt = get_random_bytes(16)
+        return self.session_salt
+
+    def open_writer(self, password: bytes, fileobj, resume_at: int = None, metadata: dict = None,
+                    volume: dict = None) -> EncryptingWriter:
+        return EncryptingWriter(password, fileobj, self.chunk_size, self.workers, kdf=self.kdf,
+                                salt=self.session_salt, key_cache=self.key_cache, resume_at=resume_at,
+                                metadata=metadata, volume=volume)
+
+    def open_reader(self, password: bytes, fileobj) -> DecryptingReader:
+        return DecryptingReader(password, fileobj, self.workers, key_cache=self.key_cache)
+
+    def encrypt_file(self, password: bytes, in_filename: str, out_folder: str=None, metadata: dict = None,
+                     map_input: bool = False) -> str:
+        # map_input=True encrypts straight from the mapped pages of in_filename,
+        # which is only safe for files nothing else truncates meanwhile (that
+        # raises SIGBUS), like the locker's own temporary archives
         if not out_folder:
             out_folder = os.path.dirname(in_filename)
         
         out_filename = os.path.join(out_folder, os.path.basename(in_filename) + ".enc")
-        with open(in_filename, "rb") as in_file:
-            data = in_file.read()
-        
-        ciphertext = self.encrypt(password, data)
-        
-        with open(out_filename, "wb") as out_file:
-            out_file.write(ciphertext)
+        # The writer is closed before the mapping, which must outlive every view of it
+        try:
+            with open_stream(in_filename) as in_file, (_mapped(in_file) if map_input else nullcontext()) as mapped, \
+                    open_stream(out_filename, "wb") as out_file, \
+                    self.open_writer(password, out_file, metadata=metadata) as writer:
+                if mapped is not None:
+                    writer.write(mapped)
+                else:
+                    buffer = bytearray(block_size(in_filename))
+                    view = memoryview(buffer)
+                    while (size := in_file.readinto(buffer)):
+                        writer.write(view[:size])
+        except BaseException:
+            # Don't leave an unfinished container behind
+            if os.path.exists(out_filename):
+                os.remove(out_filename)
+            raise
 
         return out_filename
 
@@ -56,20 +708,55 @@ class FileCrypto(Crypto):
         if not out_filename:
             out_filename = os.path.splitext(in_filename)[0]
 
-        with open(in_filename, "rb") as in_file:
-            ciphertext = in_file.read()
-        data = self.decrypt(password, ciphertext)
-        with open(out_filename, "wb") as out_file:
-            out_file.write(data)
+        try:
+            with open_stream(in_filename) as in_file, open_stream(out_filename, "wb") as out_file, \
+                    self.open_reader(password, in_file) as reader:
+                buffer = bytearray(self.chunk_size)
+                view = memoryview(buffer)
+                while (size := reader.readinto(buffer)):
+                    out_file.write(view[:size])
+        except Exception:
+            # Don't leave partially decrypted plaintext behind
+            if os.path.exists(out_filename):
+                os.remove(out_filename)
+            raise
         return out_filename
 
-    def hash_file(self, filename: str) -> str:
-        # Return SHA-256 hash of file
-        sha256 = hashlib.sha256()
-        with open(filename, "rb") as file:
-            while (chunk := file.read(8192)):
-                sha256.update(chunk)
-        return sha256.hexdigest()
+    def read_content(self, password: bytes, filename: str) -> dict:
+        # The description of the plaintext of filename, None if it has none;
+        # only needs the KDF, which the key cache keeps for the file's unlock
+        with open(filename, "rb") as in_file, self.open_reader(password, in_file) as reader:
+            return (reader.header or {}).get("content")
+
+    @staticmethod
+    def read_header(filename: str) -> dict:
+        # Parsed header of a container, without the password; None for legacy
+        # files. Only authenticated once a record has been decrypted, and the
+        # content description stays sealed (see read_content).
+        with open(filename, "rb") as in_file:
+            prefix = _read_exact(in_file, 16)
+            if prefix[:len(MAGIC)] != MAGIC:
+                return None
+            return _read_header(in_file, prefix)[1]
+
+    def verify_file(self, password: bytes, filename: str) -> int:
+        # Checks password and every record of filename, see DecryptingReader.verify
+        with open_stream(filename) as in_file, self.open_reader(password, in_file) as reader:
+            return reader.verify()
+
+    def hash_file(self, filename: str, algorithm: str = "sha256") -> str:
+        # Return the hash of file (SHA-256, or another hashlib algorithm), read
+        # through a buffer sized for the file, up to the device's block size:
+        # hashed files are live source files, which a concurrent truncate would
+        # turn into a SIGBUS if they were mapped. hashlib releases the GIL while
+        # it hashes, so files hashed from several threads are hashed in parallel.
+        digest = hashlib.new(algorithm)
+        with StreamFile(filename) as file:
+            buffer = bytearray(max(min(os.fstat(file.fileno()).st_size, file.buffer_size), 1))
+            view = memoryview(buffer)
+            while (size := file.readinto(buffer)):
+                digest.update(view[:size])
+        return digest.hexdigest()
     
 
 
@@ -0,0 +1,326 @@
+import io
+import os
+import copy
+import json
+import hmac
+import time
+import hashlib
+import warnings
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from Cryptodome.Hash import SHA256
+from Cryptodome.Protocol.KDF import HKDF
+from Cryptodome.Random import get_random_bytes
+from archiver import Archiver, get_archiver
+from crypto import Crypto, FileCrypto
+from instrument import tree_size
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+STORE_VERSION = 1
+SNAPSHOT_SUFFIX = ".snapshot"
+# Chunk size bounds. Cut points are chosen by content, so an insertion or
+# deletion only changes the chunks around it and the rest still deduplicate.
+MIN_CHUNK_SIZE = 64 * 1024
+AVG_CHUNK_SIZE = 256 * 1024
+MAX_CHUNK_SIZE = 1024 * 1024
+MASK64 = (1 << 64) - 1
+# Cut points are searched HASH_BLOCK bytes at a time with numpy. Without it the
+# search is a pure-Python loop running at a few MB/s, and locking more than
+# SLOW_CHUNKING_SIZE bytes into a store warns.
+HASH_BLOCK = 64 * 1024
+SLOW_CHUNKING_SIZE = 256 * 1024 * 1024
+
+
+class Chunker:
+    # FastCDC: a Gear rolling hash over the bytes after min_size, cutting where
+    # the masked top bits are zero. Normalized chunking uses a stricter mask
+    # before avg_size and a looser one after, which narrows the size spread. The
+    # gear table is derived from key, so boundaries don't fingerprint content.
+    def __init__(self, key: bytes, min_size: int = MIN_CHUNK_SIZE, avg_size: int = AVG_CHUNK_SIZE,
+                 max_size: int = MAX_CHUNK_SIZE):
+        self.min_size = min_size
+        self.avg_size = avg_size
+        self.max_size = max_size
+        self.gear = [int.from_bytes(hmac.new(key, bytes([value]), hashlib.sha256).digest()[:8], "big")
+                     for value in range(256)]
+        bits = avg_size.bit_length() - 1
+        self.mask_small = ((1 << (bits + 1)) - 1) << (64 - bits - 1)
+        self.mask_large = ((1 << (bits - 1)) - 1) << (64 - bits + 1)
+        self._gear_array = numpy.array(self.gear, dtype=numpy.uint64) if numpy is not None else None
+
+    def cut_point(self, data) -> int:
+        # Length of the first chunk of data, which must hold at least max_size
+        # bytes unless it is the end of the stream
+        size = len(data)
+        if size <= self.min_size:
+            return size
+        end = min(size, self.max_size)
+        normal = min(self.avg_size, end)
+        if self._gear_array is not None:
+            return self._search(data, normal, end)
+        gear, mask = self.gear, self.mask_small
+        h = 0
+        for i in range(self.min_size, normal):
+            h = ((h << 1) + gear[data[i]]) & MASK64
+            if not h & mask:
+                return i + 1
+        mask = self.mask_large
+        for i in range(normal, end):
+            h = ((h << 1) + gear[data[i]]) & MASK64
+            if not h & mask:
+                return i + 1
+        return end
+
+    def _search(self, data, normal: int, end: int) -> int:
+        # cut_point with numpy. The hash at i is the sum of gear[data[i - k]] << k
+        # for the 64 bytes up to i (back to min_size), mod 2**64; each doubling
+        # step adds the sums of the previous width, shifted by that width.
+        for start, stop, mask in ((self.min_size, normal, self.mask_small), (normal, end, self.mask_large)):
+            for block in range(start, stop, HASH_BLOCK):
+                first = max(self.min_size, block - 63)
+                h = self._gear_array[numpy.frombuffer(data, numpy.uint8, min(block + HASH_BLOCK, stop) - first, first)]
+                width = 1
+                while width < 64:
+                    h[width:] += h[:-width] << numpy.uint64(width)
+                    width *= 2
+                cuts = numpy.flatnonzero((h[block - first:] & numpy.uint64(mask)) == 0)
+                if cuts.size:
+                    return block + int(cuts[0]) + 1
+        return end
+
+
+class _ChunkingWriter(io.RawIOBase):
+    # Splits what is written to it into content-defined chunks passed to emit.
+    # Leaving the context with an exception drops the unfinished tail.
+    def __init__(self, chunker: Chunker, emit):
+        super().__init__()
+        self._chunker = chunker
+        self._emit = emit
+        self._buffer = bytearray()
+        self._aborted = False
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        data = memoryview(data).cast("B")
+        self._buffer += data
+        while len(self._buffer) >= self._chunker.max_size:
+            self._cut()
+        return data.nbytes
+
+    def _cut(self):
+        size = self._chunker.cut_point(self._buffer)
+        self._emit(bytes(self._buffer[:size]))
+        del self._buffer[:size]
+
+    def close(self):
+        if not self.closed and not self._aborted:
+            while self._buffer:
+                self._cut()
+        super().close()
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self._aborted = True
+        return super().__exit__(exc_type, exc, tb)
+
+
+class _ChunkReader(io.RawIOBase):
+    # Plaintext of a snapshot: its chunks read, verified and concatenated in order,
+    # with a window of chunks decrypted ahead on the store's pool
+    def __init__(self, store: "ChunkStore", chunks: list, password: bytes, id_key: bytes):
+        super().__init__()
+        self._pool = ThreadPoolExecutor(store.workers)
+        self._chunks = self._read(store, chunks, password, id_key)
+        self._pending = memoryview(b"")
+
+    def readable(self) -> bool:
+        return True
+
+    def _read(self, store, chunks, password, id_key):
+        pending = deque()
+        for chunk_id, size in chunks:
+            pending.append(self._pool.submit(store._read_chunk, chunk_id, size, password, id_key))
+            if len(pending) >= 2 * store.workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    def readinto(self, b) -> int:
+        while not self._pending:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return 0
+            self._pending = memoryview(chunk)
+        size = min(len(b), len(self._pending))
+        b[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+    def close(self):
+        self._pool.shutdown(cancel_futures=True)
+        super().close()
+
+
+class ChunkStore:
+    # Deduplicating store for locked folders. A folder is archived as usual, the
+    # archive stream is cut into content-defined chunks, and each unique chunk is
+    # encrypted once into chunks/ under its keyed hash. A snapshot is the
+    # encrypted list of chunk ids for one lock, so storage grows with unique data
+    # rather than with the number of snapshots.
+    #
+    #   root/store.json               salt, KDF and chunking parameters
+    #   root/chunks/ab/abcd...        one encrypted container per unique chunk
+    #   root/snapshots/name.snapshot  encrypted chunk list
+    #
+    # Chunk ids and cut points are keyed by the password, so snapshots locked with
+    # different passwords work but don't deduplicate against each other.
+    def __init__(self, root: str, crypto: FileCrypto = None, archiver: Archiver = None, workers: int = 4,
+                 min_size: int = MIN_CHUNK_SIZE, avg_size: int = AVG_CHUNK_SIZE, max_size: int = MAX_CHUNK_SIZE):
+        self.root = root
+        self.archiver = archiver or get_archiver("tarfile")
+        if not self.archiver.streamable or self.archiver.random_access:
+            raise ValueError(f"{type(self.archiver).__name__} does not support streaming")
+        self.workers = workers
+        crypto = crypto or FileCrypto()
+
+        config_file = os.path.join(root, "store.json")
+        if not os.path.exists(config_file):
+            os.makedirs(os.path.join(root, "chunks"), exist_ok=True)
+            os.makedirs(os.path.join(root, "snapshots"), exist_ok=True)
+            config = {"version": STORE_VERSION, "salt": get_random_bytes(16).hex(), "kdf": crypto.kdf,
+                      "min_size": min_size, "avg_size": avg_size, "max_size": max_size}
+            try:
+                with open(config_file, "x") as f:
+                    json.dump(config, f)
+            except FileExistsError:
+                pass
+        with open(config_file) as f:
+            self.config = json.load(f)
+        if self.config.get("version") != STORE_VERSION:
+            raise ValueError(f"Unsupported store version {self.config.get('version')}")
+
+        # Every container in the store shares the store salt, so the KDF runs once
+        # per password and each chunk gets its own subkey
+        self.crypto = copy.copy(crypto)
+        self.crypto.kdf = self.config["kdf"]
+        self.crypto.session_salt = bytes.fromhex(self.config["salt"])
+
+    def lock_folder(self, folder: str, password: str, name: str = None) -> str:
+        # Stores folder and returns the path of its snapshot
+        if numpy is None and tree_size(folder) > SLOW_CHUNKING_SIZE:
+            warnings.warn(f"Chunking {folder} without numpy runs at a few MB/s; install numpy to speed it up",
+                          RuntimeWarning, stacklevel=2)
+        password = password.encode()
+        id_key, chunker = self._keys(password)
+        chunks = []
+        seen = set()
+        pending = deque()
+
+        with ThreadPoolExecutor(self.workers) as pool:
+            def emit(chunk):
+                chunk_id = Crypto.keyed_hash(id_key, chunk)
+                chunks.append([chunk_id, len(chunk)])
+                if chunk_id in seen or os.path.exists(self._chunk_path(chunk_id)):
+                    return
+                seen.add(chunk_id)
+                pending.append(pool.submit(self._write_chunk, chunk_id, chunk, password))
+                while len(pending) > 2 * self.workers:
+                    pending.popleft().result()
+
+            with _ChunkingWriter(chunker, emit) as sink:
+                self.archiver.archive_to(folder, sink)
+            while pending:
+                pending.popleft().result()
+
+        snapshot = {"version": STORE_VERSION, "created": time.time(),
+                    "size": sum(size for _, size in chunks), "chunks": chunks}
+        return self._write_snapshot(name or os.path.basename(os.path.normpath(folder)), snapshot, password)
+
+    def unlock_folder(self, snapshot: str, password: str, out_folder: str = ".") -> str:
+        password = password.encode()
+        id_key, _ = self._keys(password)
+        chunks = self.read_snapshot(snapshot, password)["chunks"]
+        with _ChunkReader(self, chunks, password, id_key) as reader:
+            self.archiver.unarchive_from(io.BufferedReader(reader, self.config["max_size"]), out_folder)
+        return out_folder
+
+    def snapshots(self) -> list:
+        folder = os.path.join(self.root, "snapshots")
+        return sorted(os.path.join(folder, name) for name in os.listdir(folder) if name.endswith(SNAPSHOT_SUFFIX))
+
+    def read_snapshot(self, snapshot: str, password: bytes) -> dict:
+        with open(snapshot, "rb") as in_file, self.crypto.open_reader(password, in_file) as reader:
+            data = json.loads(reader.read())
+        if data.get("version") != STORE_VERSION:
+            raise ValueError(f"Unsupported snapshot version {data.get('version')}")
+        return data
+
+    def prune(self, password: str) -> int:
+        # Removes chunks no snapshot refers to (after snapshots were deleted) and
+        # returns how many. Must not run while a lock into this store is in progress.
+        referenced = set()
+        for snapshot in self.snapshots():
+            referenced.update(chunk_id for chunk_id, _ in self.read_snapshot(snapshot, password.encode())["chunks"])
+        removed = 0
+        for dir, _, names in os.walk(os.path.join(self.root, "chunks")):
+            for name in names:
+                if name not in referenced:
+                    os.remove(os.path.join(dir, name))
+                    removed += 1
+        return removed
+
+    def _keys(self, password: bytes):
+        salt = bytes.fromhex(self.config["salt"])
+        master_key = self.crypto.key_cache.derive(password, salt, self.config["kdf"])
+        id_key = HKDF(master_key, 32, salt, SHA256, context=b"locker-chunk-id")
+        chunker = Chunker(id_key, self.config["min_size"], self.config["avg_size"], self.config["max_size"])
+        return id_key, chunker
+
+    def _chunk_path(self, chunk_id: str) -> str:
+        return os.path.join(self.root, "chunks", chunk_id[:2], chunk_id)
+
+    def _write_chunk(self, chunk_id: str, chunk: bytes, password: bytes) -> None:
+        path = self._chunk_path(chunk_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Concurrent locks may store the same chunk; each writes its own temporary
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as out_file, self.crypto.open_writer(password, out_file) as writer:
+            writer.write(chunk)
+        os.replace(tmp_path, path)
+
+    def _read_chunk(self, chunk_id: str, size: int, password: bytes, id_key: bytes) -> bytes:
+        with open(self._chunk_path(chunk_id), "rb") as in_file, self.crypto.open_reader(password, in_file) as reader:
+            chunk = reader.read()
+        # Each container is authenticated, but only its id ties it to this position
+        if len(chunk) != size or not hmac.compare_digest(Crypto.keyed_hash(id_key, chunk), chunk_id):
+            raise ValueError(f"Chunk {chunk_id} does not match its id")
+        return chunk
+
+    def _write_snapshot(self, name: str, snapshot: dict, password: bytes) -> str:
+        folder = os.path.join(self.root, "snapshots")
+        stamp = time.strftime("%Y%m%dT%H%M%S", time.gmtime(snapshot["created"]))
+        data = json.dumps(snapshot).encode()
+        sequence = 0
+        while True:
+            suffix = f".{sequence}" if sequence else ""
+            path = os.path.join(folder, f"{name}-{stamp}{suffix}{SNAPSHOT_SUFFIX}")
+            try:
+                out_file = open(path, "xb")
+                break
+            except FileExistsError:
+                sequence += 1
+        try:
+            with out_file, self.crypto.open_writer(password, out_file) as writer:
+                writer.write(data)
+        except BaseException:
+            os.remove(path)
+            raise
+        return path
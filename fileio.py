@@ -0,0 +1,210 @@
+import io
+import os
+import mmap
+from functools import lru_cache
+
+
+# Locking, unlocking and hashing stream each file once, front to back. Their
+# buffers are sized for the device holding the file, the kernel is told the
+# access is sequential, and the pages a pass has moved past are dropped from the
+# page cache, so locking a tree larger than RAM doesn't evict everything else.
+# Buffers are a power of two between MIN_BUFFER and MAX_BUFFER, holding about
+# BUFFER_REQUESTS of the device's preferred request size.
+MIN_BUFFER = 256 * 1024
+MAX_BUFFER = 8 * 1024 * 1024
+BUFFER_REQUESTS = 8
+# Pages are dropped every DROP_INTERVAL bytes, up to the previous mark: written
+# pages are still dirty when first advised, which only starts their writeback,
+# and are dropped by the next advice once they are clean.
+DROP_INTERVAL = 32 * 1024 * 1024
+# Defaults for open_stream. DIRECT_IO reads files with O_DIRECT, bypassing the
+# page cache entirely, where the file system supports it; offsets and buffers
+# then have to be multiples of ALIGNMENT.
+DROP_CACHE = True
+DIRECT_IO = False
+ALIGNMENT = 4096
+
+
+def block_size(path: str) -> int:
+    # Streaming buffer size for path, or for files created at path when it
+    # doesn't exist yet
+    while True:
+        try:
+            stat = os.stat(path)
+            break
+        except OSError:
+            parent = os.path.dirname(os.path.abspath(path))
+            if parent == os.path.abspath(path):
+                return MIN_BUFFER
+            path = parent
+    return _buffer_size(stat.st_dev, getattr(stat, "st_blksize", 0))
+
+
+@lru_cache(maxsize=None)
+def _buffer_size(device: int, blksize: int) -> int:
+    request = _request_size(device) or blksize or ALIGNMENT
+    size = MIN_BUFFER
+    while size < request * BUFFER_REQUESTS and size < MAX_BUFFER:
+        size *= 2
+    return size
+
+
+def _request_size(device: int) -> int:
+    # Preferred request size of the block device holding device from sysfs
+    # (Linux only), 0 when unknown. A partition's queue is its disk's.
+    if not hasattr(os, "major"):
+        return 0
+    base = f"/sys/dev/block/{os.major(device)}:{os.minor(device)}"
+    for queue in (os.path.join(base, "queue"), os.path.join(base, "..", "queue")):
+        for name, scale in (("optimal_io_size", 1), ("max_sectors_kb", 1024)):
+            try:
+                with open(os.path.join(queue, name)) as f:
+                    value = int(f.read()) * scale
+            except (OSError, ValueError):
+                continue
+            if value:
+                return value
+    return 0
+
+
+def advise(fd: int, offset: int, length: int, advice: str) -> None:
+    # posix_fadvise(fd, offset, length, POSIX_FADV_<advice>) where there is one;
+    # length 0 means up to the end of the file
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        os.posix_fadvise(fd, offset, length, getattr(os, "POSIX_FADV_" + advice))
+    except OSError:
+        # Pipes, and file systems that don't take advice
+        pass
+
+
+def release(fileobj) -> None:
+    # Drops the cached pages of a file read in one go, unless DROP_CACHE is off
+    if DROP_CACHE:
+        advise(fileobj.fileno(), 0, 0, "DONTNEED")
+
+
+class StreamFile(io.FileIO):
+    # Raw file for one streaming pass, see open_stream. buffer_size is the
+    # buffer size for its device. Seeking still works: pages are only dropped
+    # behind the new position, and direct reads end at an unaligned offset.
+    def __init__(self, path: str, mode: str = "rb", direct: bool = None, drop_cache: bool = None):
+        direct = DIRECT_IO if direct is None else direct
+        self._drop = DROP_CACHE if drop_cache is None else drop_cache
+        # Only reads go direct: writes would need an aligned length at the end
+        self.direct = False
+        if direct and mode == "rb" and hasattr(os, "O_DIRECT"):
+            try:
+                super().__init__(path, mode, opener=lambda path, flags: os.open(path, flags | os.O_DIRECT))
+                self.direct = True
+            except OSError:
+                # tmpfs and some others refuse O_DIRECT
+                pass
+        if not self.direct:
+            super().__init__(path, mode)
+        self.buffer_size = block_size(path)
+        # Bytes read ahead into the aligned buffer by a direct read but not returned yet
+        self._bounce = self._pending = None
+        self._eof = False
+        self._position = self._dropped = self._mark = 0
+        if mode == "rb":
+            advise(self.fileno(), 0, 0, "SEQUENTIAL")
+
+    def read(self, size: int = -1):
+        if size is None or size < 0:
+            return self.readall()
+        buffer = bytearray(size)
+        read = self.readinto(buffer)
+        return None if read is None else bytes(buffer[:read])
+
+    def readall(self) -> bytes:
+        chunks = []
+        while (chunk := self.read(self.buffer_size)):
+            chunks.append(chunk)
+        return b"".join(chunks)
+
+    def readinto(self, b) -> int:
+        size = self._read_direct(b) if self.direct else super().readinto(b)
+        if size:
+            self._advance(size)
+        return size
+
+    def write(self, b) -> int:
+        size = super().write(b)
+        if size:
+            self._advance(size)
+        return size
+
+    def tell(self) -> int:
+        if self.direct:
+            return self._position
+        return super().tell()
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if self.direct:
+            if whence == io.SEEK_CUR:
+                offset, whence = self._position + offset, io.SEEK_SET
+            if whence == io.SEEK_SET and offset == self._position:
+                return offset
+            self._pending, self._eof = None, False
+            position = super().seek(offset, whence)
+            if position % ALIGNMENT:
+                self._end_direct()
+        else:
+            position = super().seek(offset, whence)
+        self._position = self._dropped = self._mark = position
+        return position
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self._drop:
+                # Reads drop the rest of the file, writes whatever is clean by now
+                advise(self.fileno(), self._dropped, self._position - self._dropped if self.writable() else 0,
+                       "DONTNEED")
+        finally:
+            self._pending = self._bounce = None
+            super().close()
+
+    def _advance(self, size: int):
+        self._position += size
+        if self._drop and self._position - self._mark >= DROP_INTERVAL:
+            advise(self.fileno(), self._dropped, self._position - self._dropped, "DONTNEED")
+            self._dropped, self._mark = self._mark, self._position
+
+    def _read_direct(self, b) -> int:
+        # Whole aligned buffers are read at aligned offsets; only the last read
+        # of the file is short
+        if not self._pending:
+            if self._eof:
+                return 0
+            if self._bounce is None:
+                # Anonymous mappings are page aligned
+                self._bounce = memoryview(mmap.mmap(-1, self.buffer_size))
+            read = os.readv(self.fileno(), [self._bounce])
+            self._eof = read < len(self._bounce)
+            self._pending = self._bounce[:read]
+        view = memoryview(b).cast("B")
+        size = min(len(view), len(self._pending))
+        view[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+    def _end_direct(self):
+        import fcntl
+        flags = fcntl.fcntl(self.fileno(), fcntl.F_GETFL)
+        fcntl.fcntl(self.fileno(), fcntl.F_SETFL, flags & ~os.O_DIRECT)
+        self.direct = False
+
+
+def open_stream(path: str, mode: str = "rb", direct: bool = None, drop_cache: bool = None):
+    # Buffered binary file for a streaming pass over path; mode is "rb", "wb",
+    # "xb" or "r+b". direct and drop_cache default to DIRECT_IO and DROP_CACHE.
+    raw = StreamFile(path, mode, direct, drop_cache)
+    if "+" in mode:
+        return io.BufferedRandom(raw, raw.buffer_size)
+    if raw.readable():
+        return io.BufferedReader(raw, raw.buffer_size)
+    return io.BufferedWriter(raw, raw.buffer_size)
@@ -0,0 +1,148 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from crypto import FileCrypto
+from scanner import scan_tree
+
+
+# Digests of files by path, valid while the file's inode, size and mtime_ns are
+# unchanged, kept in an SQLite database shared by every run (and process) using
+# it. Beyond max_entries, the entries used least recently are evicted.
+MAX_ENTRIES = 1000000
+# Files modified this recently may still change within the same mtime, so
+# their digests aren't cached
+RACY_NS = 2 * 10 ** 9
+# "sha256" is what manifests record. "blake2b" is faster where the CPU has no
+# SHA extensions. "sample" is a quick pre-check, a BLAKE2b of the size and
+# SAMPLE_BLOCKS blocks spread over the file: a different sample proves a
+# change, an equal one doesn't prove there was none.
+ALGORITHMS = ("sha256", "blake2b", "sample")
+SAMPLE_BLOCK = 64 * 1024
+SAMPLE_BLOCKS = 4
+
+
+def default_cache_file() -> str:
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "locker", "hashes.sqlite3")
+
+
+def sample_file(filename: str) -> str:
+    # The "sample" digest of filename
+    digest = hashlib.blake2b(digest_size=16)
+    with open(filename, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        digest.update(size.to_bytes(8, "big"))
+        if size <= SAMPLE_BLOCK * SAMPLE_BLOCKS:
+            digest.update(f.read())
+        else:
+            step = (size - SAMPLE_BLOCK) // (SAMPLE_BLOCKS - 1)
+            for index in range(SAMPLE_BLOCKS):
+                f.seek(index * step)
+                digest.update(f.read(SAMPLE_BLOCK))
+    return digest.hexdigest()
+
+
+class HashCache:
+    # Safe to share between threads. Lookups and stores are batched per call;
+    # hit times are written back with the next store or close.
+    def __init__(self, filename: str = None, max_entries: int = MAX_ENTRIES):
+        self.filename = filename or default_cache_file()
+        self.max_entries = max_entries
+        if self.filename != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(self.filename)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._used = []
+        self._db = sqlite3.connect(self.filename, timeout=30, check_same_thread=False)
+        with self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS digests (path TEXT NOT NULL, algorithm TEXT NOT NULL, "
+                             "inode INTEGER NOT NULL, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, "
+                             "digest TEXT NOT NULL, used INTEGER NOT NULL, PRIMARY KEY (path, algorithm))")
+            self._db.execute("CREATE INDEX IF NOT EXISTS digests_used ON digests (used)")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM digests").fetchone()[0]
+
+    def lookup(self, files: dict, algorithm: str = "sha256") -> dict:
+        # Cached digests of the files ({path: stat_result}) still matching their stat
+        found = {}
+        with self._lock:
+            for path, stat in files.items():
+                row = self._db.execute("SELECT digest FROM digests WHERE path = ? AND algorithm = ? AND inode = ? "
+                                       "AND size = ? AND mtime_ns = ?",
+                                       (os.path.abspath(path), algorithm, stat.st_ino, stat.st_size,
+                                        stat.st_mtime_ns)).fetchone()
+                if row is not None:
+                    found[path] = row[0]
+                    self._used.append((os.path.abspath(path), algorithm))
+        return found
+
+    def store(self, files: dict, digests: dict, algorithm: str = "sha256", started_ns: int = None) -> None:
+        # Caches digests ({path: digest}) of files ({path: stat_result}), hashed
+        # since started_ns, except those modified too shortly before it
+        now = time.time_ns()
+        started_ns = started_ns or now
+        rows = [(os.path.abspath(path), algorithm, files[path].st_ino, files[path].st_size, files[path].st_mtime_ns,
+                 digest, now)
+                for path, digest in digests.items() if files[path].st_mtime_ns < started_ns - RACY_NS]
+        with self._lock, self._db:
+            self._db.executemany("INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            self._flush(now)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._db is None:
+                return
+            with self._db:
+                self._flush(time.time_ns())
+            self._db.close()
+            self._db = None
+
+    def _flush(self, now: int):
+        if self._used:
+            self._db.executemany("UPDATE digests SET used = ? WHERE path = ? AND algorithm = ?",
+                                 [(now, path, algorithm) for path, algorithm in self._used])
+            self._used = []
+        excess = self._db.execute("SELECT COUNT(*) FROM digests").fetchone()[0] - self.max_entries
+        if excess > 0:
+            self._db.execute("DELETE FROM digests WHERE rowid IN "
+                             "(SELECT rowid FROM digests ORDER BY used LIMIT ?)", (excess,))
+
+
+def hash_files(crypto: FileCrypto, files: dict, algorithm: str = "sha256", cache: HashCache = None,
+               workers: int = None) -> dict:
+    # Digests of files ({path: stat_result}) by path. Those cache holds for
+    # unchanged files are reused; the others are hashed on a pool of workers
+    # threads (one per CPU by default) and stored in cache.
+    if algorithm not in ALGORITHMS:
+        raise ValueError(f"Invalid hash algorithm '{algorithm}'")
+    digests = cache.lookup(files, algorithm) if cache is not None else {}
+    missing = [path for path in files if path not in digests]
+    if not missing:
+        return digests
+    started_ns = time.time_ns()
+    hash_one = sample_file if algorithm == "sample" else lambda path: crypto.hash_file(path, algorithm)
+    with ThreadPoolExecutor(min(len(missing), workers or os.cpu_count() or 1)) as pool:
+        hashed = dict(zip(missing, pool.map(hash_one, missing)))
+    if cache is not None:
+        cache.store(files, hashed, algorithm, started_ns)
+    digests.update(hashed)
+    return digests
+
+
+def hash_tree(folder: str, crypto: FileCrypto = None, algorithm: str = "sha256", cache: HashCache = None,
+              workers: int = None) -> dict:
+    # Digest of every file under folder, by path relative to it
+    files = {entry.relpath: entry for entry in scan_tree(folder, prefetch_size=0) if entry.type == "file"}
+    digests = hash_files(crypto or FileCrypto(), {entry.path: entry.stat for entry in files.values()}, algorithm,
+                         cache, workers)
+    return {relpath: digests[entry.path] for relpath, entry in files.items()}
@@ -0,0 +1,324 @@
+import io
+import os
+import sys
+import time
+import threading
+from contextlib import contextmanager
+from scanner import ScanEntry
+
+
+# Bytes a metered stream accumulates before it reports progress
+PROGRESS_STEP = 1024 * 1024
+
+
+class Observer:
+    # Instrumentation hooks called by Locker and the archiver it drives. Every
+    # method is a no-op, so subclasses override only what they need; calls may
+    # come from worker threads. Stages Locker reports: "measure", "kdf", "walk",
+    # "archive", "encrypt", "decrypt", "extract", "manifest", "delta", "finalize"
+    # (syncing and renaming what was written) and "other" for time not spent in
+    # any of them. Stage times are exclusive: time spent in a nested stage
+    # (encrypting while archiving) is only counted there. Progress bytes are
+    # those of the input: source files read on lock, locked bytes read on unlock.
+    # Set needs_total to have Locker size the source first, for an ETA.
+    needs_total = False
+
+    def start(self, operation: str, total_bytes: int = None) -> None:
+        pass
+
+    def stage_started(self, name: str) -> None:
+        pass
+
+    def stage(self, name: str, elapsed: float, bytes: int = 0) -> None:
+        pass
+
+    def progress(self, bytes: int = 0, files: int = 0) -> None:
+        pass
+
+    def finish(self, operation: str, elapsed: float, error: BaseException = None) -> None:
+        pass
+
+
+_local = threading.local()
+
+
+def _stack() -> list:
+    # This thread's open spans, as [start, time spent in nested stages]
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def _charge(elapsed: float) -> None:
+    # Counts elapsed as spent in a nested stage of this thread's current span
+    stack = _stack()
+    if stack:
+        stack[-1][1] += elapsed
+
+
+@contextmanager
+def span(observer: Observer, name: str):
+    # Times the block as stage name, excluding nested spans and metered calls
+    observer.stage_started(name)
+    stack = _stack()
+    current = [time.perf_counter(), 0.0]
+    stack.append(current)
+    try:
+        yield
+    finally:
+        stack.pop()
+        elapsed = time.perf_counter() - current[0]
+        _charge(elapsed)
+        observer.stage(name, elapsed - current[1])
+
+
+def tree_size(folder: str) -> int:
+    total = 0
+    for dir, _, files in os.walk(folder):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(dir, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+class Metered(io.RawIOBase):
+    # Stream wrapper that times reads or writes on fileobj as stage name and,
+    # unless progress is False, reports the bytes passing through as progress.
+    # close() reports the stage but leaves fileobj open.
+    def __init__(self, fileobj, observer: Observer, name: str, progress: bool = True):
+        super().__init__()
+        self._fileobj = fileobj
+        self._observer = observer
+        self._name = name
+        self._progress = progress
+        self._elapsed = 0.0
+        self._bytes = 0
+        self._unreported = 0
+
+    def readable(self) -> bool:
+        return self._fileobj.readable()
+
+    def writable(self) -> bool:
+        return self._fileobj.writable()
+
+    def seekable(self) -> bool:
+        return self._fileobj.seekable()
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        return self._fileobj.seek(offset, whence)
+
+    def tell(self) -> int:
+        return self._fileobj.tell()
+
+    def readinto(self, b) -> int:
+        start = time.perf_counter()
+        size = self._fileobj.readinto(b)
+        self._count(time.perf_counter() - start, size or 0)
+        return size
+
+    def write(self, data) -> int:
+        start = time.perf_counter()
+        size = self._fileobj.write(data)
+        self._count(time.perf_counter() - start, size)
+        return size
+
+    def _count(self, elapsed: float, size: int):
+        _charge(elapsed)
+        self._elapsed += elapsed
+        self._bytes += size
+        self._unreported += size if self._progress else 0
+        if self._unreported >= PROGRESS_STEP:
+            self._observer.progress(bytes=self._unreported)
+            self._unreported = 0
+
+    def close(self):
+        if not self.closed:
+            if self._unreported:
+                self._observer.progress(bytes=self._unreported)
+                self._unreported = 0
+            self._observer.stage(self._name, self._elapsed, self._bytes)
+        super().close()
+
+
+def observe_scan(entries, observer: Observer):
+    # Passes scan entries through, timing how long the consumer waits on the
+    # walk and reporting each file, and its content as the consumer reads it
+    waited = 0.0
+    try:
+        while True:
+            start = time.perf_counter()
+            entry = next(entries, None)
+            elapsed = time.perf_counter() - start
+            _charge(elapsed)
+            waited += elapsed
+            if entry is None:
+                return
+            if entry.type == "file":
+                if entry.data is not None:
+                    # Prefetched, so small: counted as soon as it is handed over
+                    observer.progress(bytes=len(entry.data), files=1)
+                else:
+                    observer.progress(files=1)
+                    entry = _ObservedEntry(entry, observer)
+            yield entry
+    finally:
+        entries.close()
+        observer.stage("walk", waited)
+
+
+class _ObservedEntry(ScanEntry):
+    # A file the consumer reads from disk, reporting what it reads as progress
+    __slots__ = ("entry", "observer", "consumed")
+
+    def __init__(self, entry: ScanEntry, observer: Observer):
+        super().__init__(entry.name, entry.path, entry.relpath, entry.type, entry.stat)
+        self.entry = entry
+        self.observer = observer
+        # Bytes reported so far, over every open
+        self.consumed = 0
+
+    def open(self):
+        return _ObservedReader(self.entry.open(), self)
+
+
+class _ObservedReader(io.RawIOBase):
+    # Passes reads through, reporting those past what earlier opens of the
+    # entry read (archivers sample a file before archiving it) as progress
+    def __init__(self, fileobj, entry: _ObservedEntry):
+        super().__init__()
+        self._fileobj = fileobj
+        self._entry = entry
+        self._position = 0
+        self._unreported = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._fileobj.read(size)
+        self._count(len(data))
+        return data
+
+    def readinto(self, b) -> int:
+        size = self._fileobj.readinto(b)
+        self._count(size or 0)
+        return size
+
+    def _count(self, size: int):
+        self._position += size
+        if self._position > self._entry.consumed:
+            self._unreported += self._position - self._entry.consumed
+            self._entry.consumed = self._position
+            if self._unreported >= PROGRESS_STEP:
+                self._entry.observer.progress(bytes=self._unreported)
+                self._unreported = 0
+
+    def close(self):
+        if not self.closed:
+            self._fileobj.close()
+            if self._unreported:
+                self._entry.observer.progress(bytes=self._unreported)
+                self._unreported = 0
+        super().close()
+
+
+class Profiler(Observer):
+    # Aggregates stages over every operation it observes; report() prints
+    # where the time went with per-stage throughput
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stages = {}
+        self.operations = {}
+        self.bytes = 0
+        self.files = 0
+
+    def stage(self, name: str, elapsed: float, bytes: int = 0) -> None:
+        with self._lock:
+            totals = self.stages.setdefault(name, [0.0, 0])
+            totals[0] += elapsed
+            totals[1] += bytes
+
+    def progress(self, bytes: int = 0, files: int = 0) -> None:
+        with self._lock:
+            self.bytes += bytes
+            self.files += files
+
+    def finish(self, operation: str, elapsed: float, error: BaseException = None) -> None:
+        with self._lock:
+            totals = self.operations.setdefault(operation, [0, 0.0])
+            totals[0] += 1
+            totals[1] += elapsed
+
+    def report(self) -> str:
+        with self._lock:
+            stages = sorted(self.stages.items(), key=lambda item: -item[1][0])
+            wall = sum(elapsed for _, elapsed in self.operations.values())
+            lines = [f"{'stage':10} {'seconds':>9} {'share':>7} {'MiB':>10} {'MiB/s':>9}"]
+            for name, (elapsed, size) in stages:
+                share = f"{elapsed / wall:7.1%}" if wall else f"{'-':>7}"
+                rate = f"{size / elapsed / 2 ** 20:9.1f}" if size and elapsed else f"{'-':>9}"
+                lines.append(f"{name:10} {elapsed:9.3f} {share} {size / 2 ** 20:10.1f} {rate}")
+            for operation, (count, elapsed) in sorted(self.operations.items()):
+                lines.append(f"{operation}: {count} in {elapsed:.3f}s")
+            rate = f", {self.bytes / wall / 2 ** 20:.1f} MiB/s" if wall else ""
+            lines.append(f"{self.files} files, {self.bytes / 2 ** 20:.1f} MiB{rate}")
+            return "\n".join(lines)
+
+    def print_report(self, file=None) -> None:
+        print(self.report(), file=file or sys.stderr)
+
+
+class ProgressTracker(Observer):
+    # Tracks the progress of one operation at a time for a progress bar.
+    # fraction, eta and finalizing are safe to poll from another thread;
+    # callback, if given, is called from the worker with (fraction, eta) on
+    # every update. finalizing is set once the input is read and what was
+    # written is being synced, when fraction no longer moves.
+    needs_total = True
+
+    def __init__(self, callback=None):
+        self._callback = callback
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+        self.total = None
+        self.done = 0
+        self.files = 0
+        self.finalizing = False
+
+    def start(self, operation: str, total_bytes: int = None) -> None:
+        with self._lock:
+            self._start = time.monotonic()
+            self.total = total_bytes
+            self.done = 0
+            self.files = 0
+            self.finalizing = False
+
+    def stage_started(self, name: str) -> None:
+        if name == "finalize":
+            self.finalizing = True
+
+    def progress(self, bytes: int = 0, files: int = 0) -> None:
+        with self._lock:
+            self.done += bytes
+            self.files += files
+        if self._callback and bytes:
+            self._callback(self.fraction, self.eta)
+
+    @property
+    def fraction(self) -> float:
+        # None when the total is unknown
+        if not self.total:
+            return None
+        return min(self.done / self.total, 1.0)
+
+    @property
+    def eta(self) -> float:
+        # Seconds left at the average rate so far, None until there is a rate
+        fraction = self.fraction
+        if not fraction:
+            return None
+        elapsed = time.monotonic() - self._start
+        return elapsed * (1 - fraction) / fraction
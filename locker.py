@@ -1,24 +1,672 @@
+import io
 import os
-from crypto import FileCrypto
-from archiver import Archiver
+import copy
+import glob
+import hashlib
+import fnmatch
+import json
+import time
+import queue
+import shutil
+import tempfile
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from crypto import FileCrypto, InvalidPassword, ResumeMismatch
+from fileio import block_size, open_stream
+from archiver import Archiver, reader_for
+from checkpoint import CHECKPOINT_BYTES, CheckpointedSink, Journal, TreeChanged
+from manifest import (Listing, ManifestRecorder, build_manifest, diff_manifests, list_manifest, read_manifest,
+                      write_manifest)
+from hashcache import HashCache
+from instrument import Metered, Observer, span, tree_size
+from volumes import (VolumeReader, VolumeWriter, decrypt_volumes, encrypt_volumes, list_volumes, volume_base,
+                     volume_path)
+
+
+MANIFEST_SUFFIX = ".manifest"
+DELTA_SUFFIX = ".delta"
+# A locked file is written under its name plus PARTIAL_SUFFIX and renamed when complete
+PARTIAL_SUFFIX = ".partial"
+JOURNAL_SUFFIX = ".journal"
+# Delta member listing the paths removed since the previous lock
+DELETED_MEMBER = ".locker-deleted.json"
+
+# Chunks iter_lock lets its worker produce ahead of the consumer
+MAX_PENDING = 8
+# Outcome of one item of a batch: output is None and error set when it failed
+BatchResult = namedtuple("BatchResult", "source output error elapsed")
 
 
 class Locker:
-    def __init__(self, archiver: Archiver, crypto: FileCrypto):
-        self.archiver = archiver
+    def __init__(self, archiver: Archiver, crypto: FileCrypto, pipelined: bool = True,
+                 observer: Observer = None, checkpoint_bytes: int = CHECKPOINT_BYTES, volume_size: int = None,
+                 hash_cache: HashCache = None):
         self.crypto = crypto
+        # Archive straight into the cipher (and back) without a temporary plaintext archive
+        self.pipelined = pipelined
+        # Pipelined locks and resumable unlocks journal their progress every
+        # checkpoint_bytes, so an interrupted one picks up from there when run
+        # again; None disables it
+        self.checkpoint_bytes = checkpoint_bytes
+        # With volume_size, locked files are split into volumes of that many
+        # plaintext bytes (see volumes.py), written and read concurrently, and
+        # lock_folder returns the first one. Split locks aren't checkpointed.
+        self.volume_size = volume_size
+        # Manifests reuse the file hashes in hash_cache (see hashcache.py) and add theirs
+        self.hash_cache = hash_cache
+        # observer (an instrument.Observer) receives stage timings and progress
+        self.observer = observer or Observer()
+        if observer is not None:
+            # The archiver reports the walk; a copy keeps the caller's archiver untouched
+            archiver = copy.copy(archiver)
+            archiver.observer = observer
+        self.archiver = archiver
+
+    def lock_folder(self, folder: str, password: str, out_folder: str, incremental: bool = False) -> str:
+        # Every lock keeps an encrypted manifest of the folder next to the locked
+        # file (see list). With incremental=True, later locks of the same folder
+        # only write a delta of what changed since.
+        with self._operation("lock", lambda: tree_size(folder)):
+            encrypted_archive = self._locked_path(folder, out_folder)
+            manifest_file = encrypted_archive + MANIFEST_SUFFIX
+            locked = os.path.exists(encrypted_archive) or bool(list_volumes(encrypted_archive))
+            if incremental and locked and os.path.exists(manifest_file):
+                return self._lock_delta(folder, password, encrypted_archive)
+
+            previous = None
+            if incremental and os.path.exists(manifest_file):
+                with span(self.observer, "manifest"):
+                    previous = read_manifest(self.crypto, password.encode(), manifest_file)
+            for stale in self._deltas(encrypted_archive) + [manifest_file]:
+                if os.path.exists(stale):
+                    os.remove(stale)
+
+            # The manifest is recorded from what the archiver reads
+            recorder = ManifestRecorder(self.crypto, self.hash_cache)
+            locker = copy.copy(self)
+            locker.archiver = _hooked(self.archiver, recorder.entries)
+            resumed_salt = self._resumed_salt(encrypted_archive)
+            if self.crypto.session_salt is None or resumed_salt is not None:
+                # The locked file and its manifest share a KDF salt, so the key is
+                # derived once; a resumed lock keeps the salt its partial file has
+                locker.crypto = copy.copy(self.crypto)
+                locker.crypto.session_salt = resumed_salt or locker.crypto.new_session()
+            if self.volume_size and self.pipelined and self.archiver.streamable:
+                volumes = locker._lock_volumes(folder, password, encrypted_archive)
+            elif self.pipelined and self.archiver.streamable:
+                locker._lock_pipelined(folder, password, encrypted_archive)
+                volumes = []
+            else:
+                volumes = locker._lock_with_temp_file(folder, password, out_folder)
+            # What an earlier lock of this folder wrote in the other layout, or in more volumes
+            stale = list_volumes(encrypted_archive)[len(volumes):]
+            if volumes and os.path.exists(encrypted_archive):
+                stale.append(encrypted_archive)
+            for path in stale:
+                os.remove(path)
 
-    def lock_folder(self, folder: str, password: str, out_folder: str) -> str:
-        archive_out_path = self.archiver.archive(folder)
-        encrypted_archive = self.crypto.encrypt_file(
-            password.encode(), archive_out_path, out_folder)
-        os.remove(archive_out_path)
-        return encrypted_archive
+            with span(self.observer, "manifest"):
+                entries = recorder.result()
+                if not recorder.complete:
+                    # The archiver doesn't scan
+                    entries = build_manifest(folder, self.crypto, previous, self.hash_cache,
+                                             self.archiver.follow_symlinks)
+                write_manifest(locker.crypto, password.encode(), entries, manifest_file)
+            return volumes[0] if volumes else encrypted_archive
        
-    def unlock_folder(self, file: str, password: str, out_folder: str =".") -> str:
-        decrypted_archive = self.crypto.decrypt_file(password.encode(), file)
-        self.archiver.unarchive(decrypted_archive, out_folder)
-        os.remove(decrypted_archive)
+    def unlock_folder(self, file: str, password: str, out_folder: str =".", resume: bool = False) -> str:
+        # file is read with the archiver its header records (see archiver_for),
+        # whatever archiver this locker writes with. For a split file, it is the first volume.
+        # With resume=True, an unlock into out_folder that was interrupted
+        # continues from its last checkpoint, trusting that what it extracted
+        # before is still there; otherwise everything is extracted again. The
+        # checkpoint is kept in the temporary directory (see _unlock_journal).
+        with self._operation("unlock", lambda: self._locked_size(file)):
+            locker = self._reading(file, password)
+            encrypted_archive = volume_base(file) or file
+            stat = os.stat(file)
+            journal = _unlock_journal(file, out_folder)
+            info = {"operation": "unlock", "source": os.path.abspath(file), "size": stat.st_size,
+                    "mtime_ns": stat.st_mtime_ns}
+            state = journal.load(info) if self.checkpoint_bytes and resume else None
+            try:
+                if state is None or not state.get("done"):
+                    if locker.pipelined and locker.archiver.streamable:
+                        locker._unlock_pipelined(file, password, out_folder, journal, info, state)
+                    else:
+                        locker._unlock_with_temp_file(file, password, out_folder)
+                    if self.checkpoint_bytes and self._deltas(encrypted_archive):
+                        # Deltas are reapplied in full, but the archive isn't
+                        journal.save(dict(info, done=True))
+
+                for delta in self._deltas(encrypted_archive):
+                    with span(self.observer, "delta"):
+                        self._apply_delta(delta, password, out_folder)
+            except BaseException:
+                # Only an unlock asked to resume leaves its checkpoint for the next one
+                if not resume:
+                    journal.remove()
+                raise
+            journal.remove()
+            return out_folder
+
+    def lock_many(self, folders, password: str, out_folder: str = None, workers: int = None,
+                  incremental: bool = False):
+        # Locks each of folders (a list, or a glob pattern) on a pool of workers
+        # threads (one per CPU by default), yielding a BatchResult as each one
+        # finishes; a failure is reported in its result and doesn't stop the batch.
+        # The batch shares one KDF salt, so the key is derived once and every
+        # file gets its own subkey from it. Folders that would lock to the same
+        # file (same name, same out_folder) raise ValueError before any is locked.
+        if isinstance(folders, str):
+            folders = [path for path in sorted(glob.glob(folders)) if os.path.isdir(path)]
+        targets = {}
+        for folder in folders:
+            target = os.path.abspath(self._locked_path(folder, out_folder))
+            if target in targets:
+                raise ValueError(f"{targets[target]!r} and {folder!r} would both be locked to {target!r}")
+            targets[target] = folder
+        batch = copy.copy(self)
+        batch.crypto = copy.copy(self.crypto)
+        batch.crypto.new_session()
+        return _run_batch(lambda folder: batch.lock_folder(folder, password, out_folder, incremental),
+                          folders, workers)
+
+    def unlock_many(self, files, password: str, out_folder: str = ".", workers: int = None, resume: bool = False):
+        # Unlocks each of files (a list, or a glob pattern) into out_folder, like
+        # lock_many. Files locked in one batch share a KDF salt, so the key cache
+        # derives their key once even when they are opened concurrently.
+        if isinstance(files, str):
+            files = [path for path in sorted(glob.glob(files)) if os.path.isfile(path)]
+        return _run_batch(lambda file: self.unlock_folder(file, password, out_folder, resume), files, workers)
+
+    def lock_to_stream(self, folder: str, password: str, writable) -> None:
+        # Writes the locked bytes of folder to writable (anything with write: a
+        # pipe, a socket file, stdout), without touching the disk. What is written
+        # is a single locked file, which unlock_from_stream reads back, or
+        # unlock_folder once it is saved. Needs a streamable archiver.
+        if not self.archiver.streamable:
+            raise ValueError(f"{type(self.archiver).__name__} does not support streaming")
+        with self._operation("lock", lambda: tree_size(folder)):
+            with span(self.observer, "kdf"):
+                writer = self.crypto.open_writer(password.encode(), writable, metadata=self.archiver.describe())
+            with writer, Metered(writer, self.observer, "encrypt", progress=False) as metered, \
+                    span(self.observer, "archive"):
+                self.archiver.archive_to(folder, metered)
+
+    def iter_lock(self, folder: str, password: str, max_pending: int = MAX_PENDING):
+        # Yields the locked bytes of folder as lock_to_stream produces them on a
+        # worker thread, at most max_pending chunks ahead of the consumer. Closing
+        # the generator early stops the worker.
+        chunks = queue.Queue(max_pending)
+        cancelled = threading.Event()
+
+        def produce():
+            try:
+                self.lock_to_stream(folder, password, _QueueWriter(chunks, cancelled))
+                item = None
+            except BaseException as e:
+                item = e
+            _put(chunks, item, cancelled)
+
+        worker = threading.Thread(target=produce, daemon=True)
+        worker.start()
+        try:
+            while (item := chunks.get()) is not None:
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            cancelled.set()
+            worker.join()
+
+    def unlock_from_stream(self, readable, password: str, out_folder: str = ".") -> str:
+        # Unlocks what lock_to_stream wrote into out_folder, reading it front to
+        # back from readable: a file object with read, or an iterable of bytes
+        # chunks like iter_lock, with the archiver its header records (this
+        # locker's for files without one). Only archivers that stream their reads
+        # can; other formats have to be saved and unlocked with unlock_folder.
+        if not hasattr(readable, "read"):
+            readable = _ChunkReader(readable)
+        with self._operation("unlock"):
+            with span(self.observer, "kdf"):
+                reader = self.crypto.open_reader(password.encode(), readable)
+            with reader, Metered(reader, self.observer, "decrypt") as metered, span(self.observer, "extract"):
+                archiver = self._archiver_reading((reader.header or {}).get("content"))
+                if not archiver.streamable or archiver.random_access:
+                    raise ValueError(f"{type(archiver).__name__} archives can't be unlocked from a stream")
+                archiver.unarchive_from(io.BufferedReader(metered, self.crypto.chunk_size), out_folder)
         return out_folder
 
+    def verify(self, file: str, password: str) -> int:
+        # Checks the password and authenticates every record of file, its deltas and
+        # manifest in one streaming pass, without writing any plaintext. Raises
+        # crypto.InvalidPassword right after the KDF for a wrong password and
+        # ValueError for a damaged file; returns the plaintext bytes checked.
+        encrypted_archive = volume_base(file) or file
+        files = [file] + self._deltas(encrypted_archive)
+        if os.path.exists(encrypted_archive + MANIFEST_SUFFIX):
+            files.append(encrypted_archive + MANIFEST_SUFFIX)
+        with self._operation("verify", lambda: sum(self._locked_size(path) for path in files)):
+            size = 0
+            for path in files:
+                with self._open_container(path, password) as reader, span(self.observer, "decrypt"):
+                    checked = reader.verify()
+                self.observer.progress(bytes=checked)
+                size += checked
+            return size
+
+    def verify_many(self, files, password: str, workers: int = None):
+        # Verifies each of files (a list, or a glob pattern) like unlock_many;
+        # a BatchResult's output is the plaintext size checked
+        if isinstance(files, str):
+            files = [path for path in sorted(glob.glob(files)) if os.path.isfile(path)]
+        return _run_batch(lambda file: self.verify(file, password), files, workers)
+
+    def list(self, file: str, password: str, pattern: str = None) -> list:
+        # What unlocking file restores, as manifest.Listing tuples with paths
+        # relative to the locked folder, read from the manifest kept next to
+        # file: only that is decrypted, however big the archive. pattern (an
+        # fnmatch pattern) keeps the matching paths. Files locked without a
+        # manifest are listed from the archive, by member name, without modes or hashes.
+        manifest_file = (volume_base(file) or file) + MANIFEST_SUFFIX
+        if os.path.exists(manifest_file):
+            with span(self.observer, "manifest"):
+                return list_manifest(read_manifest(self.crypto, password.encode(), manifest_file), pattern)
+        return [Listing(member.name, member.type, member.size, int(member.mtime * 1e9), None, None)
+                for member in self.list_members(file, password)
+                if pattern is None or fnmatch.fnmatch(member.name, pattern)]
+
+    def list_members(self, file: str, password: str) -> list:
+        archiver = self.archiver_for(file, password)
+        with self._open_locked(file, password, archiver.random_access) as reader:
+            return archiver.list_members(reader)
+
+    def extract_member(self, file: str, member: str, password: str, out_folder: str = ".") -> str:
+        # Only decrypts the records the archiver needs to find and read member,
+        # except in split files, which are decrypted up to the end
+        archiver = self.archiver_for(file, password)
+        with self._open_locked(file, password, archiver.random_access) as reader:
+            return archiver.extract_member(reader, member, out_folder)
+
+    def archiver_for(self, file: str, password: str) -> Archiver:
+        # The archiver to read file with: the fastest registered one for the
+        # format recorded in its header, with this locker's archiver settings.
+        # Files locked before the header described them use self.archiver.
+        return self._archiver_reading(self.crypto.read_content(password.encode(), file))
+
+    def folder_name(self, file: str, password: str) -> str:
+        # Name of the folder locked into file, from the extension in its header
+        content = self.crypto.read_content(password.encode(), file) or {}
+        extension = content.get("extension", self.archiver.extension)
+        name = os.path.basename(volume_base(file) or file)
+        if name.endswith(".enc"):
+            name = name[:-len(".enc")]
+        if extension and name.endswith(extension):
+            name = name[:-len(extension)]
+        return name
+
+    @contextmanager
+    def _operation(self, name: str, measure=None):
+        # Reports one lock or unlock to the observer. measure() sizes the input for
+        # observers that need a total; time not spent in any stage counts as "other".
+        observer = self.observer
+        start = time.perf_counter()
+        error = None
+        try:
+            with span(observer, "other"):
+                total = None
+                if measure is not None and observer.needs_total:
+                    with span(observer, "measure"):
+                        total = measure()
+                observer.start(name, total)
+                yield
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            observer.finish(name, time.perf_counter() - start, error)
+
+    def _archiver_reading(self, content: dict) -> Archiver:
+        if not content:
+            return self.archiver
+        archiver = reader_for(content, workers=self.archiver.workers, extract_workers=self.archiver.extract_workers,
+                              preallocate=self.archiver.preallocate, fsync=self.archiver.fsync)
+        if type(archiver) is type(self.archiver):
+            return self.archiver
+        archiver.observer = self.archiver.observer
+        return archiver
+
+    def _reading(self, file: str, password: str) -> "Locker":
+        # This locker, or a copy of it reading with the archiver file needs
+        archiver = self.archiver_for(file, password)
+        if archiver is self.archiver:
+            return self
+        locker = copy.copy(self)
+        locker.archiver = archiver
+        return locker
+
+    @contextmanager
+    def _open_locked(self, file: str, password: str, seekable: bool = False):
+        # With seekable=True, split and legacy files, whose readers only go
+        # forward, are decrypted to an anonymous temporary file next to file
+        with self._open_container(file, password) as reader, Metered(reader, self.observer, "decrypt") as metered:
+            if not seekable or reader.seekable():
+                yield io.BufferedReader(metered, self.crypto.chunk_size)
+                return
+            with tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(file))) as spool:
+                shutil.copyfileobj(metered, spool, block_size(file))
+                spool.seek(0)
+                yield spool
+
+    @contextmanager
+    def _open_container(self, file: str, password: str):
+        # A DecryptingReader for file, or a VolumeReader when it is the first volume of a split file
+        encrypted_archive = volume_base(file)
+        if encrypted_archive is not None:
+            with span(self.observer, "kdf"):
+                reader = VolumeReader(self.crypto, password.encode(), encrypted_archive)
+            with reader:
+                yield reader
+            return
+        with open_stream(file) as in_file:
+            with span(self.observer, "kdf"):
+                reader = self.crypto.open_reader(password.encode(), in_file)
+            with reader:
+                yield reader
+
+    def _locked_size(self, file: str) -> int:
+        encrypted_archive = volume_base(file)
+        if encrypted_archive is None:
+            return os.path.getsize(file)
+        return sum(os.path.getsize(path) for path in list_volumes(encrypted_archive))
+
+    def _locked_path(self, folder: str, out_folder: str) -> str:
+        if not out_folder:
+            out_folder = os.path.dirname(folder)
+        return os.path.join(out_folder, os.path.basename(folder + self.archiver.extension) + ".enc")
+
+    def _resumed_salt(self, encrypted_archive: str) -> bytes:
+        # KDF salt of the partial file _lock_pipelined would resume, if any
+        partial_file = encrypted_archive + PARTIAL_SUFFIX
+        if not (self.checkpoint_bytes and self.pipelined and self.archiver.streamable and not self.volume_size
+                and os.path.exists(partial_file) and os.path.exists(encrypted_archive + JOURNAL_SUFFIX)):
+            return None
+        try:
+            header = FileCrypto.read_header(partial_file)
+        except (OSError, ValueError):
+            return None
+        return bytes.fromhex(header["salt"]) if header else None
+
+    def _lock_pipelined(self, folder: str, password: str, encrypted_archive: str) -> None:
+        # Written under a temporary name and renamed into place once complete. A
+        # lock that dies after a checkpoint leaves that file and its journal behind,
+        # and the next lock of the same folder resumes from the last checkpoint.
+        partial_file = encrypted_archive + PARTIAL_SUFFIX
+        journal = Journal(encrypted_archive + JOURNAL_SUFFIX)
+        info = {"operation": "lock", "source": os.path.abspath(folder), "archiver": type(self.archiver).__name__,
+                "codec": self.archiver.codec}
+        state = journal.load(info) if self.checkpoint_bytes and os.path.exists(partial_file) else None
+        try:
+            try:
+                self._write_locked(folder, password, partial_file, journal, info, state)
+            except (TreeChanged, InvalidPassword, ResumeMismatch):
+                if state is None:
+                    raise
+                # The folder changed, its content did past the checkpoint, or the password differs: start over
+                self._write_locked(folder, password, partial_file, journal, info, None)
+        except BaseException:
+            if journal.load(info) is None and os.path.exists(partial_file):
+                os.remove(partial_file)
+            raise
+        with span(self.observer, "finalize"):
+            os.replace(partial_file, encrypted_archive)
+            journal.remove()
+
+    def _write_locked(self, folder: str, password: str, partial_file: str, journal: Journal, info: dict,
+                      state: dict) -> None:
+        if state is None:
+            journal.remove()
+        with open_stream(partial_file, "r+b" if state else "wb") as out_file:
+            with span(self.observer, "kdf"):
+                writer = self.crypto.open_writer(password.encode(), out_file,
+                                                 resume_at=state["records"] if state else None,
+                                                 metadata=self.archiver.describe())
+            with writer, Metered(writer, self.observer, "encrypt", progress=False) as metered, \
+                    span(self.observer, "archive"):
+                sink = CheckpointedSink(metered, writer, out_file, journal, self.checkpoint_bytes, info, state,
+                                        skip_content=not self.archiver.codec)
+                _hooked(self.archiver, sink.entries).archive_to(folder, sink)
+                sink.finish()
+            with span(self.observer, "finalize"):
+                out_file.flush()
+                os.fsync(out_file.fileno())
+
+    def _lock_volumes(self, folder: str, password: str, encrypted_archive: str) -> list:
+        # Volumes are written under temporary names and renamed once all are complete
+        with VolumeWriter(self.crypto, password.encode(), encrypted_archive, self.volume_size,
+                          self.archiver.describe(), PARTIAL_SUFFIX) as writer, \
+                Metered(writer, self.observer, "encrypt", progress=False) as metered, span(self.observer, "archive"):
+            self.archiver.archive_to(folder, metered)
+        volumes = [path[:-len(PARTIAL_SUFFIX)] for path in writer.paths]
+        with span(self.observer, "finalize"):
+            for partial_file, path in zip(writer.paths, volumes):
+                os.replace(partial_file, path)
+        return volumes
+
+    def _lock_with_temp_file(self, folder: str, password: str, out_folder: str) -> list:
+        # Returns the volumes written, or no volumes for an unsplit file
+        archive_out_path = folder + self.archiver.extension
+        existed = os.path.exists(archive_out_path)
+        try:
+            with span(self.observer, "archive"):
+                archive_out_path = self.archiver.archive(folder)
+            with span(self.observer, "encrypt"):
+                if self.volume_size:
+                    volumes = encrypt_volumes(self.crypto, password.encode(), archive_out_path, out_folder,
+                                              self.volume_size, self.archiver.describe())
+                else:
+                    # The temporary archive is this lock's own, so it can be mapped
+                    self.crypto.encrypt_file(password.encode(), archive_out_path, out_folder,
+                                             metadata=self.archiver.describe(), map_input=True)
+                    volumes = []
+        finally:
+            # The plaintext archive never outlives the lock, even a failed one
+            if not existed and os.path.exists(archive_out_path):
+                os.remove(archive_out_path)
+        return volumes
+
+    def _unlock_pipelined(self, file: str, password: str, out_folder: str, journal: Journal, info: dict,
+                          state: dict) -> None:
+        with self._open_locked(file, password, self.archiver.random_access) as reader, \
+                span(self.observer, "extract"):
+            # Resuming seeks back into the archive, which split and legacy files can't
+            if not (self.checkpoint_bytes and self.archiver.resumable and reader.seekable()):
+                self.archiver.unarchive_from(reader, out_folder)
+                return
+
+            last = [state["offset"] if state else 0]
+
+            def checkpoint(offset, sync):
+                if offset - last[0] >= self.checkpoint_bytes:
+                    sync()
+                    journal.save(dict(info, offset=offset))
+                    last[0] = offset
+
+            self.archiver.unarchive_from(reader, out_folder, start=last[0], checkpoint=checkpoint)
+
+    def _unlock_with_temp_file(self, file: str, password: str, out_folder: str) -> None:
+        with span(self.observer, "decrypt"):
+            if volume_base(file) is not None:
+                decrypted_archive = decrypt_volumes(self.crypto, password.encode(), volume_base(file))
+            else:
+                decrypted_archive = self.crypto.decrypt_file(password.encode(), file)
+        try:
+            self.observer.progress(bytes=os.path.getsize(decrypted_archive))
+            with span(self.observer, "extract"):
+                self.archiver.unarchive(decrypted_archive, out_folder)
+        finally:
+            os.remove(decrypted_archive)
+
+    def _deltas(self, encrypted_archive: str) -> list:
+        deltas = glob.glob(glob.escape(encrypted_archive + DELTA_SUFFIX) + "[0-9]*")
+        return sorted(deltas, key=lambda path: int(path[len(encrypted_archive + DELTA_SUFFIX):]))
+
+    def _base_session(self, encrypted_archive: str) -> FileCrypto:
+        # A copy of self.crypto writing under the KDF salt of the locked file at
+        # encrypted_archive (or its first volume), so the key cache derives one
+        # key for it, its deltas and its manifest
+        crypto = copy.copy(self.crypto)
+        base = encrypted_archive if os.path.exists(encrypted_archive) else volume_path(encrypted_archive, 0)
+        header = FileCrypto.read_header(base)
+        if header is not None and header["kdf"] == crypto.kdf:
+            crypto.session_salt = bytes.fromhex(header["salt"])
+        return crypto
+
+    def _lock_delta(self, folder: str, password: str, encrypted_archive: str) -> str:
+        manifest_file = encrypted_archive + MANIFEST_SUFFIX
+        crypto = self._base_session(encrypted_archive)
+        with span(self.observer, "manifest"):
+            old = read_manifest(crypto, password.encode(), manifest_file)
+            new = build_manifest(folder, crypto, old, self.hash_cache, self.archiver.follow_symlinks)
+        added, modified, deleted = diff_manifests(old, new)
+        if not (added or modified or deleted):
+            return encrypted_archive
+
+        deltas = self._deltas(encrypted_archive)
+        sequence = int(deltas[-1][len(encrypted_archive + DELTA_SUFFIX):]) + 1 if deltas else 1
+        delta_file = f"{encrypted_archive}{DELTA_SUFFIX}{sequence:04d}"
+        # Deltas are tar streams whatever the archiver, imported only when there is one
+        import tarfile
+        try:
+            with span(self.observer, "delta"), open_stream(delta_file, "wb") as out_file, \
+                    crypto.open_writer(password.encode(), out_file) as writer, \
+                    tarfile.open(fileobj=writer, mode="w|", dereference=self.archiver.follow_symlinks) as tar:
+                # Deletions go first so a path replaced by another type is cleared before
+                # extraction; directories that stay directories only get their mode reapplied
+                replaced = [path for path in modified if not old[path]["type"] == new[path]["type"] == "dir"]
+                removed = json.dumps([self.archiver.arcname(folder, path) for path in deleted + replaced]).encode()
+                info = tarfile.TarInfo(DELETED_MEMBER)
+                info.size = len(removed)
+                tar.addfile(info, io.BytesIO(removed))
+                for path in added + modified:
+                    tar.add(os.path.join(folder, path), arcname=self.archiver.arcname(folder, path), recursive=False)
+        except BaseException:
+            if os.path.exists(delta_file):
+                os.remove(delta_file)
+            raise
+
+        with span(self.observer, "manifest"):
+            write_manifest(crypto, password.encode(), new, manifest_file)
+        return delta_file
+
+    def _apply_delta(self, delta_file: str, password: str, out_folder: str) -> None:
+        import shutil
+        import tarfile
+        root = os.path.realpath(out_folder)
+        with open_stream(delta_file) as in_file, \
+                self.crypto.open_reader(password.encode(), in_file) as reader, \
+                tarfile.open(fileobj=io.BufferedReader(reader, self.crypto.chunk_size), mode="r|") as tar:
+            for member in tar:
+                if member.name != DELETED_MEMBER:
+                    tar.extract(member, out_folder, filter="data")
+                    continue
+
+                # Deepest paths first so directories are empty by the time they are removed
+                for name in sorted(json.load(tar.extractfile(member)), reverse=True):
+                    path = os.path.realpath(os.path.join(root, name))
+                    if os.path.commonpath([root, path]) != root:
+                        raise ValueError(f"Refusing to delete {name!r} outside {out_folder}")
+                    if os.path.isdir(path) and not os.path.islink(path):
+                        shutil.rmtree(path)
+                    elif os.path.lexists(path):
+                        os.remove(path)
+
+
+class _QueueWriter(io.RawIOBase):
+    # Sink putting a copy of each write on a bounded queue (writers reuse their
+    # buffers); once cancelled, writes fail as if the reader had gone away
+    def __init__(self, chunks: queue.Queue, cancelled: threading.Event):
+        super().__init__()
+        self._chunks = chunks
+        self._cancelled = cancelled
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        chunk = bytes(data)
+        if not _put(self._chunks, chunk, self._cancelled):
+            raise BrokenPipeError("The stream was closed by its reader")
+        return len(chunk)
+
+
+class _ChunkReader(io.RawIOBase):
+    # Readable file over an iterable of bytes chunks
+    def __init__(self, chunks):
+        super().__init__()
+        self._chunks = iter(chunks)
+        self._pending = memoryview(b"")
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        while not self._pending:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return 0
+            self._pending = memoryview(chunk).cast("B")
+        size = min(len(b), len(self._pending))
+        b[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+
+def _put(chunks: queue.Queue, item, cancelled: threading.Event) -> bool:
+    # Puts item on chunks unless cancelled first; returns whether it was put
+    while not cancelled.is_set():
+        try:
+            chunks.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _unlock_journal(file: str, out_folder: str) -> Journal:
+    # Kept out of out_folder, which only gets what was locked, and named after
+    # both paths, so unlocks of one file into different folders don't share it
+    key = hashlib.sha256(f"{os.path.abspath(file)}\0{os.path.abspath(out_folder)}".encode()).hexdigest()[:16]
+    return Journal(os.path.join(tempfile.gettempdir(), f".{os.path.basename(file)}-{key}{JOURNAL_SUFFIX}"))
+
+
+def _hooked(archiver: Archiver, hook) -> Archiver:
+    # Copy of archiver passing its scanned entries through hook, after any hook it already has
+    archiver = copy.copy(archiver)
+    previous = archiver.scan_hook
+    archiver.scan_hook = hook if previous is None else lambda entries: hook(previous(entries))
+    return archiver
+
+
+def _timed(task, item) -> BatchResult:
+    start = time.perf_counter()
+    try:
+        output, error = task(item), None
+    except Exception as e:
+        output, error = None, e
+    return BatchResult(item, output, error, time.perf_counter() - start)
+
 
+def _run_batch(task, items, workers: int = None):
+    # Yields the BatchResult of task(item) for every item in completion order.
+    # Items not started yet are cancelled if the consumer stops early.
+    pool = ThreadPoolExecutor(workers or os.cpu_count() or 1)
+    try:
+        futures = [pool.submit(_timed, task, item) for item in items]
+        for future in as_completed(futures):
+            yield future.result()
+    finally:
+        pool.shutdown(cancel_futures=True)
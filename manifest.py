@@ -0,0 +1,201 @@
+import io
+import os
+import json
+import time
+import fnmatch
+import hashlib
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from crypto import FileCrypto
+from hashcache import HashCache, hash_files
+from scanner import ScanEntry, scan_tree
+
+
+# A manifest maps every path under a locked folder, relative to it, to its
+# type ("file", "dir", "symlink" or "other"), size, mtime_ns and mode, plus the
+# SHA-256 of its content for files and the target of symlinks. It is kept, encrypted, next to the locked
+# file, so listing one decrypts the manifest instead of the archive.
+MANIFEST_VERSION = 1
+# Entry returned by list_manifest; hash is None for all but files
+Listing = namedtuple("Listing", "path type size mtime_ns mode hash")
+# Chunks read by the archiver that may wait for ManifestRecorder's hashing thread
+HASH_PENDING = 16
+
+
+def manifest_entry(entry: ScanEntry) -> dict:
+    stat = entry.stat
+    record = {"type": entry.type, "size": stat.st_size if entry.type == "file" else 0,
+              "mtime_ns": stat.st_mtime_ns, "mode": stat.st_mode & 0o7777}
+    if entry.type == "symlink":
+        record["target"] = os.readlink(entry.path)
+    return record
+
+
+def build_manifest(folder: str, crypto: FileCrypto, previous: dict = None, cache: HashCache = None,
+                   follow_symlinks: bool = False) -> dict:
+    # The manifest of folder. Hashes from previous are reused for files whose
+    # size and mtime did not change, and from cache for files it knows
+    # unchanged, so only touched files are read; those are hashed in parallel.
+    # follow_symlinks has to match the archiver's (see Archiver.follow_symlinks)
+    # for the manifest to compare equal to the one recorded at lock time.
+    previous = previous or {}
+    entries = {}
+    files = {}
+    for entry in scan_tree(folder, follow_symlinks=follow_symlinks, prefetch_size=0):
+        if entry.relpath == ".":
+            continue
+        record = manifest_entry(entry)
+        if entry.type == "file":
+            old = previous.get(entry.relpath)
+            if old and old.get("size") == record["size"] and old.get("mtime_ns") == record["mtime_ns"]:
+                record["hash"] = old["hash"]
+            else:
+                files[entry.relpath] = entry
+        entries[entry.relpath] = record
+    digests = hash_files(crypto, {entry.path: entry.stat for entry in files.values()}, cache=cache)
+    for relpath, entry in files.items():
+        entries[relpath]["hash"] = digests[entry.path]
+    return entries
+
+
+class ManifestRecorder:
+    # Archiver scan hook building the manifest of the tree the archiver reads.
+    # File contents are hashed as the archiver reads them (streamed ones on a
+    # thread of their own), so a lock doesn't read the tree a second time. Files whose
+    # content the archiver didn't read in full (a resumed lock skips some) are
+    # hashed from disk by result(). Hashes go to and come from cache, if given.
+    # complete is False until the archiver has walked the whole tree;
+    # archivers that don't scan never set it.
+    def __init__(self, crypto: FileCrypto, cache: HashCache = None):
+        self.crypto = crypto
+        self.cache = cache
+        self.complete = False
+        self._started_ns = time.time_ns()
+        self._entries = {}
+        self._files = {}
+        self._pool = ThreadPoolExecutor(1)
+        self._pending = deque()
+
+    def entries(self, entries):
+        for entry in entries:
+            if entry.relpath == ".":
+                yield entry
+                continue
+            self._entries[entry.relpath] = manifest_entry(entry)
+            if entry.type == "file":
+                self._files[entry.relpath] = entry
+                if entry.data is not None:
+                    # Prefetched files are small, not worth a trip to the thread
+                    self._store(entry.relpath, hashlib.sha256(entry.data), len(entry.data))
+                else:
+                    entry = _HashedEntry(entry.name, entry.path, entry.relpath, entry.type, entry.stat)
+                    entry.recorder = self
+            yield entry
+        self.complete = True
+
+    def result(self) -> dict:
+        self._pool.shutdown()
+        for future in self._pending:
+            future.result()
+        missing = {relpath: entry for relpath, entry in self._files.items()
+                   if "hash" not in self._entries[relpath]}
+        if self.cache is not None:
+            self.cache.store({entry.path: entry.stat for entry in self._files.values()},
+                             {entry.path: self._entries[relpath]["hash"] for relpath, entry in self._files.items()
+                              if relpath not in missing}, started_ns=self._started_ns)
+        digests = hash_files(self.crypto, {entry.path: entry.stat for entry in missing.values()}, cache=self.cache)
+        for relpath, entry in missing.items():
+            self._entries[relpath]["hash"] = digests[entry.path]
+        return self._entries
+
+    def _submit(self, fn, *args):
+        while len(self._pending) >= HASH_PENDING:
+            self._pending.popleft().result()
+        self._pending.append(self._pool.submit(fn, *args))
+
+    def _store(self, relpath: str, sha256, size: int):
+        record = self._entries[relpath]
+        if size == record["size"]:
+            record["hash"] = sha256.hexdigest()
+
+
+class _HashedEntry(ScanEntry):
+    __slots__ = ("recorder",)
+
+    def open(self):
+        return _HashingReader(super().open(), self.recorder, self.relpath)
+
+
+class _HashingReader(io.RawIOBase):
+    # Passes reads through, handing a copy of each chunk to the recorder's
+    # hashing thread; the hash counts once the file has been read to its size
+    def __init__(self, fileobj, recorder: ManifestRecorder, relpath: str):
+        super().__init__()
+        self._fileobj = fileobj
+        self._recorder = recorder
+        self._relpath = relpath
+        self._sha256 = hashlib.sha256()
+        self._size = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._fileobj.read(size)
+        self._hash(data)
+        return data
+
+    def readinto(self, b) -> int:
+        size = self._fileobj.readinto(b)
+        if size:
+            # The caller reuses b
+            self._hash(bytes(memoryview(b)[:size]))
+        return size
+
+    def close(self):
+        if not self.closed:
+            self._fileobj.close()
+            self._recorder._submit(self._recorder._store, self._relpath, self._sha256, self._size)
+        super().close()
+
+    def _hash(self, data):
+        if data:
+            self._size += len(data)
+            self._recorder._submit(self._sha256.update, data)
+
+
+def diff_manifests(old: dict, new: dict):
+    # Returns (added, modified, deleted) lists of relative paths. A path is
+    # modified when its type, content, link target or mode changed.
+    added = [path for path in new if path not in old]
+    deleted = [path for path in old if path not in new]
+    modified = [
+        path for path, entry in new.items()
+        if path in old and any(entry.get(key) != old[path].get(key) for key in ("type", "hash", "target", "mode"))
+    ]
+    return sorted(added), sorted(modified), sorted(deleted)
+
+
+def write_manifest(crypto: FileCrypto, password: bytes, entries: dict, filename: str) -> None:
+    data = json.dumps({"version": MANIFEST_VERSION, "entries": entries}).encode()
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, "wb") as out_file, crypto.open_writer(password, out_file) as writer:
+        writer.write(data)
+    os.replace(tmp_filename, filename)
+
+
+def read_manifest(crypto: FileCrypto, password: bytes, filename: str) -> dict:
+    with open(filename, "rb") as in_file, crypto.open_reader(password, in_file) as reader:
+        manifest = json.loads(reader.read())
+    if manifest.get("version") != MANIFEST_VERSION:
+        raise ValueError(f"Unsupported manifest version {manifest.get('version')}")
+    return manifest["entries"]
+
+
+def list_manifest(entries: dict, pattern: str = None) -> list:
+    # Listing of every entry, sorted by path; pattern (an fnmatch pattern) keeps
+    # only the paths matching it
+    return [Listing(path, record["type"], record.get("size", 0), record.get("mtime_ns"), record.get("mode"),
+                    record.get("hash"))
+            for path, record in sorted(entries.items())
+            if pattern is None or fnmatch.fnmatch(path, pattern)]
@@ -0,0 +1,127 @@
+import io
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from fileio import open_stream, release
+
+
+# Files up to this size are read ahead on the worker pool
+PREFETCH_SIZE = 1024 * 1024
+# Upper bound on prefetched bytes and entries held ahead of the consumer
+WINDOW_BYTES = 64 * 1024 * 1024
+WINDOW_ENTRIES = 4096
+
+
+class ScanEntry:
+    # One entry of a scanned tree. type is "dir", "file", "symlink" or "other";
+    # relpath is relative to the scanned root, which itself is ".".
+    __slots__ = ("name", "path", "relpath", "type", "stat", "data", "_future")
+
+    def __init__(self, name: str, path: str, relpath: str, type: str, stat: os.stat_result):
+        self.name = name
+        self.path = path
+        self.relpath = relpath
+        self.type = type
+        self.stat = stat
+        # File contents when they were prefetched, otherwise None
+        self.data = None
+        self._future = None
+
+    def open(self):
+        if self.data is not None:
+            return io.BytesIO(self.data)
+        return open_stream(self.path)
+
+
+def _read_file(path: str) -> bytes:
+    with open(path, "rb") as fp:
+        data = fp.read()
+        release(fp)
+        return data
+
+
+def _list_dir(path: str, relpath: str, follow_symlinks: bool) -> list:
+    # Children of path sorted by name, with their stat results
+    children = []
+    with os.scandir(path) as it:
+        for dirent in it:
+            child_relpath = dirent.name if relpath == "." else os.path.join(relpath, dirent.name)
+            if dirent.is_dir(follow_symlinks=False):
+                type = "dir"
+            elif dirent.is_symlink():
+                # Like os.walk, symlinks to directories are never descended into
+                if not follow_symlinks:
+                    type = "symlink"
+                elif dirent.is_file():
+                    type = "file"
+                else:
+                    continue
+            elif dirent.is_file(follow_symlinks=False):
+                type = "file"
+            else:
+                type = "other"
+            stat = dirent.stat(follow_symlinks=follow_symlinks and type == "file")
+            children.append(ScanEntry(dirent.name, dirent.path, child_relpath, type, stat))
+    children.sort(key=lambda entry: entry.name)
+    return children
+
+
+def _walk(pool: ThreadPoolExecutor, src: str, follow_symlinks: bool):
+    # Depth-first, pre-order, children sorted by name (the order tar.add uses).
+    # Each directory's subdirectories are listed on the pool as soon as the
+    # directory itself is reached, so listings overlap with the consumer.
+    root = ScanEntry(os.path.basename(src), src, ".", "dir", os.stat(src))
+    yield root
+    listings = {src: pool.submit(_list_dir, src, ".", follow_symlinks)}
+    stack = []
+
+    def descend(entry):
+        children = listings.pop(entry.path).result()
+        for child in children:
+            if child.type == "dir":
+                listings[child.path] = pool.submit(_list_dir, child.path, child.relpath, follow_symlinks)
+        stack.append(iter(children))
+
+    descend(root)
+    while stack:
+        entry = next(stack[-1], None)
+        if entry is None:
+            stack.pop()
+            continue
+        yield entry
+        if entry.type == "dir":
+            descend(entry)
+
+
+def scan_tree(src: str, workers: int = 8, follow_symlinks: bool = False, prefetch_size: int = PREFETCH_SIZE):
+    # Yields a ScanEntry for src and everything under it, in a deterministic order.
+    # Directory listings, stats and the contents of small files are fetched on a
+    # thread pool ahead of the consumer, which hides per-file latency on network
+    # filesystems and trees with many small files. With follow_symlinks, symlinks
+    # to files are reported as files (like os.walk + open) and others are skipped.
+    pool = ThreadPoolExecutor(max(workers, 1))
+    try:
+        window = deque()
+        window_bytes = 0
+        for entry in _walk(pool, src, follow_symlinks):
+            if entry.type == "file" and entry.stat.st_size <= prefetch_size:
+                entry._future = pool.submit(_read_file, entry.path)
+                window_bytes += entry.stat.st_size
+            window.append(entry)
+
+            while window and (window_bytes > WINDOW_BYTES or len(window) > WINDOW_ENTRIES):
+                ready = window.popleft()
+                window_bytes -= ready.stat.st_size if ready._future else 0
+                yield _resolve(ready)
+
+        while window:
+            yield _resolve(window.popleft())
+    finally:
+        pool.shutdown(cancel_futures=True)
+
+
+def _resolve(entry: ScanEntry) -> ScanEntry:
+    if entry._future is not None:
+        entry.data = entry._future.result()
+        entry._future = None
+    return entry
@@ -1,10 +1,38 @@
 
+import io
+import json
 import time
+import base64
+import hashlib
+import pickle
 import unittest
+import subprocess
+import sys
+import importlib.util
+from unittest import mock
 from archiver import get_archiver
+import glob
 import shutil
-from crypto import FileCrypto, Crypto
-from locker import Locker
+import socket
+import tarfile
+import tempfile
+from crypto import FileCrypto, Crypto, EncryptingWriter, DecryptingReader, KeyCache, InvalidPassword, derive_key
+from locker import Locker, _unlock_journal
+from scanner import scan_tree
+from compression import entropy, should_compress
+import benchmark
+import cli
+import contextlib
+import asyncio
+from async_locker import AsyncLocker
+from instrument import Profiler, ProgressTracker
+import dedup
+from dedup import ChunkStore, Chunker
+from volumes import VolumeReader, VolumeWriter, list_volumes, volume_path
+import fileio
+from hashcache import HashCache, hash_files, hash_tree
+from manifest import build_manifest, read_manifest
+from archiver import TarfileArchiver, PickleArchiver, _FileWriter, ARCHIVERS, register_archiver, available_archivers
 import os
 
 
@@ -36,6 +64,1415 @@ class TestCrypto(unittest.TestCase):
         os.remove(encrypted_file)
         os.remove("test.txt")
 
+    def test_encrypt_decrypt_stream_chunks(self):
+        data = os.urandom(10 * 1024 + 7)
+        password = "password".encode()
+        for size in (0, 1024, len(data)):
+            out = io.BytesIO()
+            Crypto.encrypt_stream(password, io.BytesIO(data[:size]), out, chunk_size=1024)
+            decrypted = io.BytesIO()
+            Crypto.decrypt_stream(password, io.BytesIO(out.getvalue()), decrypted)
+            self.assertEqual(data[:size], decrypted.getvalue())
+
+    def test_parallel_engine_matches_serial(self):
+        data = os.urandom(50 * 1024 + 11)
+        password = "password".encode()
+        for encrypt_workers, decrypt_workers in ((4, 1), (1, 4), (3, 3)):
+            out = io.BytesIO()
+            with EncryptingWriter(password, out, 1024, encrypt_workers) as writer:
+                writer.write(data)
+            with DecryptingReader(password, io.BytesIO(out.getvalue()), decrypt_workers) as reader:
+                self.assertEqual(data, reader.read())
+
+    def test_writes_spanning_records(self):
+        data = os.urandom(10 * 1024 + 5)
+        password = "password".encode()
+        for workers in (1, 3):
+            out = io.BytesIO()
+            with EncryptingWriter(password, out, 1024, workers, kdf=FAST_KDF) as writer:
+                offset = 0
+                for size in (1, 1023, 1024, 3000, 0, 17, 10 * 1024):
+                    writer.write(memoryview(data)[offset:offset + size])
+                    offset += size
+            with DecryptingReader(password, io.BytesIO(out.getvalue()), workers) as reader:
+                self.assertEqual(data, reader.read())
+
+    def test_file_roundtrip_and_hash(self):
+        crypto = FileCrypto(chunk_size=1024, kdf=FAST_KDF)
+        password = "password".encode()
+        for data in (b"", os.urandom(5000)):
+            with open("mapped.bin", "wb") as f:
+                f.write(data)
+            with mock.patch("mmap.mmap", side_effect=AssertionError("source file mapped")):
+                # Source files may be truncated while they are read, so only the locker's own are mapped
+                self.assertEqual(hashlib.sha256(data).hexdigest(), crypto.hash_file("mapped.bin"))
+                os.remove(crypto.encrypt_file(password, "mapped.bin", "."))
+            encrypted_file = crypto.encrypt_file(password, "mapped.bin", ".", map_input=True)
+            os.remove("mapped.bin")
+            crypto.decrypt_file(password, encrypted_file)
+            with open("mapped.bin", "rb") as f:
+                self.assertEqual(data, f.read())
+            os.remove(encrypted_file)
+            os.remove("mapped.bin")
+
+    def test_kdf_parameters_are_read_from_header(self):
+        password = "password".encode()
+        for kdf in ({"name": "pbkdf2", "iterations": 1000, "hash": "sha256"},
+                    {"name": "scrypt", "n": 2 ** 10, "r": 8, "p": 1}):
+            out = io.BytesIO()
+            with EncryptingWriter(password, out, kdf=kdf) as writer:
+                writer.write(b"hello world")
+            with DecryptingReader(password, io.BytesIO(out.getvalue())) as reader:
+                self.assertEqual(b"hello world", reader.read())
+
+    def test_kdf_parameters_from_header_are_bounded(self):
+        out = io.BytesIO()
+        with EncryptingWriter(b"password", out, kdf=FAST_KDF) as writer:
+            writer.write(b"hello world")
+        data = out.getvalue()
+        start = len(b"LOCKER") + 1 + 4
+        length = int.from_bytes(data[start - 4:start], "big")
+        header = json.loads(data[start:start + length])
+        # Refused before any key derivation, so none of these hang or run out of memory
+        for kdf in ({"name": "pbkdf2", "iterations": 10 ** 12}, {"name": "pbkdf2", "iterations": "1000"},
+                    {"name": "pbkdf2", "iterations": 1000, "hash": "md4"}, {"name": "argon2"}, {},
+                    {"name": "scrypt", "n": 2 ** 40, "r": 8, "p": 1}, {"name": "scrypt", "n": 1000, "r": 8, "p": 1},
+                    {"name": "scrypt", "n": 2 ** 20, "r": 1024, "p": 1},
+                    {"name": "scrypt", "n": 2 ** 14, "r": 8, "p": 2 ** 20}):
+            tampered = json.dumps(dict(header, kdf=kdf)).encode()
+            with mock.patch("crypto.PBKDF2") as pbkdf2, mock.patch("crypto.scrypt") as scrypt:
+                with self.assertRaises(ValueError) as raised:
+                    DecryptingReader(b"password", io.BytesIO(data[:start - 4] + len(tampered).to_bytes(4, "big")
+                                                             + tampered + data[start + length:]))
+            self.assertNotIsInstance(raised.exception, InvalidPassword)
+            pbkdf2.assert_not_called()
+            scrypt.assert_not_called()
+
+    def test_session_salt_derives_key_once(self):
+        cache = KeyCache()
+        crypto = FileCrypto(kdf={"name": "pbkdf2", "iterations": 1000}, key_cache=cache)
+        crypto.new_session()
+        password = "password".encode()
+        outputs = []
+        for data in (b"first", b"second"):
+            out = io.BytesIO()
+            with crypto.open_writer(password, out) as writer:
+                writer.write(data)
+            outputs.append(out.getvalue())
+        self.assertEqual(1, len(cache))
+        self.assertNotEqual(outputs[0][:200], outputs[1][:200])
+
+        for data, encrypted in zip((b"first", b"second"), outputs):
+            with crypto.open_reader(password, io.BytesIO(encrypted)) as reader:
+                self.assertEqual(data, reader.read())
+        self.assertEqual(1, len(cache))
+
+    def test_key_cache_eviction(self):
+        kdf = {"name": "pbkdf2", "iterations": 10}
+        cache = KeyCache(max_size=2)
+        for salt in (b"a" * 16, b"b" * 16, b"c" * 16):
+            cache.derive(b"password", salt, kdf)
+        self.assertEqual(2, len(cache))
+
+        cache = KeyCache(ttl=0)
+        cache.derive(b"password", b"a" * 16, kdf)
+        cache.derive(b"password", b"b" * 16, kdf)
+        self.assertLessEqual(len(cache), 1)
+
+    def test_decrypt_stream_detects_truncation(self):
+        password = "password".encode()
+        out = io.BytesIO()
+        Crypto.encrypt_stream(password, io.BytesIO(os.urandom(4096)), out, chunk_size=1024)
+        # drop the final record, leaving a stream that ends on a record boundary
+        truncated = out.getvalue()[:-(1024 + 16)]
+        with self.assertRaises(ValueError):
+            Crypto.decrypt_stream(password, io.BytesIO(truncated), io.BytesIO())
+
+    def test_verify_checks_password_and_records(self):
+        password = "password".encode()
+        out = io.BytesIO()
+        with EncryptingWriter(password, out, 1024, kdf=FAST_KDF) as writer:
+            writer.write(os.urandom(5000))
+        encrypted = out.getvalue()
+        with DecryptingReader(password, io.BytesIO(encrypted)) as reader:
+            self.assertEqual(5000, reader.verify())
+
+        # rejected from the header alone, before any record is read
+        source = io.BytesIO(encrypted)
+        with self.assertRaises(InvalidPassword):
+            DecryptingReader("wrong".encode(), source)
+        self.assertLess(source.tell(), 1024)
+
+        damaged = bytearray(encrypted)
+        damaged[-100] ^= 1
+        for workers in (1, 3):
+            with DecryptingReader(password, io.BytesIO(bytes(damaged)), workers) as reader:
+                with self.assertRaises(ValueError):
+                    reader.verify()
+
+    def test_decrypt_legacy_file(self):
+        crypto = FileCrypto()
+        data = os.urandom(200 * 1024 + 3)
+        password = "password".encode()
+        with open("legacy.txt.enc", "wb") as f:
+            f.write(crypto.encrypt(password, data))
+
+        decrypted_file = crypto.decrypt_file(password, "legacy.txt.enc")
+        with open(decrypted_file, "rb") as f:
+            self.assertEqual(data, f.read())
+        os.remove("legacy.txt.enc")
+        os.remove(decrypted_file)
+
+
+# Cheap key derivation for tests that don't exercise the KDF itself
+FAST_KDF = {"name": "pbkdf2", "iterations": 1000}
+
+
+def make_tree(root: str) -> dict:
+    # small folder with a nested directory, returns {relative path: content}
+    files = {
+        "a.txt": b"hello world" * 100,
+        "empty.bin": b"",
+        os.path.join("sub", "b.bin"): os.urandom(300 * 1024),
+    }
+    for name, content in files.items():
+        path = os.path.join(root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(content)
+    return files
+
+
+def read_tree(root: str) -> dict:
+    files = {}
+    for dir, _, names in os.walk(root):
+        for name in names:
+            with open(os.path.join(dir, name), "rb") as f:
+                files[os.path.relpath(os.path.join(dir, name), root)] = f.read()
+    return files
+
+
+class TestPipelinedLocker(unittest.TestCase):
+    def setUp(self) -> None:
+        # pickle and json archives record paths relative to the working directory
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        self.folder = "pipelined"
+        self.files = make_tree(self.folder)
+
+    def tearDown(self) -> None:
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def test_pipelined_roundtrip(self):
+        for name in ("tarfile", "pickle", "json"):
+            locker = Locker(get_archiver(name), FileCrypto())
+            encrypted_file = locker.lock_folder(self.folder, "password", ".")
+            self.assertFalse(os.path.exists(self.folder + locker.archiver.extension))
+
+            out_folder = "out_" + name
+            locker.unlock_folder(encrypted_file, "password", out_folder)
+            self.assertEqual(self.files, read_tree(os.path.join(out_folder, self.folder)))
+            os.remove(encrypted_file)
+
+    def test_pipelined_output_unlocks_with_temp_file_path(self):
+        encrypted_file = Locker(get_archiver("tarfile"), FileCrypto()).lock_folder(
+            self.folder, "password", ".")
+        Locker(get_archiver("tarfile"), FileCrypto(), pipelined=False).unlock_folder(
+            encrypted_file, "password", "out")
+        self.assertEqual(self.files, read_tree(os.path.join("out", self.folder)))
+
+
+    def test_verify(self):
+        locker = Locker(get_archiver("tarfile"), FileCrypto(kdf=FAST_KDF))
+        encrypted_file = locker.lock_folder(self.folder, "password", ".")
+        before = sorted(os.listdir("."))
+        self.assertGreater(locker.verify(encrypted_file, "password"), 300 * 1024)
+        self.assertEqual(before, sorted(os.listdir(".")))
+        with self.assertRaises(InvalidPassword):
+            locker.verify(encrypted_file, "wrong")
+
+        with open(encrypted_file, "r+b") as f:
+            f.seek(-10, io.SEEK_END)
+            f.write(b"corruption")
+        results = list(locker.verify_many([encrypted_file], "password"))
+        self.assertIsInstance(results[0].error, ValueError)
+
+
+class TestIncrementalLocker(unittest.TestCase):
+    def setUp(self) -> None:
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        self.folder = "incremental"
+        self.files = make_tree(self.folder)
+        self.locker = Locker(get_archiver("tarfile"), FileCrypto(kdf=FAST_KDF))
+
+    def tearDown(self) -> None:
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def test_relock_writes_delta_of_changes(self):
+        encrypted_file = self.locker.lock_folder(self.folder, "password", ".", incremental=True)
+        self.assertEqual(encrypted_file, self.locker.lock_folder(self.folder, "password", ".", incremental=True))
+
+        with open(os.path.join(self.folder, "a.txt"), "wb") as f:
+            f.write(b"changed")
+        os.remove(os.path.join(self.folder, "sub", "b.bin"))
+        os.makedirs(os.path.join(self.folder, "new"))
+        with open(os.path.join(self.folder, "new", "c.txt"), "wb") as f:
+            f.write(b"added")
+        delta_file = self.locker.lock_folder(self.folder, "password", ".", incremental=True)
+        self.assertNotEqual(encrypted_file, delta_file)
+        self.assertLess(os.path.getsize(delta_file), os.path.getsize(encrypted_file))
+
+        os.remove(os.path.join(self.folder, "empty.bin"))
+        self.locker.lock_folder(self.folder, "password", ".", incremental=True)
+
+        self.locker.unlock_folder(encrypted_file, "password", "out")
+        self.assertEqual(read_tree(self.folder), read_tree(os.path.join("out", self.folder)))
+
+    def test_relock_detects_retargeted_links_and_modes(self):
+        os.symlink("a.txt", os.path.join(self.folder, "link"))
+        encrypted_file = self.locker.lock_folder(self.folder, "password", ".", incremental=True)
+        os.remove(os.path.join(self.folder, "link"))
+        os.symlink("empty.bin", os.path.join(self.folder, "link"))
+        self.assertNotEqual(encrypted_file, self.locker.lock_folder(self.folder, "password", ".", incremental=True))
+        os.chmod(os.path.join(self.folder, "a.txt"), 0o600)
+        os.chmod(os.path.join(self.folder, "sub"), 0o700)
+        self.assertNotEqual(encrypted_file, self.locker.lock_folder(self.folder, "password", ".", incremental=True))
+
+        self.locker.unlock_folder(encrypted_file, "password", "out")
+        restored = os.path.join("out", self.folder)
+        self.assertEqual("empty.bin", os.readlink(os.path.join(restored, "link")))
+        self.assertEqual(0o600, os.stat(os.path.join(restored, "a.txt")).st_mode & 0o777)
+        # The directory whose mode changed keeps its content (tar's data filter leaves directory modes alone)
+        self.assertEqual(read_tree(self.folder), read_tree(restored))
+
+    def test_unchanged_relock_with_symlinks_writes_no_delta(self):
+        # The manifest compared against follows symlinks as the archiver does
+        os.symlink("a.txt", os.path.join(self.folder, "relative"))
+        os.symlink(os.path.abspath(os.path.join(self.folder, "a.txt")), os.path.join(self.folder, "absolute"))
+        for name in ("pickle", "indexed", "zipfile", "tarfile"):
+            if name == "tarfile":
+                # tar keeps the links, and extracting refuses absolute ones
+                os.remove(os.path.join(self.folder, "absolute"))
+            locker = Locker(get_archiver(name), FileCrypto(kdf=FAST_KDF))
+            encrypted_file = locker.lock_folder(self.folder, "password", ".", incremental=True)
+            self.assertEqual(encrypted_file, locker.lock_folder(self.folder, "password", ".", incremental=True))
+            self.assertEqual([], glob.glob(encrypted_file + ".delta*"))
+            out = "out_" + name
+            locker.unlock_folder(encrypted_file, "password", out)
+            self.assertEqual(read_tree(self.folder), read_tree(os.path.join(out, self.folder) if name != "zipfile"
+                                                               else out))
+
+    def test_deltas_share_the_base_key(self):
+        # Deltas and the manifest are sealed under the base file's salt, so
+        # relocking and unlocking each run the KDF once
+        encrypted_file = self.locker.lock_folder(self.folder, "password", ".", incremental=True)
+        for content in (b"changed", b"changed again"):
+            with open(os.path.join(self.folder, "a.txt"), "wb") as f:
+                f.write(content)
+            locker = Locker(get_archiver("tarfile"), FileCrypto(kdf=FAST_KDF))
+            with mock.patch("crypto.derive_key", side_effect=derive_key) as derive:
+                delta_file = locker.lock_folder(self.folder, "password", ".", incremental=True)
+            self.assertNotEqual(encrypted_file, delta_file)
+            self.assertEqual(1, derive.call_count)
+            self.assertEqual(FileCrypto.read_header(encrypted_file)["salt"], FileCrypto.read_header(delta_file)["salt"])
+
+        locker = Locker(get_archiver("tarfile"), FileCrypto(kdf=FAST_KDF))
+        with mock.patch("crypto.derive_key", side_effect=derive_key) as derive:
+            locker.unlock_folder(encrypted_file, "password", "out")
+        self.assertEqual(1, derive.call_count)
+        self.assertEqual(read_tree(self.folder), read_tree(os.path.join("out", self.folder)))
+
+    def test_full_lock_discards_deltas(self):
+        encrypted_file = self.locker.lock_folder(self.folder, "password", ".", incremental=True)
+        with open(os.path.join(self.folder, "a.txt"), "wb") as f:
+            f.write(b"changed")
+        delta_file = self.locker.lock_folder(self.folder, "password", ".", incremental=True)
+        self.locker.lock_folder(self.folder, "password", ".")
+        self.assertFalse(os.path.exists(delta_file))
+        # The full lock's own manifest replaces the incremental one
+        listing = {entry.path: entry for entry in self.locker.list(encrypted_file, "password")}
+        self.assertEqual(len(b"changed"), listing["a.txt"].size)
+
+
+class TestRandomAccess(unittest.TestCase):
+    def setUp(self) -> None:
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        self.folder = "random"
+        self.files = make_tree(self.folder)
+        self.crypto = FileCrypto(chunk_size=4096, kdf=FAST_KDF)
+
+    def tearDown(self) -> None:
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def test_list_and_extract_members(self):
+        for name in ("indexed", "tarfile"):
+            locker = Locker(get_archiver(name), self.crypto)
+            encrypted_file = locker.lock_folder(self.folder, "password", ".")
+            members = {member.name: member for member in locker.list_members(encrypted_file, "password")}
+            self.assertEqual(300 * 1024, members["random/sub/b.bin"].size)
+            self.assertEqual("dir", members["random/sub"].type)
+
+            out_folder = "out_" + name
+            path = locker.extract_member(encrypted_file, "random/a.txt", "password", out_folder)
+            self.assertEqual({"a.txt": self.files["a.txt"]}, read_tree(os.path.dirname(path)))
+            locker.extract_member(encrypted_file, "random/sub", "password", out_folder)
+            self.assertEqual(set(self.files) - {"empty.bin"}, set(read_tree(os.path.join(out_folder, "random"))))
+            with self.assertRaises(KeyError):
+                locker.extract_member(encrypted_file, "random/missing", "password", out_folder)
+
+    def test_indexed_extract_only_decrypts_needed_records(self):
+        locker = Locker(get_archiver("indexed"), self.crypto)
+        encrypted_file = locker.lock_folder(self.folder, "password", ".")
+        # corrupt a record in the middle of sub/b.bin
+        with open(encrypted_file, "r+b") as f:
+            f.seek(os.path.getsize(encrypted_file) // 2)
+            byte = f.read(1)
+            f.seek(-1, io.SEEK_CUR)
+            f.write(bytes([byte[0] ^ 1]))
+
+        path = locker.extract_member(encrypted_file, "random/a.txt", "password", "out")
+        with open(path, "rb") as f:
+            self.assertEqual(self.files["a.txt"], f.read())
+        with self.assertRaises(ValueError):
+            locker.extract_member(encrypted_file, "random/sub/b.bin", "password", "out")
+
+    def test_indexed_roundtrip(self):
+        locker = Locker(get_archiver("indexed"), self.crypto)
+        encrypted_file = locker.lock_folder(self.folder, "password", ".")
+        locker.unlock_folder(encrypted_file, "password", "out")
+        self.assertEqual(self.files, read_tree(os.path.join("out", self.folder)))
+
+
+class TestScanner(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.folder = os.path.join(self.tmp.name, "scanned")
+        self.files = make_tree(self.folder)
+        os.symlink("a.txt", os.path.join(self.folder, "link"))
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+    def test_scan_order_and_prefetch(self):
+        entries = list(scan_tree(self.folder, workers=4, prefetch_size=1024 * 1024))
+        self.assertEqual([".", "a.txt", "empty.bin", "link", "sub", os.path.join("sub", "b.bin")],
+                         [entry.relpath for entry in entries])
+        self.assertEqual("symlink", entries[3].type)
+        for entry in entries:
+            if entry.type == "file":
+                self.assertEqual(self.files[entry.relpath], entry.data)
+
+        entries = {entry.relpath: entry for entry in scan_tree(self.folder, follow_symlinks=True, prefetch_size=0)}
+        self.assertEqual("file", entries["link"].type)
+        self.assertIsNone(entries["a.txt"].data)
+        with entries["link"].open() as f:
+            self.assertEqual(self.files["a.txt"], f.read())
+
+    def test_tar_archive_matches_tar_add(self):
+        # Sockets are skipped and later hard links stored as links to the first
+        os.link(os.path.join(self.folder, "a.txt"), os.path.join(self.folder, "sub", "hardlink"))
+        with socket.socket(socket.AF_UNIX) as sock:
+            sock.bind(os.path.join(self.folder, "socket"))
+        dst = os.path.join(self.tmp.name, "scanned.tar")
+        get_archiver("tarfile").archive(self.folder, dst)
+        with tarfile.open(dst) as tar:
+            members = {info.name: info for info in tar}
+        with tarfile.open(os.path.join(self.tmp.name, "expected.tar"), "x:") as tar:
+            tar.add(self.folder, arcname="scanned")
+        with tarfile.open(os.path.join(self.tmp.name, "expected.tar")) as tar:
+            for info in tar:
+                self.assertEqual(info.get_info(), members[info.name].get_info())
+        self.assertEqual(tarfile.LNKTYPE, members[os.path.join("scanned", "sub", "hardlink")].type)
+        self.assertNotIn(os.path.join("scanned", "socket"), members)
+
+
+class TestCompression(unittest.TestCase):
+    def setUp(self) -> None:
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        self.folder = "compressed"
+        self.files = make_tree(self.folder)
+        with open(os.path.join(self.folder, "log.txt"), "wb") as f:
+            f.write(b"INFO request handled in 12ms\n" * 20000)
+        self.files = read_tree(self.folder)
+
+    def tearDown(self) -> None:
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def test_entropy_sampling(self):
+        self.assertGreater(entropy(os.urandom(64 * 1024)), 7.9)
+        self.assertLess(entropy(b"\0" * 1024), 0.1)
+        self.assertFalse(should_compress(os.urandom(4096)))
+        self.assertFalse(should_compress(b"text" * 100, "photo.JPG"))
+        self.assertTrue(should_compress(b"text" * 100, "notes.txt"))
+
+    def test_codecs_are_imported_when_used(self):
+        code = ("import sys, compression; loaded = set(sys.modules); compression.compressor('lzma'); "
+                "print(sorted({'bz2', 'lzma', 'zstandard'} & loaded), 'lzma' in sys.modules)")
+        output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(benchmark.__file__))).stdout
+        self.assertEqual("[] True", output.strip())
+
+    def test_compressed_roundtrip(self):
+        crypto = FileCrypto(kdf=FAST_KDF)
+        for name in ("tarfile", "pickle", "json", "indexed", "zipfile", "shutil"):
+            plain = Locker(get_archiver(name), crypto).lock_folder(self.folder, "password", ".")
+            plain_size = os.path.getsize(plain)
+            os.remove(plain)
+
+            locker = Locker(get_archiver(name, codec="zlib", level=9), crypto)
+            encrypted_file = locker.lock_folder(self.folder, "password", ".")
+            self.assertLess(os.path.getsize(encrypted_file), plain_size - 400000, name)
+
+            out_folder = "out_" + name
+            locker.unlock_folder(encrypted_file, "password", out_folder)
+            root = out_folder if name in ("zipfile", "shutil") else os.path.join(out_folder, self.folder)
+            self.assertEqual(self.files, read_tree(root), name)
+            os.remove(encrypted_file)
+
+    def test_compressed_tar_members(self):
+        locker = Locker(get_archiver("tarfile", codec="lzma"), FileCrypto(kdf=FAST_KDF))
+        encrypted_file = locker.lock_folder(self.folder, "password", ".")
+        names = [member.name for member in locker.list_members(encrypted_file, "password")]
+        self.assertIn("compressed/log.txt", names)
+        path = locker.extract_member(encrypted_file, "compressed/log.txt", "password", "out")
+        with open(path, "rb") as f:
+            self.assertEqual(self.files["log.txt"], f.read())
+
+    def test_invalid_codec(self):
+        with self.assertRaises(ValueError):
+            get_archiver("tarfile", codec="rle")
+
+
+class TestRecordArchivers(unittest.TestCase):
+    def setUp(self) -> None:
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        self.folder = "records"
+        self.files = make_tree(self.folder)
+
+    def tearDown(self) -> None:
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def test_streaming_roundtrip_with_small_chunks(self):
+        for name in ("pickle", "json"):
+            archiver = get_archiver(name)
+            archiver.CHUNK_SIZE = 1000
+            archive = archiver.archive(self.folder)
+            archiver.unarchive(archive, "out_" + name)
+            self.assertEqual(self.files, read_tree(os.path.join("out_" + name, self.folder)))
+
+    def test_reads_single_object_archives(self):
+        structure = {self.folder: {"a.txt": b"hello"}, os.path.join(self.folder, "sub"): {"b.bin": b"\x00\x01"}}
+        with open("old.archive", "wb") as f:
+            pickle.dump(structure, f, pickle.HIGHEST_PROTOCOL)
+        with open("old.json", "w") as f:
+            json.dump({dir: {name: base64.b64encode(content).decode() for name, content in files.items()}
+                       for dir, files in structure.items()}, f)
+
+        expected = {"a.txt": b"hello", os.path.join("sub", "b.bin"): b"\x00\x01"}
+        get_archiver("pickle").unarchive("old.archive", "out_pickle")
+        self.assertEqual(expected, read_tree(os.path.join("out_pickle", self.folder)))
+        get_archiver("json").unarchive("old.json", "out_json")
+        self.assertEqual(expected, read_tree(os.path.join("out_json", self.folder)))
+
+    def test_truncated_json_archive(self):
+        archive = get_archiver("json").archive(self.folder)
+        with open(archive, "rb+") as f:
+            f.truncate(os.path.getsize(archive) - 20)
+        with self.assertRaises(ValueError):
+            get_archiver("json").unarchive(archive, "out")
+
+    def test_parallel_extraction(self):
+        # b.bin is above the buffering limit, so both write paths are used
+        with mock.patch("archiver.PARALLEL_FILE_SIZE", 100 * 1024):
+            for name in ("tarfile", "zipfile", "pickle", "json", "indexed"):
+                archive = get_archiver(name).archive(self.folder)
+                get_archiver(name).unarchive(archive, "serial_" + name)
+                archiver = get_archiver(name, extract_workers=4, preallocate=True, fsync=True)
+                archiver.unarchive(archive, "parallel_" + name)
+                self.assertEqual(read_tree("serial_" + name), read_tree("parallel_" + name))
+                os.remove(archive)
+
+    def test_parallel_tar_extraction_filters_members(self):
+        with tarfile.open("unsafe.tar", "w") as tar:
+            info = tarfile.TarInfo("setuid.bin")
+            info.size, info.mode = 4, 0o4777
+            tar.addfile(info, io.BytesIO(b"data"))
+        get_archiver("tarfile", extract_workers=4).unarchive("unsafe.tar", "out")
+        self.assertEqual(0o755, os.stat(os.path.join("out", "setuid.bin")).st_mode & 0o7777)
+
+        with tarfile.open("escape.tar", "w") as tar:
+            info = tarfile.TarInfo("../escape.bin")
+            info.size = 4
+            tar.addfile(info, io.BytesIO(b"data"))
+        with self.assertRaises(tarfile.FilterError):
+            get_archiver("tarfile", extract_workers=4).unarchive("escape.tar", "out")
+        self.assertFalse(os.path.exists("escape.bin"))
+
+
+class TestBatchLocker(unittest.TestCase):
+    def setUp(self) -> None:
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        self.trees = {name: make_tree(os.path.join("users", name)) for name in ("alice", "bob", "carol")}
+
+    def tearDown(self) -> None:
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def test_lock_and_unlock_many(self):
+        cache = KeyCache()
+        locker = Locker(get_archiver("tarfile"), FileCrypto(kdf=FAST_KDF, key_cache=cache))
+        os.mkdir("locked")
+        results = list(locker.lock_many(os.path.join("users", "*"), "password", "locked", workers=2))
+        self.assertEqual(sorted(os.path.join("users", name) for name in self.trees),
+                         sorted(result.source for result in results))
+        self.assertTrue(all(result.error is None for result in results))
+        # one KDF run for the whole batch
+        self.assertEqual(1, len(cache))
+
+        results = list(locker.unlock_many(os.path.join("locked", "*.enc"), "password", "out", workers=3))
+        self.assertTrue(all(result.error is None for result in results))
+        self.assertEqual(1, len(cache))
+        for name, files in self.trees.items():
+            self.assertEqual(files, read_tree(os.path.join("out", name)))
+
+    def test_failures_are_reported(self):
+        locker = Locker(get_archiver("tarfile"), FileCrypto(kdf=FAST_KDF))
+        results = {result.source: result for result in
+                   locker.lock_many([os.path.join("users", "alice"), "missing"], "password", ".")}
+        self.assertIsNone(results[os.path.join("users", "alice")].error)
+        self.assertIsNone(results["missing"].output)
+        self.assertIsInstance(results["missing"].error, OSError)
+
+    def test_same_output_is_refused(self):
+        # Two folders named alice locked into one folder would race on one file
+        make_tree(os.path.join("other", "alice"))
+        locker = Locker(get_archiver("tarfile"), FileCrypto(kdf=FAST_KDF))
+        with self.assertRaises(ValueError):
+            locker.lock_many([os.path.join("users", "alice"), os.path.join("other", "alice")], "password", ".")
+        self.assertFalse(glob.glob("alice.tar.enc*"))
+        # Locked next to themselves, they don't collide
+        results = list(locker.lock_many([os.path.join("users", "alice"), os.path.join("other", "alice")], "password"))
+        self.assertTrue(all(result.error is None for result in results))
+
+    def test_cli(self):
+        os.environ["LOCKER_TEST_PASSWORD"] = "password"
+        self.addCleanup(os.environ.pop, "LOCKER_TEST_PASSWORD")
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            status = cli.main(["lock", os.path.join("users", "*"), "-o", ".", "--json",
+                               "--password-env", "LOCKER_TEST_PASSWORD"])
+        self.assertEqual(0, status)
+        locked = [json.loads(line)["output"] for line in out.getvalue().splitlines()]
+        self.assertEqual(3, len(locked))
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            status = cli.main(["unlock", *locked, "-o", "out", "--password-env", "LOCKER_TEST_PASSWORD"])
+        self.assertEqual(0, status)
+        self.assertEqual(self.trees["bob"], read_tree(os.path.join("out", "bob")))
+
+
+class TestAsyncLocker(unittest.TestCase):
+    def setUp(self) -> None:
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        self.folder = "async"
+        self.files = make_tree(self.folder)
+        self.locker = AsyncLocker(Locker(get_archiver("tarfile"), FileCrypto(chunk_size=4096, kdf=FAST_KDF)),
+                                  max_pending=2)
+
+    def tearDown(self) -> None:
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def test_lock_and_unlock_folder(self):
+        async def roundtrip():
+            encrypted_file = await self.locker.lock_folder(self.folder, "password", ".")
+            members = await self.locker.list_members(encrypted_file, "password")
+            self.assertIn("async/sub/b.bin", [member.name for member in members])
+            await self.locker.unlock_folder(encrypted_file, "password", "out")
+
+        asyncio.run(roundtrip())
+        self.assertEqual(self.files, read_tree(os.path.join("out", self.folder)))
+
+    def test_stream_to_writer_and_back(self):
+        class SlowWriter:
+            def __init__(self):
+                self.chunks = []
+
+            async def write(self, chunk):
+                await asyncio.sleep(0)
+                self.chunks.append(chunk)
+
+        async def source(chunks):
+            for chunk in chunks:
+                yield chunk
+
+        async def roundtrip():
+            writer = SlowWriter()
+            await self.locker.lock_to_writer(self.folder, "password", writer)
+            await self.locker.unlock_from(source(writer.chunks), "password", "out")
+            with self.assertRaises(ValueError):
+                await self.locker.unlock_from(source(writer.chunks[:-1]), "password", "truncated")
+
+        asyncio.run(roundtrip())
+        self.assertEqual(self.files, read_tree(os.path.join("out", self.folder)))
+
+    def test_cancel_lock_removes_output(self):
+        with open(os.path.join(self.folder, "big.bin"), "wb") as f:
+            f.write(os.urandom(32 * 1024 * 1024))
+
+        async def cancel():
+            task = asyncio.create_task(self.locker.lock_folder(self.folder, "password", "."))
+            await asyncio.sleep(0.01)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        asyncio.run(cancel())
+        self.assertFalse(os.path.exists(self.folder + ".tar.enc"))
+
+
+class TestInstrumentation(unittest.TestCase):
+    def setUp(self) -> None:
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        self.folder = "observed"
+        self.files = make_tree(self.folder)
+
+    def tearDown(self) -> None:
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def test_profiler_stages(self):
+        for name in ("tarfile", "zipfile"):
+            profiler = Profiler()
+            archiver = get_archiver(name)
+            locker = Locker(archiver, FileCrypto(kdf=FAST_KDF), observer=profiler)
+            self.assertIsNone(archiver.observer)
+            encrypted_file = locker.lock_folder(self.folder, "password", ".")
+            locker.unlock_folder(encrypted_file, "password", "out_" + name)
+            os.remove(encrypted_file)
+
+            self.assertEqual(len(self.files), profiler.files)
+            self.assertGreater(profiler.bytes, 300 * 1024)
+            self.assertTrue({"walk", "archive", "encrypt", "decrypt", "extract", "other"} <= set(profiler.stages))
+            self.assertEqual({"lock": 1, "unlock": 1}, {op: count for op, (count, _) in profiler.operations.items()})
+            # exclusive stage times add up to the operations' wall time
+            stage_time = sum(elapsed for elapsed, _ in profiler.stages.values())
+            wall = sum(elapsed for _, elapsed in profiler.operations.values())
+            self.assertLessEqual(stage_time, wall * 1.01)
+            self.assertIn("encrypt", profiler.report())
+
+    def test_progress_tracker(self):
+        updates = []
+        tracker = ProgressTracker(lambda fraction, eta: updates.append(fraction))
+        locker = Locker(get_archiver("tarfile"), FileCrypto(kdf=FAST_KDF), observer=tracker)
+        locker.lock_folder(self.folder, "password", ".")
+        self.assertEqual(sum(len(content) for content in self.files.values()), tracker.total)
+        self.assertEqual(1.0, tracker.fraction)
+        self.assertEqual(0, tracker.eta)
+        self.assertEqual(sorted(updates), updates)
+
+    def test_progress_counts_input(self):
+        # Compressed, the locked file is far smaller than the folder: progress
+        # follows the bytes read from it, then reports the final sync
+        with open(os.path.join(self.folder, "large.txt"), "wb") as f:
+            f.write(b"compressible " * 400000)
+        tracker = ProgressTracker()
+        locker = Locker(get_archiver("tarfile", codec="zlib"), FileCrypto(kdf=FAST_KDF), observer=tracker)
+        encrypted_file = locker.lock_folder(self.folder, "password", ".")
+        self.assertLess(os.path.getsize(encrypted_file), tracker.total // 4)
+        self.assertEqual(tracker.total, tracker.done)
+        self.assertTrue(tracker.finalizing)
+
+        profiler = Profiler()
+        locker = Locker(get_archiver("tarfile", fsync=True), FileCrypto(kdf=FAST_KDF), observer=profiler)
+        locker.unlock_folder(encrypted_file, "password", "out")
+        self.assertIn("finalize", profiler.stages)
+
+
+class TestDedupStore(unittest.TestCase):
+    def setUp(self) -> None:
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        os.makedirs("docs")
+        self.content = os.urandom(512 * 1024)
+        with open("docs/data.bin", "wb") as f:
+            f.write(self.content)
+        self.store = ChunkStore("store", FileCrypto(kdf=FAST_KDF), min_size=4096, avg_size=16384, max_size=65536)
+
+    def tearDown(self) -> None:
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def count_chunks(self) -> int:
+        return sum(len(names) for _, _, names in os.walk("store/chunks"))
+
+    def test_roundtrip(self):
+        snapshot = self.store.lock_folder("docs", "password")
+        self.store.unlock_folder(snapshot, "password", "out")
+        with open("out/docs/data.bin", "rb") as f:
+            self.assertEqual(self.content, f.read())
+        with self.assertRaises(ValueError):
+            self.store.unlock_folder(snapshot, "wrong", "bad")
+
+    def test_unchanged_and_edited_data_deduplicates(self):
+        self.store.lock_folder("docs", "password", "first")
+        stored = self.count_chunks()
+        self.store.lock_folder("docs", "password", "second")
+        self.assertEqual(stored, self.count_chunks())
+
+        # an insertion only changes the chunks around it
+        edited = self.content[:200000] + b"inserted" + self.content[200000:]
+        with open("docs/data.bin", "wb") as f:
+            f.write(edited)
+        snapshot = self.store.lock_folder("docs", "password", "third")
+        self.assertLessEqual(self.count_chunks() - stored, 4)
+        self.assertEqual(3, len(self.store.snapshots()))
+
+        for path in self.store.snapshots()[:2]:
+            os.remove(path)
+        self.assertGreater(self.store.prune("password"), 0)
+        self.store.unlock_folder(snapshot, "password", "out")
+        with open("out/docs/data.bin", "rb") as f:
+            self.assertEqual(edited, f.read())
+
+    @unittest.skipIf(dedup.numpy is None, "numpy is not installed")
+    def test_vectorized_cut_points_match_the_loop(self):
+        chunker = Chunker(b"key", 4096, 16384, 65536)
+        for data in (os.urandom(70000), os.urandom(10000), bytes(70000), self.content):
+            data = bytearray(data)
+            with mock.patch.object(chunker, "_gear_array", None):
+                expected = chunker.cut_point(data)
+            self.assertEqual(expected, chunker.cut_point(data))
+
+    def test_large_lock_without_numpy_warns(self):
+        with mock.patch("dedup.numpy", None), mock.patch("dedup.SLOW_CHUNKING_SIZE", 1024), \
+                self.assertWarns(RuntimeWarning):
+            snapshot = self.store.lock_folder("docs", "password")
+        self.store.unlock_folder(snapshot, "password", "out")
+        with open("out/docs/data.bin", "rb") as f:
+            self.assertEqual(self.content, f.read())
+
+
+class TestCheckpoints(unittest.TestCase):
+    def setUp(self) -> None:
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        self.folder = "large"
+        self.files = {f"{index:02d}.bin": os.urandom(50 * 1024) for index in range(12)}
+        os.makedirs(self.folder)
+        for name, content in self.files.items():
+            with open(os.path.join(self.folder, name), "wb") as f:
+                f.write(content)
+        self.locker = Locker(get_archiver("tarfile"), FileCrypto(chunk_size=4096, kdf=FAST_KDF),
+                             checkpoint_bytes=64 * 1024)
+
+    def tearDown(self) -> None:
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def crash_lock(self):
+        scan = TarfileArchiver.scan
+
+        def crashing_scan(archiver, src, follow_symlinks=None):
+            for index, entry in enumerate(scan(archiver, src, follow_symlinks)):
+                if index == 9:
+                    raise RuntimeError("crash")
+                yield entry
+
+        with mock.patch.object(TarfileArchiver, "scan", crashing_scan), self.assertRaises(RuntimeError):
+            self.locker.lock_folder(self.folder, "password", ".")
+        self.assertFalse(os.path.exists("large.tar.enc"))
+        with open("large.tar.enc.journal") as f:
+            return json.load(f)
+
+    def test_lock_resumes_from_checkpoint(self):
+        # tarfile holds back at most 10 KiB, far below the default allowance
+        with mock.patch("checkpoint.ARCHIVER_LAG", 16 * 1024):
+            state = self.crash_lock()
+        self.assertGreater(state["bytes"], 0)
+        self.assertGreater(state["complete"], 1)
+        partial_header = FileCrypto.read_header("large.tar.enc.partial")
+
+        self.locker.lock_folder(self.folder, "password", ".")
+        # Resumed, not restarted: the records already written are kept
+        self.assertEqual(partial_header, FileCrypto.read_header("large.tar.enc"))
+        # and the manifest shares their salt
+        self.assertEqual(partial_header["salt"], FileCrypto.read_header("large.tar.enc.manifest")["salt"])
+        self.assertEqual(["large", "large.tar.enc", "large.tar.enc.manifest"], sorted(os.listdir(".")))
+        self.locker.unlock_folder("large.tar.enc", "password", "out")
+        self.assertEqual(self.files, read_tree(os.path.join("out", self.folder)))
+
+    def test_changed_folder_restarts_lock(self):
+        self.crash_lock()
+        self.files["00.bin"] = b"shorter"
+        with open(os.path.join(self.folder, "00.bin"), "wb") as f:
+            f.write(self.files["00.bin"])
+        self.locker.lock_folder(self.folder, "password", ".")
+        self.locker.unlock_folder("large.tar.enc", "password", "out")
+        self.assertEqual(self.files, read_tree(os.path.join("out", self.folder)))
+
+    def test_resumed_lock_never_reuses_nonces(self):
+        # Content changed past the checkpoint with its metadata kept: the records the
+        # interrupted run wrote there can't be sealed again over other plaintext
+        with mock.patch("checkpoint.ARCHIVER_LAG", 16 * 1024):
+            self.crash_lock()
+        with open("large.tar.enc.partial", "rb") as f:
+            partial = f.read()
+        for name in ("06.bin", "07.bin"):
+            path = os.path.join(self.folder, name)
+            stat = os.stat(path)
+            self.files[name] = os.urandom(len(self.files[name]))
+            with open(path, "wb") as f:
+                f.write(self.files[name])
+            os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+        self.locker.lock_folder(self.folder, "password", ".")
+        with open("large.tar.enc", "rb") as f:
+            locked = f.read()
+        header_size = len(b"LOCKER") + 5 + int.from_bytes(partial[len(b"LOCKER") + 1:len(b"LOCKER") + 5], "big")
+        if locked[:header_size] == partial[:header_size]:
+            # Same key and nonces: every record of the interrupted run is unchanged
+            self.assertEqual(partial, locked[:len(partial)])
+        self.locker.unlock_folder("large.tar.enc", "password", "out")
+        self.assertEqual(self.files, read_tree(os.path.join("out", self.folder)))
+
+    def crash_unlock(self, out_folder, resume):
+        write = _FileWriter.write
+        calls = []
+
+        def crashing_write(writer, *args, **kwargs):
+            calls.append(args[0])
+            if len(calls) == 8:
+                raise RuntimeError("crash")
+            return write(writer, *args, **kwargs)
+
+        with mock.patch.object(_FileWriter, "write", crashing_write), self.assertRaises(RuntimeError):
+            self.locker.unlock_folder("large.tar.enc", "password", out_folder, resume=resume)
+        return _unlock_journal("large.tar.enc", out_folder).path
+
+    def test_unlock_resumes_from_checkpoint(self):
+        self.locker.lock_folder(self.folder, "password", ".")
+        journal = self.crash_unlock("out", resume=True)
+        self.assertTrue(os.path.exists(journal))
+        self.assertEqual([self.folder], os.listdir("out"))
+
+        # files before the checkpoint aren't extracted again when resuming
+        os.remove(os.path.join("out", self.folder, "00.bin"))
+        self.locker.unlock_folder("large.tar.enc", "password", "out", resume=True)
+        restored = read_tree(os.path.join("out", self.folder))
+        self.assertNotIn("00.bin", restored)
+        self.assertEqual({name: content for name, content in self.files.items() if name != "00.bin"}, restored)
+        self.assertFalse(os.path.exists(journal))
+
+        # Without resume, a journal left behind is ignored and everything extracted
+        journal = self.crash_unlock("stale", resume=True)
+        os.remove(os.path.join("stale", self.folder, "00.bin"))
+        self.locker.unlock_folder("large.tar.enc", "password", "stale")
+        self.assertEqual(self.files, read_tree(os.path.join("stale", self.folder)))
+        self.assertFalse(os.path.exists(journal))
+
+    def test_failed_unlock_without_resume_leaves_no_journal(self):
+        self.locker.lock_folder(self.folder, "password", ".")
+        self.assertFalse(os.path.exists(self.crash_unlock("out", resume=False)))
+        self.assertEqual([self.folder], os.listdir("out"))
+
+    def test_failed_lock_leaves_no_temp_archive(self):
+        locker = Locker(get_archiver("pickle"), FileCrypto(kdf=FAST_KDF), pipelined=False)
+        with mock.patch.object(FileCrypto, "encrypt_file", side_effect=OSError("disk full")), \
+                self.assertRaises(OSError):
+            locker.lock_folder(self.folder, "password", ".")
+        self.assertEqual(["large"], os.listdir("."))
+
+
+class TestArchiverRegistry(unittest.TestCase):
+    def setUp(self) -> None:
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        self.folder = "registry"
+        self.files = make_tree(self.folder)
+        self.crypto = FileCrypto(kdf=FAST_KDF)
+
+    def tearDown(self) -> None:
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def test_unlock_detects_archiver(self):
+        reader = Locker(get_archiver("tarfile"), self.crypto)
+        for name in ("pickle", "json", "zipfile", "indexed", "shutil"):
+            locker = Locker(get_archiver(name), self.crypto)
+            encrypted_file = locker.lock_folder(self.folder, "password", ".")
+            # The description of the archive is only readable with the password
+            self.assertNotIn("content", FileCrypto.read_header(encrypted_file))
+            self.assertEqual(name, self.crypto.read_content(b"password", encrypted_file)["archiver"])
+            self.assertEqual(self.folder, reader.folder_name(encrypted_file, "password"))
+
+            locker.unlock_folder(encrypted_file, "password", "expected_" + name)
+            reader.unlock_folder(encrypted_file, "password", "out_" + name)
+            self.assertEqual(read_tree("expected_" + name), read_tree("out_" + name))
+            os.remove(encrypted_file)
+
+    def test_plain_tar_is_read_by_streaming_archiver(self):
+        locker = Locker(get_archiver("shutil"), self.crypto)
+        encrypted_file = locker.lock_folder(self.folder, "password", ".")
+        self.assertIsInstance(locker.archiver_for(encrypted_file, "password"), TarfileArchiver)
+        locker.unlock_folder(encrypted_file, "password", "out")
+        self.assertEqual(self.files, read_tree("out"))
+
+    def test_registered_archiver(self):
+        @register_archiver("test-pickle")
+        class TestPickleArchiver(PickleArchiver):
+            format = "test-pickle"
+            reads = ("test-pickle",)
+        self.addCleanup(ARCHIVERS.pop, "test-pickle")
+
+        self.assertIn("test-pickle", available_archivers())
+        encrypted_file = Locker(get_archiver("test-pickle"), self.crypto).lock_folder(self.folder, "password", ".")
+        locker = Locker(get_archiver("tarfile"), self.crypto)
+        self.assertIsInstance(locker.archiver_for(encrypted_file, "password"), TestPickleArchiver)
+        locker.unlock_folder(encrypted_file, "password", "out")
+        self.assertEqual(self.files, read_tree(os.path.join("out", self.folder)))
+        with self.assertRaises(ValueError):
+            get_archiver("missing")
+
+    def test_registered_archiver_without_options(self):
+        # Options an archiver's __init__ doesn't declare aren't passed to it
+        @register_archiver("test-plain")
+        class TestPlainArchiver(PickleArchiver):
+            format = "test-plain"
+            reads = ("test-plain",)
+
+            def __init__(self):
+                super().__init__()
+        self.addCleanup(ARCHIVERS.pop, "test-plain")
+
+        archiver = get_archiver("test-plain", workers=2, fsync=True)
+        encrypted_file = Locker(archiver, self.crypto).lock_folder(self.folder, "password", ".")
+        locker = Locker(get_archiver("tarfile", workers=2, extract_workers=2, fsync=True), self.crypto)
+        self.assertIsInstance(locker.archiver_for(encrypted_file, "password"), TestPlainArchiver)
+        locker.unlock_folder(encrypted_file, "password", "out")
+        self.assertEqual(self.files, read_tree(os.path.join("out", self.folder)))
+
+
+class TestVolumes(unittest.TestCase):
+    def setUp(self) -> None:
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        self.folder = "volumes"
+        self.files = make_tree(self.folder)
+        self.crypto = FileCrypto(chunk_size=4096, kdf=FAST_KDF)
+
+    def tearDown(self) -> None:
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def test_lock_and_unlock_volumes(self):
+        for name, pipelined in (("tarfile", True), ("tarfile", False), ("zipfile", True)):
+            locker = Locker(get_archiver(name), self.crypto, pipelined=pipelined, volume_size=64 * 1024)
+            first = locker.lock_folder(self.folder, "password", ".")
+            base = first[:-len(".000")]
+            self.assertEqual(volume_path(base, 0), first)
+            self.assertFalse(os.path.exists(base))
+            volumes = list_volumes(base)
+            self.assertGreater(len(volumes), 3)
+            self.assertEqual(list(range(len(volumes))),
+                             [FileCrypto.read_header(path)["volume"]["index"] for path in volumes])
+            self.assertGreater(locker.verify(first, "password"), 300 * 1024)
+
+            out_folder = f"out_{name}_{pipelined}"
+            locker.unlock_folder(first, "password", out_folder)
+            expected = os.path.join(out_folder, self.folder) if name == "tarfile" else out_folder
+            self.assertEqual(self.files, read_tree(expected))
+            for path in volumes:
+                os.remove(path)
+
+    def test_random_access_volumes(self):
+        # Split files only read forward, so the indexed archiver reads them from a temporary copy
+        locker = Locker(get_archiver("indexed"), self.crypto, volume_size=64 * 1024)
+        first = locker.lock_folder(self.folder, "password", ".")
+        self.assertGreater(len(list_volumes(first[:-len(".000")])), 3)
+        locker.unlock_folder(first, "password", "out")
+        self.assertEqual(self.files, read_tree(os.path.join("out", self.folder)))
+
+        members = locker.list_members(first, "password")
+        self.assertEqual(sorted(self.files), sorted(os.path.relpath(member.name, self.folder)
+                                                    for member in members if member.type == "file"))
+        os.remove(first[:-len(".000")] + ".manifest")
+        self.assertEqual(sorted(member.name for member in members),
+                         sorted(listing.path for listing in locker.list(first, "password")))
+        path = locker.extract_member(first, os.path.join(self.folder, "a.txt"), "password", "member")
+        with open(path, "rb") as f:
+            self.assertEqual(self.files["a.txt"], f.read())
+
+    def test_relock_removes_stale_volumes(self):
+        first = Locker(get_archiver("tarfile"), self.crypto, volume_size=32 * 1024).lock_folder(
+            self.folder, "password", ".")
+        base = first[:-len(".000")]
+        count = len(list_volumes(base))
+        Locker(get_archiver("tarfile"), self.crypto, volume_size=128 * 1024).lock_folder(self.folder, "password", ".")
+        self.assertLess(len(list_volumes(base)), count)
+        self.assertFalse(os.path.exists(volume_path(base, len(list_volumes(base)))))
+        Locker(get_archiver("tarfile"), self.crypto).lock_folder(self.folder, "password", ".")
+        self.assertEqual([], list_volumes(base))
+        self.assertTrue(os.path.exists(base))
+
+    def test_full_last_volume_and_damage(self):
+        data = os.urandom(3 * 10000)
+        for base in ("a.enc", "b.enc"):
+            with VolumeWriter(self.crypto, b"password", base, 10000) as writer:
+                writer.write(data)
+        # The third volume is full, so an empty fourth one marks the end
+        self.assertEqual(4, len(list_volumes("a.enc")))
+        with VolumeReader(self.crypto, b"password", "a.enc", workers=2) as reader:
+            self.assertEqual(data, reader.read())
+        with self.assertRaises(InvalidPassword):
+            VolumeReader(self.crypto, b"wrong", "a.enc")
+
+        shutil.copy(volume_path("b.enc", 1), volume_path("a.enc", 1))
+        with self.assertRaises(ValueError), VolumeReader(self.crypto, b"password", "a.enc") as reader:
+            reader.read()
+        os.remove(volume_path("b.enc", 3))
+        with self.assertRaises(ValueError), VolumeReader(self.crypto, b"password", "b.enc") as reader:
+            reader.read()
+
+        with self.assertRaises(RuntimeError), VolumeWriter(self.crypto, b"password", "c.enc", 10000) as writer:
+            writer.write(data)
+            raise RuntimeError("crash")
+        self.assertEqual([], list_volumes("c.enc"))
+
+
+class TestStreamFiles(unittest.TestCase):
+    def setUp(self) -> None:
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        self.data = os.urandom(3 * 1024 * 1024 + 123)
+        with fileio.open_stream("data.bin", "wb") as f:
+            f.write(self.data)
+
+    def tearDown(self) -> None:
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def test_block_size(self):
+        for path in ("data.bin", "missing/folder/file"):
+            size = fileio.block_size(path)
+            self.assertTrue(fileio.MIN_BUFFER <= size <= fileio.MAX_BUFFER)
+            self.assertEqual(0, size & (size - 1))
+
+    def test_direct_reads_and_seeks(self):
+        # Falls back to buffered reads where the file system refuses O_DIRECT
+        with fileio.open_stream("data.bin", direct=True) as f:
+            self.assertEqual(self.data[:10], f.read(10))
+            self.assertEqual(self.data[10:], f.read())
+            f.seek(8192)
+            self.assertEqual(self.data[8192:8200], f.read(8))
+            f.seek(7)
+            self.assertFalse(f.raw.direct)
+            self.assertEqual(self.data[7:], f.read())
+        with fileio.open_stream("data.bin", "r+b") as f:
+            f.seek(5)
+            f.write(b"xx")
+        with open("data.bin", "rb") as f:
+            self.assertEqual(self.data[:5] + b"xx" + self.data[7:], f.read())
+
+    def test_pages_are_dropped_behind(self):
+        calls = []
+        with mock.patch("fileio.DROP_INTERVAL", 1024 * 1024), \
+                mock.patch("fileio.advise", lambda fd, offset, length, advice: calls.append((offset, advice))):
+            with fileio.StreamFile("data.bin") as f:
+                while f.read(64 * 1024):
+                    pass
+            with fileio.StreamFile("data.bin", drop_cache=False) as f:
+                f.read()
+        self.assertEqual([(0, "SEQUENTIAL"), (0, "DONTNEED"), (0, "DONTNEED"), (1024 * 1024, "DONTNEED"),
+                          (2 * 1024 * 1024, "DONTNEED"), (0, "SEQUENTIAL")], calls)
+
+        crypto = FileCrypto(chunk_size=4096, kdf=FAST_KDF)
+        with mock.patch("fileio.DIRECT_IO", True):
+            encrypted = crypto.encrypt_file(b"password", "data.bin", ".")
+            self.assertEqual(hashlib.sha256(self.data).hexdigest(), crypto.hash_file("data.bin"))
+            os.remove("data.bin")
+            crypto.decrypt_file(b"password", encrypted)
+        with open("data.bin", "rb") as f:
+            self.assertEqual(self.data, f.read())
+
+
+class TestStreamLocking(unittest.TestCase):
+    def setUp(self) -> None:
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        self.folder = "streamed"
+        self.files = make_tree(self.folder)
+        self.locker = Locker(get_archiver("tarfile"), FileCrypto(chunk_size=4096, kdf=FAST_KDF))
+
+    def tearDown(self) -> None:
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def test_lock_to_and_unlock_from_stream(self):
+        stream = io.BytesIO()
+        self.locker.lock_to_stream(self.folder, "password", stream)
+        self.assertEqual(["streamed"], os.listdir("."))
+        stream.seek(0)
+        self.locker.unlock_from_stream(stream, "password", "out")
+        self.assertEqual(self.files, read_tree(os.path.join("out", self.folder)))
+
+        # The stream is a locked file like any other
+        with open("saved.tar.enc", "wb") as f:
+            f.write(stream.getvalue())
+        self.locker.unlock_folder("saved.tar.enc", "password", "saved")
+        self.assertEqual(self.files, read_tree(os.path.join("saved", self.folder)))
+        with self.assertRaises(ValueError):
+            Locker(get_archiver("zipfile"), self.locker.crypto).lock_to_stream(self.folder, "password", io.BytesIO())
+
+    def test_random_access_archiver_stream(self):
+        # The indexed format writes a stream, but reading it needs its index at the end
+        locker = Locker(get_archiver("indexed"), self.locker.crypto)
+        stream = io.BytesIO()
+        locker.lock_to_stream(self.folder, "password", stream)
+        stream.seek(0)
+        with self.assertRaisesRegex(ValueError, "stream"):
+            locker.unlock_from_stream(stream, "password", "out")
+        self.assertFalse(os.path.exists("out"))
+        with open("saved.larc.enc", "wb") as f:
+            f.write(stream.getvalue())
+        locker.unlock_folder("saved.larc.enc", "password", "saved")
+        self.assertEqual(self.files, read_tree(os.path.join("saved", self.folder)))
+        read_end, write_end = os.pipe()
+        os.close(write_end)
+        with open(read_end, "rb") as pipe, self.assertRaisesRegex(ValueError, "non-seekable"):
+            get_archiver("indexed").unarchive_from(pipe, "out")
+
+    def test_non_streaming_archiver_stream(self):
+        # A zip written to a temporary file and encrypted is a locked file, but not a stream
+        locker = Locker(get_archiver("zipfile"), self.locker.crypto, pipelined=False)
+        encrypted_file = locker.lock_folder(self.folder, "password", ".")
+        with open(encrypted_file, "rb") as f, self.assertRaisesRegex(ValueError, "ZipfileArchiver"):
+            self.locker.unlock_from_stream(f, "password", "out")
+        self.assertFalse(os.path.exists("out"))
+
+    def test_iter_lock(self):
+        self.locker.unlock_from_stream(self.locker.iter_lock(self.folder, "password", max_pending=2), "password", "out")
+        self.assertEqual(self.files, read_tree(os.path.join("out", self.folder)))
+        with self.assertRaises(InvalidPassword):
+            self.locker.unlock_from_stream(self.locker.iter_lock(self.folder, "password"), "wrong", "wrong")
+
+        # Stopping early ends the worker instead of leaving it blocked
+        chunks = self.locker.iter_lock(self.folder, "password", max_pending=1)
+        next(chunks)
+        chunks.close()
+
+    def test_cli_pipes(self):
+        os.environ["LOCKER_TEST_PASSWORD"] = "password"
+        self.addCleanup(os.environ.pop, "LOCKER_TEST_PASSWORD")
+        stdout = io.TextIOWrapper(io.BytesIO())
+        with mock.patch("sys.stdout", stdout), contextlib.redirect_stderr(io.StringIO()) as err:
+            status = cli.main(["lock", self.folder, "-o", "-", "--password-env", "LOCKER_TEST_PASSWORD"])
+        self.assertEqual(0, status)
+        self.assertIn("-> -", err.getvalue())
+        stdin = io.TextIOWrapper(io.BytesIO(stdout.buffer.getvalue()))
+        with mock.patch("sys.stdin", stdin), contextlib.redirect_stdout(io.StringIO()):
+            status = cli.main(["unlock", "-", "-o", "out", "--password-env", "LOCKER_TEST_PASSWORD"])
+        self.assertEqual(0, status)
+        self.assertEqual(self.files, read_tree(os.path.join("out", self.folder)))
+        with self.assertRaises(SystemExit):
+            cli.main(["lock", self.folder, "other", "-o", "-", "--password-env", "LOCKER_TEST_PASSWORD"])
+        with self.assertRaises(SystemExit):
+            cli.main(["unlock", "-", "--resume", "--password-env", "LOCKER_TEST_PASSWORD"])
+
+
+class TestListing(unittest.TestCase):
+    def setUp(self) -> None:
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        self.folder = "listed"
+        self.files = make_tree(self.folder)
+        # Bigger than a prefetched file, so it is hashed as the archiver streams it
+        self.files["big.bin"] = os.urandom(3 * 1024 * 1024)
+        with open(os.path.join(self.folder, "big.bin"), "wb") as f:
+            f.write(self.files["big.bin"])
+        os.chmod(os.path.join(self.folder, "a.txt"), 0o640)
+        self.crypto = FileCrypto(chunk_size=4096, kdf=FAST_KDF)
+
+    def tearDown(self) -> None:
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def check_listing(self, listing):
+        self.assertEqual(sorted(list(self.files) + ["sub"]), [entry.path for entry in listing])
+        for entry in listing:
+            if entry.type == "file":
+                self.assertEqual(len(self.files[entry.path]), entry.size)
+                self.assertEqual(hashlib.sha256(self.files[entry.path]).hexdigest(), entry.hash)
+        self.assertEqual(0o640, {entry.path: entry for entry in listing}["a.txt"].mode)
+
+    def test_manifest_shares_the_key(self):
+        # Sealed under the salt of the locked file, so a lock runs the KDF once
+        for name, pipelined, volume_size in (("tarfile", True, None), ("tarfile", True, 1024 * 1024),
+                                             ("tarfile", False, None)):
+            locker = Locker(get_archiver(name), FileCrypto(chunk_size=4096, kdf=FAST_KDF), pipelined=pipelined,
+                            volume_size=volume_size)
+            with mock.patch("crypto.derive_key", side_effect=derive_key) as derive:
+                locked = locker.lock_folder(self.folder, "password", ".")
+            self.assertEqual(1, derive.call_count)
+            self.assertIsNone(locker.crypto.session_salt)
+            manifest_file = locked[:-len(".000")] + ".manifest" if volume_size else locked + ".manifest"
+            self.assertEqual(FileCrypto.read_header(locked)["salt"], FileCrypto.read_header(manifest_file)["salt"])
+
+    def test_list_reads_only_the_manifest(self):
+        for name, pipelined, volume_size in (("tarfile", True, None), ("tarfile", True, 1024 * 1024),
+                                             ("pickle", False, None), ("shutil", False, None)):
+            locker = Locker(get_archiver(name), self.crypto, pipelined=pipelined, volume_size=volume_size)
+            locked = locker.lock_folder(self.folder, "password", ".")
+            # Damage the archive: listing doesn't decrypt it
+            with open(locked, "r+b") as f:
+                f.seek(-100, os.SEEK_END)
+                f.write(b"\0" * 100)
+            self.check_listing(locker.list(locked, "password"))
+            self.assertEqual(["a.txt"], [entry.path for entry in locker.list(locked, "password", "*.txt")])
+            with self.assertRaises(InvalidPassword):
+                locker.list(locked, "wrong")
+
+    def test_list_without_manifest(self):
+        locker = Locker(get_archiver("tarfile"), self.crypto)
+        locked = locker.lock_folder(self.folder, "password", ".")
+        os.remove(locked + ".manifest")
+        listing = locker.list(locked, "password", "*.txt")
+        self.assertEqual([os.path.join(self.folder, "a.txt")], [entry.path for entry in listing])
+        self.assertIsNone(listing[0].hash)
+
+    def test_list_after_resumed_lock(self):
+        # Files skipped by a resumed lock are hashed from disk
+        locker = Locker(get_archiver("tarfile"), self.crypto, checkpoint_bytes=64 * 1024)
+        crashing = False
+
+        def crashing_scan(archiver, src, follow_symlinks=None):
+            for entry in original_scan(archiver, src, follow_symlinks):
+                if crashing and entry.name == "big.bin":
+                    raise RuntimeError("crash")
+                yield entry
+
+        original_scan = TarfileArchiver.scan
+        crashing = True
+        with mock.patch.object(TarfileArchiver, "scan", crashing_scan), self.assertRaises(RuntimeError):
+            locker.lock_folder(self.folder, "password", ".")
+        locked = locker.lock_folder(self.folder, "password", ".")
+        self.check_listing(locker.list(locked, "password"))
+
+
+class TestHashCache(unittest.TestCase):
+    def setUp(self) -> None:
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        self.folder = "hashed"
+        self.files = make_tree(self.folder)
+        # Files modified in the last moments aren't cached
+        for name in self.files:
+            os.utime(os.path.join(self.folder, name), ns=(10 ** 18, 10 ** 18))
+        self.crypto = FileCrypto(kdf=FAST_KDF)
+
+    def tearDown(self) -> None:
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def test_hash_tree(self):
+        expected = {name: hashlib.sha256(content).hexdigest() for name, content in self.files.items()}
+        self.assertEqual(expected, hash_tree(self.folder, self.crypto, workers=4))
+        self.assertEqual({name: hashlib.blake2b(content).hexdigest() for name, content in self.files.items()},
+                         hash_tree(self.folder, self.crypto, "blake2b"))
+        samples = hash_tree(self.folder, algorithm="sample")
+        self.assertEqual(3, len(set(samples.values())))
+        with self.assertRaises(ValueError):
+            hash_tree(self.folder, algorithm="md4")
+
+    def test_cache_reuses_unchanged_files(self):
+        files = {path: os.stat(path) for path in (os.path.join(self.folder, name) for name in self.files)}
+        with HashCache("hashes.sqlite3") as cache:
+            first = hash_files(self.crypto, files, cache=cache)
+            self.assertEqual(3, len(cache))
+
+        changed = os.path.join(self.folder, "a.txt")
+        with open(changed, "wb") as f:
+            f.write(b"changed")
+        os.utime(changed, ns=(10 ** 18 + 1, 10 ** 18 + 1))
+        files = {path: os.stat(path) for path in files}
+        with HashCache("hashes.sqlite3") as cache, \
+                mock.patch.object(FileCrypto, "hash_file", side_effect=FileCrypto.hash_file, autospec=True) as hash_file:
+            second = hash_files(self.crypto, files, cache=cache)
+        self.assertEqual([changed], [call.args[1] for call in hash_file.call_args_list])
+        self.assertEqual(hashlib.sha256(b"changed").hexdigest(), second[changed])
+        self.assertEqual({path: digest for path, digest in first.items() if path != changed},
+                         {path: digest for path, digest in second.items() if path != changed})
+
+        with HashCache("hashes.sqlite3", max_entries=2) as cache:
+            cache.store(files, {changed: second[changed]})
+            self.assertEqual(2, len(cache))
+
+    def test_locker_fills_cache(self):
+        cache = HashCache(":memory:")
+        locker = Locker(get_archiver("tarfile"), self.crypto, hash_cache=cache)
+        locked = locker.lock_folder(self.folder, "password", ".")
+        self.assertEqual(3, len(cache))
+        # The hashes taken while locking make a manifest of the tree free
+        with mock.patch.object(FileCrypto, "hash_file") as hash_file:
+            entries = build_manifest(self.folder, self.crypto, cache=cache)
+        hash_file.assert_not_called()
+        self.assertEqual(read_manifest(self.crypto, b"password", locked + ".manifest"), entries)
+        cache.close()
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_run_and_compare(self):
+        report = benchmark.run(["small"], ["compressible"], ["tarfile", "pickle"], ["serial"], [None, "zlib"],
+                               scale=0.01, kdf_iterations=1000, log=io.StringIO())
+        self.assertEqual(4, len(report["results"]))
+        for result in report["results"]:
+            self.assertEqual(20 * 4096, result["source_bytes"])
+            self.assertGreater(result["lock_throughput"], 0)
+            self.assertGreater(result["peak_rss"], 0)
+        self.assertFalse(any(row[-1] for row in benchmark.compare(report, report)))
+
+        slower = json.loads(json.dumps(report))
+        slower["results"][0]["lock_wall"] *= 2
+        regressions = [row for row in benchmark.compare(report, slower) if row[-1]]
+        self.assertEqual(["lock_wall"], [row[1] for row in regressions])
+
+    def test_startup_is_lazy(self):
+        # The front ends must come up without the archivers, crypto or GUI theme
+        for module in benchmark.STARTUP_MODULES:
+            if module == "app" and importlib.util.find_spec("tkinter") is None:
+                continue
+            result = benchmark.measure_startup(module, repeat=1)
+            self.assertEqual([], result["heavy_modules"], module)
+            self.assertGreater(result["import_wall"], 0)
+
 
 class TestLocker(unittest.TestCase):
     def __init__(self, methodName: str = "runTest") -> None:
@@ -56,6 +1493,10 @@ class TestLocker(unittest.TestCase):
     def tearDown(self) -> None:
         if os.path.exists(self.test_folder):
             shutil.rmtree(self.test_folder)
+        # Every lock leaves a manifest next to its locked file
+        for name in os.listdir("."):
+            if name.startswith(self.test_folder) and name.endswith(".manifest"):
+                os.remove(name)
 
     def test_locker_with_tarfile(self):
 
@@ -0,0 +1,322 @@
+import io
+import os
+import copy
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from Cryptodome.Random import get_random_bytes
+from crypto import FileCrypto
+from fileio import open_stream
+
+
+# A split file is a set of volumes name.000, name.001, ..., each a container of
+# its own with its own subkey. The "volume" entry of each header records the
+# set it belongs to, its index and the volume size. Every volume but the last
+# holds exactly that many plaintext bytes and the last one fewer (possibly
+# none), so a missing, reordered or foreign volume and a truncated set are all
+# detected without a separate index.
+VOLUME_SIZE = 1024 * 1024 * 1024
+# Chunks a volume decrypted ahead of the reader may buffer
+READ_AHEAD = 4
+
+
+def volume_path(filename: str, index: int) -> str:
+    return f"{filename}.{index:03d}"
+
+
+def volume_base(path: str) -> str:
+    # The split file whose first volume is path, or None if path doesn't name one
+    if path.endswith(".000"):
+        return path[:-len(".000")]
+    return None
+
+
+def list_volumes(filename: str) -> list:
+    # The consecutive volumes of filename that exist
+    paths = []
+    while os.path.exists(volume_path(filename, len(paths))):
+        paths.append(volume_path(filename, len(paths)))
+    return paths
+
+
+def _session(crypto: FileCrypto) -> FileCrypto:
+    # Volumes of a set share one KDF salt, so the KDF runs once for all of them
+    if crypto.session_salt is None:
+        crypto = copy.copy(crypto)
+        crypto.new_session()
+    return crypto
+
+
+def _finish(writer, fileobj) -> None:
+    try:
+        writer.close()
+    finally:
+        fileobj.close()
+
+
+class VolumeWriter(io.RawIOBase):
+    # Sink splitting what is written to it into volumes of filename, each named
+    # volume_path(filename, index) + suffix. A filled volume is sealed and closed
+    # on a background thread while the next one is written. paths lists the
+    # volumes written; leaving the context with an exception removes them.
+    def __init__(self, crypto: FileCrypto, password: bytes, filename: str, volume_size: int = VOLUME_SIZE,
+                 metadata: dict = None, suffix: str = ""):
+        super().__init__()
+        self._crypto = _session(crypto)
+        self._password = password
+        self._filename = filename
+        self._volume_size = volume_size
+        self._metadata = metadata
+        self._suffix = suffix
+        self._set = get_random_bytes(8).hex()
+        self._closer = ThreadPoolExecutor(1)
+        self._closing = []
+        self._aborted = False
+        self._file = self._writer = None
+        self.paths = []
+        self._open()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        data = memoryview(data).cast("B")
+        size = data.nbytes
+        while data:
+            # A full volume is only followed by another once there is more data
+            if not self._remaining:
+                self._closing.append(self._closer.submit(_finish, self._writer, self._file))
+                self._open()
+            part = data[:self._remaining]
+            self._writer.write(part)
+            self._remaining -= part.nbytes
+            data = data[part.nbytes:]
+        return size
+
+    def _open(self):
+        index = len(self.paths)
+        path = volume_path(self._filename, index) + self._suffix
+        self.paths.append(path)
+        self._file = open_stream(path, "wb")
+        try:
+            self._writer = self._crypto.open_writer(self._password, self._file, metadata=self._metadata,
+                                                    volume={"set": self._set, "index": index,
+                                                            "size": self._volume_size})
+        except BaseException:
+            self._file.close()
+            self._writer = None
+            raise
+        self._remaining = self._volume_size
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self._aborted:
+                self._discard()
+                return
+            try:
+                # A full last volume gets an empty one after it to mark the end
+                if not self._remaining:
+                    self._closing.append(self._closer.submit(_finish, self._writer, self._file))
+                    self._open()
+                _finish(self._writer, self._file)
+                for future in self._closing:
+                    future.result()
+            except BaseException:
+                self._discard()
+                raise
+        finally:
+            self._closer.shutdown()
+            super().close()
+
+    def _discard(self):
+        if self._writer is not None:
+            self._writer.abort()
+        self._file.close()
+        # Volumes still being closed in the background are removed too
+        self._closer.shutdown()
+        for path in self.paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self._aborted = True
+        return super().__exit__(exc_type, exc, tb)
+
+
+class VolumeReader(io.RawIOBase):
+    # Plaintext of a split file, reassembled in order while up to workers of
+    # the next volumes are decrypted ahead, each into a bounded queue. The first
+    # volume is opened before returning, so a wrong password fails right away;
+    # header is its header.
+    def __init__(self, crypto: FileCrypto, password: bytes, filename: str, workers: int = 4):
+        super().__init__()
+        self._crypto = crypto
+        self._password = password
+        self._filename = filename
+        self._workers = max(1, workers)
+        self._cancelled = threading.Event()
+        self._pool = None
+        # Queue of each volume started and not yet consumed, in order
+        self._started = deque()
+        self._next = 0
+        self._pending = memoryview(b"")
+        self._done = False
+
+        in_file = open_stream(volume_path(filename, 0))
+        try:
+            reader = crypto.open_reader(password, in_file)
+        except BaseException:
+            in_file.close()
+            raise
+        self.header = reader.header
+        self._volume = (reader.header or {}).get("volume")
+        if not self._volume or self._volume.get("index") != 0:
+            reader.close()
+            in_file.close()
+            raise ValueError(f"{volume_path(filename, 0)} is not the first volume of a split file")
+        self._pool = ThreadPoolExecutor(self._workers)
+        self._start(reader, in_file)
+        self._fill()
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        while not self._pending:
+            if self._done:
+                return 0
+            item = self._started[0].get()
+            if isinstance(item, BaseException):
+                raise item
+            if isinstance(item, int):
+                # The volume ended, holding item plaintext bytes; only a full one has a successor
+                self._started.popleft()
+                if item < self._volume["size"]:
+                    self._done = True
+                    return 0
+                self._fill()
+                if not self._started:
+                    raise ValueError(f"Missing volume {volume_path(self._filename, self._next)}")
+                continue
+            self._pending = memoryview(item)
+        size = min(len(b), len(self._pending))
+        b[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+    def verify(self) -> int:
+        # Reads the whole set, authenticating every record of every volume, and
+        # returns the plaintext size
+        size = 0
+        buffer = bytearray(self._crypto.chunk_size)
+        while (read := self.readinto(buffer)):
+            size += read
+        return size
+
+    def _fill(self):
+        while len(self._started) < self._workers and os.path.exists(volume_path(self._filename, self._next)):
+            self._start()
+
+    def _start(self, reader=None, in_file=None):
+        out = queue.Queue(READ_AHEAD)
+        self._started.append(out)
+        self._pool.submit(self._pump, self._next, out, reader, in_file)
+        self._next += 1
+
+    def _pump(self, index: int, out: queue.Queue, reader=None, in_file=None):
+        # Puts the plaintext chunks of volume index on out, then its size, or the
+        # exception that stopped it
+        try:
+            if reader is None:
+                in_file = open_stream(volume_path(self._filename, index))
+                try:
+                    reader = self._crypto.open_reader(self._password, in_file)
+                except BaseException:
+                    in_file.close()
+                    raise
+            with in_file, reader:
+                if (reader.header or {}).get("volume") != dict(self._volume, index=index):
+                    raise ValueError(f"{volume_path(self._filename, index)} is not volume {index} of this set")
+                size = 0
+                while not self._cancelled.is_set() and (chunk := reader.read(self._crypto.chunk_size)):
+                    size += len(chunk)
+                    self._put(out, chunk)
+            if size > self._volume["size"]:
+                raise ValueError(f"{volume_path(self._filename, index)} is larger than its volume size")
+            self._put(out, size)
+        except BaseException as e:
+            self._put(out, e)
+
+    def _put(self, out: queue.Queue, item):
+        while not self._cancelled.is_set():
+            try:
+                out.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def close(self):
+        self._cancelled.set()
+        if self._pool is not None:
+            self._pool.shutdown()
+        super().close()
+
+
+def encrypt_volumes(crypto: FileCrypto, password: bytes, in_filename: str, out_folder: str = None,
+                    volume_size: int = VOLUME_SIZE, metadata: dict = None, workers: int = None) -> list:
+    # Like FileCrypto.encrypt_file, but split into volumes that are all
+    # encrypted at once, each by its own thread reading its own range of
+    # in_filename. Returns the volume paths.
+    if not out_folder:
+        out_folder = os.path.dirname(in_filename)
+    out_filename = os.path.join(out_folder, os.path.basename(in_filename) + ".enc")
+    crypto = _session(crypto)
+    set_id = get_random_bytes(8).hex()
+    size = os.path.getsize(in_filename)
+    paths = [volume_path(out_filename, index) for index in range(size // volume_size + 1)]
+
+    def write(index):
+        start = index * volume_size
+        remaining = min(volume_size, size - start)
+        buffer = bytearray(crypto.chunk_size)
+        view = memoryview(buffer)
+        with open_stream(in_filename) as in_file, open_stream(paths[index], "wb") as out_file, \
+                crypto.open_writer(password, out_file, metadata=metadata,
+                                   volume={"set": set_id, "index": index, "size": volume_size}) as writer:
+            in_file.seek(start)
+            while remaining and (read := in_file.readinto(view[:min(len(buffer), remaining)])):
+                writer.write(view[:read])
+                remaining -= read
+
+    try:
+        with ThreadPoolExecutor(min(len(paths), workers or os.cpu_count() or 1)) as pool:
+            for future in [pool.submit(write, index) for index in range(len(paths))]:
+                future.result()
+    except BaseException:
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+    return paths
+
+
+def decrypt_volumes(crypto: FileCrypto, password: bytes, filename: str, out_filename: str = None,
+                    workers: int = 4) -> str:
+    # Like FileCrypto.decrypt_file for the split file filename
+    if not out_filename:
+        out_filename = os.path.splitext(filename)[0]
+    try:
+        with VolumeReader(crypto, password, filename, workers) as reader, open_stream(out_filename, "wb") as out_file:
+            buffer = bytearray(crypto.chunk_size)
+            view = memoryview(buffer)
+            while (size := reader.readinto(buffer)):
+                out_file.write(view[:size])
+    except Exception:
+        if os.path.exists(out_filename):
+            os.remove(out_filename)
+        raise
+    return out_filename